@@ -3,16 +3,19 @@
 import getpass
 import sys
 import traceback
+from datetime import datetime
 
 from IPython.core import release
 from IPython.utils.py3compat import builtin_mod, PY3
 from IPython.utils.tokenutil import token_at_cursor, line_at_cursor
-from IPython.utils.traitlets import Instance, Type, Any, List
+from IPython.utils.traitlets import Instance, Type, Any, List, Integer
 from IPython.utils.decorators import undoc
 
 from ..comm import CommManager
 from .kernelbase import Kernel as KernelBase
-from .serialize import serialize_object, unpack_apply_message
+from .serialize import (
+    serialize_object, unpack_apply_message, unpack_apply_args, FunctionCache,
+)
 from .zmqshell import ZMQInteractiveShell
 
 
@@ -36,6 +39,17 @@ def _user_ns_changed(self, name, old, new):
             self.shell.user_ns = new
             self.shell.init_user_ns()
 
+    function_cache_size = Integer(64, config=True,
+        help="""The number of functions from apply requests to keep, by content hash.
+        Clients may omit a cached function from subsequent requests.
+        Set to 0 to disable the cache."""
+    )
+    function_cache = Instance(FunctionCache)
+    def _function_cache_default(self):
+        return FunctionCache(self.function_cache_size)
+    def _function_cache_size_changed(self, name, old, new):
+        self.function_cache.size = new
+
     # A reference to the Python builtin 'raw_input' function.
     # (i.e., __builtin__.raw_input for Python 2.7, builtins.input for Python 3)
     _sys_raw_input = Any()
@@ -296,12 +310,33 @@ def do_is_complete(self, code):
 
     def do_apply(self, content, bufs, msg_id, reply_metadata):
         shell = self.shell
+        f_hash = reply_metadata.get('f_hash', None)
+        if f_hash and not len(bufs[0]) and f_hash not in self.function_cache:
+            # the client omitted a function we don't have, ask for it again
+            self.log.debug("function %s not in cache", f_hash)
+            reply_metadata['function_cache_miss'] = True
+            reply_content = dict(status='error', ename='FunctionCacheMiss', evalue=f_hash,
+                traceback=[], engine_info=dict(engine_uuid=self.ident,
+                engine_id=self.int_id, method='apply'),
+            )
+            return reply_content, []
         try:
             working = shell.user_ns
 
             prefix = "_"+str(msg_id).replace("-","")+"_"
 
-            f,args,kwargs = unpack_apply_message(bufs, working, copy=False)
+            if f_hash and not len(bufs[0]):
+                f = self.function_cache[f_hash]
+                args,kwargs = unpack_apply_args(bufs[1:], working, copy=False)
+            else:
+                f,args,kwargs = unpack_apply_message(bufs, working, copy=False)
+                # clients only send an f_hash for functions that don't
+                # depend on the namespace (see serialize.cacheable)
+                if f_hash:
+                    self.function_cache[f_hash] = f
+            if f_hash and f_hash in self.function_cache:
+                reply_metadata['function_cached'] = True
+            reply_metadata['unpacked'] = datetime.now()
 
             fname = getattr(f, '__name__', 'f')
 
@@ -320,6 +355,7 @@ def do_apply(self, content, bufs, msg_id, reply_metadata):
             finally:
                 for key in ns:
                     working.pop(key)
+                reply_metadata['finished'] = datetime.now()
 
             result_buf = serialize_object(result,
                 buffer_threshold=self.session.buffer_threshold,
@@ -351,6 +387,11 @@ def do_apply(self, content, bufs, msg_id, reply_metadata):
 
         return reply_content, result_buf
 
+    def data_names(self):
+        hidden = self.shell.user_ns_hidden
+        return set(name for name in self.shell.user_ns
+                   if not name.startswith('_') and name not in hidden)
+
     def do_clear(self):
         self.shell.reset(False)
         return dict(status='ok')
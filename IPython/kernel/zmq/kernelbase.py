@@ -108,6 +108,9 @@ def _ident_default(self):
     # set of aborted msg_ids
     aborted = Set()
 
+    # dict by upstream identity of the hash of the data_names last advertised there
+    _data_advertised = Dict()
+
     # Track execution count here. For IPython, we override this to use the
     # execution count we store in the shell.
     execution_count = 0
@@ -524,6 +527,10 @@ def apply_request(self, stream, ident, parent):
 
         # put 'ok'/'error' status in header, for scheduler introspection:
         md['status'] = reply_content['status']
+        # and our namespace if it changed, for data-locality-aware scheduling
+        names = self._data_update(ident[0] if ident else b'')
+        if names is not None:
+            md['data_names'] = names
 
         # flush i/o
         sys.stdout.flush()
@@ -537,6 +544,35 @@ def do_apply(self, content, bufs, msg_id, reply_metadata):
         """
         raise NotImplementedError
 
+    def data_names(self):
+        """Override in subclasses to advertise the names of the objects in the namespace
+        with apply replies, so that schedulers can send tasks where their data is.
+
+        Returns a set of names, or None to advertise nothing.
+        """
+        return None
+
+    def _data_update(self, route):
+        """data_names, if they changed since they were last advertised to the upstream
+        socket with identity `route`.
+
+        `route` is the first identity of the request: the socket that relayed it,
+        e.g. the task scheduler or the MUX, not the client that sent it.
+        The whole set is sent, so the scheduler never applies a diff against a set
+        it has not seen, and only a hash of it is kept per route.
+
+        Returns a sorted list of names, or None if nothing changed.
+        """
+        names = self.data_names()
+        if names is None:
+            return None
+        route = getattr(route, 'bytes', route)
+        digest = hash(frozenset(names))
+        if self._data_advertised.get(route) == digest:
+            return None
+        self._data_advertised[route] = digest
+        return sorted(names)
+
     #---------------------------------------------------------------------------
     # Control messages
     #---------------------------------------------------------------------------
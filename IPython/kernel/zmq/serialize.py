@@ -3,6 +3,9 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import hashlib
+from collections import OrderedDict, deque
+
 try:
     import cPickle
     pickle = cPickle
@@ -14,8 +17,8 @@
 from IPython.utils.py3compat import PY3, buffer_to_bytes_py2
 from IPython.utils.data import flatten
 from IPython.utils.pickleutil import (
-    can, uncan, can_sequence, uncan_sequence, CannedObject,
-    istype, sequence_types, PICKLE_PROTOCOL,
+    can, uncan, can_sequence, uncan_sequence, CannedObject, CannedFunction,
+    CannedCell, Reference, istype, sequence_types, PICKLE_PROTOCOL,
 )
 
 if PY3:
@@ -45,11 +48,11 @@ def _extract_buffers(obj, threshold=MAX_BYTES):
     return buffers
 
 def _restore_buffers(obj, buffers):
-    """restore buffers extracted by """
+    """restore buffers extracted by _extract_buffers, from a deque of buffers"""
     if isinstance(obj, CannedObject) and obj.buffers:
         for i,buf in enumerate(obj.buffers):
             if buf is None:
-                obj.buffers[i] = buffers.pop(0)
+                obj.buffers[i] = buffers.popleft()
 
 def serialize_object(obj, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
     """Serialize an object into a list of sendable buffers.
@@ -96,6 +99,8 @@ def deserialize_object(buffers, g=None):
     ----------
     
     bufs : list of buffers/bytes
+        These may be zmq Frames (as received with copy=False),
+        in which case large arrays are built on the memory of the frames, without copying.
     
     g : globals to be used when uncanning
     
@@ -104,8 +109,8 @@ def deserialize_object(buffers, g=None):
     
     (newobj, bufs) : unpacked object, and the list of remaining unused buffers.
     """
-    bufs = list(buffers)
-    pobj = buffer_to_bytes_py2(bufs.pop(0))
+    bufs = deque(buffers)
+    pobj = buffer_to_bytes_py2(bufs.popleft())
     canned = pickle.loads(pobj)
     if istype(canned, sequence_types) and len(canned) < MAX_ITEMS:
         for c in canned:
@@ -121,7 +126,21 @@ def deserialize_object(buffers, g=None):
         _restore_buffers(canned, bufs)
         newobj = uncan(canned, g)
     
-    return newobj, bufs
+    return newobj, list(bufs)
+
+def _pack_apply_args(args, kwargs, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
+    """pack up args and kwargs for an apply message: [ pinfo, <arg_bufs>, <kwarg_bufs> ]"""
+    arg_bufs = flatten(serialize_object(arg, buffer_threshold, item_threshold) for arg in args)
+    
+    kw_keys = sorted(kwargs.keys())
+    kwarg_bufs = flatten(serialize_object(kwargs[key], buffer_threshold, item_threshold) for key in kw_keys)
+    
+    info = dict(nargs=len(args), narg_bufs=len(arg_bufs), kw_keys=kw_keys)
+    
+    msg = [pickle.dumps(info, PICKLE_PROTOCOL)]
+    msg.extend(arg_bufs)
+    msg.extend(kwarg_bufs)
+    return msg
 
 def pack_apply_message(f, args, kwargs, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
     """pack up a function, args, and kwargs to be sent over the wire
@@ -138,20 +157,58 @@ def pack_apply_message(f, args, kwargs, buffer_threshold=MAX_BYTES, item_thresho
     
     With length at least two + len(args) + len(kwargs)
     """
+    msg = [pickle.dumps(can(f), PICKLE_PROTOCOL)]
+    msg.extend(_pack_apply_args(args, kwargs, buffer_threshold, item_threshold))
+    return msg
+
+def pack_apply_batch(f, arg_list, kwargs, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
+    """pack up a function and several sets of args to be sent over the wire together
     
-    arg_bufs = flatten(serialize_object(arg, buffer_threshold, item_threshold) for arg in args)
-    
-    kw_keys = sorted(kwargs.keys())
-    kwarg_bufs = flatten(serialize_object(kwargs[key], buffer_threshold, item_threshold) for key in kw_keys)
+    The function is canned and pickled only once.  Every call gets the same kwargs.
     
-    info = dict(nargs=len(args), narg_bufs=len(arg_bufs), kw_keys=kw_keys)
+    Returns (bufs, nbufs), where bufs is a list of bytes/buffers of the format:
     
-    msg = [pickle.dumps(can(f), PICKLE_PROTOCOL)]
-    msg.append(pickle.dumps(info, PICKLE_PROTOCOL))
-    msg.extend(arg_bufs)
-    msg.extend(kwarg_bufs)
+    [ cf, pinfo_0, <arg_bufs_0>, <kwarg_bufs_0>, pinfo_1, ... ]
     
-    return msg
+    and nbufs[i] is the number of buffers for call i, so that ``cf``
+    followed by the buffers of call i is the output of pack_apply_message.
+    """
+    bufs = [pickle.dumps(can(f), PICKLE_PROTOCOL)]
+    nbufs = []
+    for args in arg_list:
+        call_bufs = _pack_apply_args(args, kwargs, buffer_threshold, item_threshold)
+        nbufs.append(len(call_bufs))
+        bufs.extend(call_bufs)
+    return bufs, nbufs
+
+def pack_apply_graph(calls, buffer_threshold=MAX_BYTES, item_threshold=MAX_ITEMS):
+    """pack up calls of several functions to be sent over the wire together
+
+    `calls` is a list of (f, args, kwargs).
+    Each distinct function object is canned and pickled only once.
+
+    Returns (bufs, nbufs, f_indices), where bufs is a list of bytes/buffers of the format:
+
+    [ cf_0, cf_1, ..., pinfo_0, <arg_bufs_0>, <kwarg_bufs_0>, pinfo_1, ... ]
+
+    nbufs[i] is the number of buffers for call i, and f_indices[i] is the index
+    of its function, so that ``bufs[f_indices[i]]`` followed by the buffers of call i
+    is the output of pack_apply_message.
+    """
+    f_bufs = []
+    f_index = {} # by id of the function
+    f_indices = []
+    call_bufs = []
+    nbufs = []
+    for f, args, kwargs in calls:
+        if id(f) not in f_index:
+            f_index[id(f)] = len(f_bufs)
+            f_bufs.append(pickle.dumps(can(f), PICKLE_PROTOCOL))
+        f_indices.append(f_index[id(f)])
+        bufs = _pack_apply_args(args, kwargs, buffer_threshold, item_threshold)
+        nbufs.append(len(bufs))
+        call_bufs.extend(bufs)
+    return f_bufs + call_bufs, nbufs, f_indices
 
 def unpack_apply_message(bufs, g=None, copy=True):
     """unpack f,args,kwargs from buffers packed by pack_apply_message()
@@ -160,6 +217,14 @@ def unpack_apply_message(bufs, g=None, copy=True):
     assert len(bufs) >= 2, "not enough buffers!"
     pf = buffer_to_bytes_py2(bufs.pop(0))
     f = uncan(pickle.loads(pf), g)
+    args, kwargs = unpack_apply_args(bufs, g, copy)
+    return f,args,kwargs
+
+def unpack_apply_args(bufs, g=None, copy=True):
+    """unpack args,kwargs from the buffers of an apply message after the function
+    Returns: original args,kwargs"""
+    bufs = list(bufs) # allow us to pop
+    assert len(bufs) >= 1, "not enough buffers!"
     pinfo = buffer_to_bytes_py2(bufs.pop(0))
     info = pickle.loads(pinfo)
     arg_bufs, kwarg_bufs = bufs[:info['narg_bufs']], bufs[info['narg_bufs']:]
@@ -177,5 +242,85 @@ def unpack_apply_message(bufs, g=None, copy=True):
         kwargs[key] = kwarg
     assert not kwarg_bufs, "Shouldn't be any kwarg bufs left over"
     
-    return f,args,kwargs
+    return args,kwargs
+
+#-----------------------------------------------------------------------------
+# Function cache
+#-----------------------------------------------------------------------------
+
+def function_hash(pf):
+    """The content hash of a pickled, canned function (the first buffer of an apply message)
+    
+    Used as the key of engines' FunctionCache, so that requests
+    applying the same function can omit it.
+    """
+    return hashlib.sha1(buffer_to_bytes_py2(pf)).hexdigest()
+
+def _namespace_free(canned):
+    """Whether uncanning an object is independent of the namespace it is uncanned in"""
+    if isinstance(canned, Reference):
+        return False
+    if isinstance(canned, CannedFunction):
+        return all(_namespace_free(c) for c in list(canned.defaults or ()) + list(canned.closure or ()))
+    if isinstance(canned, CannedCell):
+        return _namespace_free(canned.cell_contents)
+    if isinstance(canned, (list, tuple)):
+        return all(_namespace_free(c) for c in canned)
+    if isinstance(canned, dict):
+        return all(_namespace_free(c) for c in canned.values())
+    # generic CannedObjects may run a hook when uncanned, e.g. dependents
+    return type(canned) is not CannedObject
+
+def cacheable(f):
+    """Whether engines can cache f by function_hash.
+    
+    Only plain functions are cacheable.  A Reference, or a function with
+    a Reference default or closure, is looked up in the engine's namespace
+    when it is uncanned, so the same pickle can stand for different functions.
+    """
+    canned = can(f)
+    return isinstance(canned, CannedFunction) and _namespace_free(canned)
+
+class FunctionCacheMiss(KeyError):
+    """An apply_request omitted a function that is not in the engine's FunctionCache"""
+    pass
+
+class FunctionCache(object):
+    """A small LRU mapping of function_hash to uncanned function.
+    
+    Engines keep one of these, and clients and schedulers keep one per engine
+    as a record of which functions that engine is believed to have.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self._cache = OrderedDict()
+    
+    def __len__(self):
+        return len(self._cache)
+    
+    def __contains__(self, key):
+        return key in self._cache
+    
+    def __getitem__(self, key):
+        try:
+            value = self._cache.pop(key)
+        except KeyError:
+            raise FunctionCacheMiss(key)
+        # move to the end
+        self._cache[key] = value
+        return value
+    
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        self._cache.pop(key, None)
+        self._cache[key] = value
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+    
+    def discard(self, key):
+        self._cache.pop(key, None)
+    
+    def clear(self):
+        self._cache.clear()
 
@@ -16,10 +16,12 @@
 import logging
 import os
 import pprint
-import random
+import struct
 import uuid
 import warnings
+from collections import deque
 from datetime import datetime
+from importlib import import_module
 
 try:
     import cPickle
@@ -45,12 +47,12 @@ def compare_digest(a,b): return a == b
 from IPython.config.configurable import Configurable, LoggingConfigurable
 from IPython.utils import io
 from IPython.utils.importstring import import_item
-from IPython.utils.jsonutil import extract_dates, squash_dates, date_default
+from IPython.utils.jsonutil import squash_dates, date_default, parse_date
 from IPython.utils.py3compat import (str_to_bytes, str_to_unicode, unicode_type,
-                                     iteritems)
-from IPython.utils.traitlets import (CBytes, Unicode, Bool, Any, Instance, Set,
+                                     string_types, cast_bytes, iteritems, PY3)
+from IPython.utils.traitlets import (CBytes, Unicode, Bool, Any, Instance,
                                         DottedObjectName, CUnicode, Dict, Integer,
-                                        TraitError,
+                                        TraitError, Enum,
 )
 from IPython.utils.pickleutil import PICKLE_PROTOCOL
 from IPython.kernel.adapter import adapt
@@ -96,6 +98,84 @@ def squash_unicode(obj):
 # singleton dummy tracker, which will always report as done
 DONE = zmq.MessageTracker()
 
+# stdlib modules with compress/decompress functions, usable for buffers
+COMPRESSION_METHODS = ('zlib', 'bz2', 'lzma')
+
+def compressor(method):
+    """Get the module for a compression method"""
+    if method not in COMPRESSION_METHODS:
+        raise ValueError("Unknown compression method %r, must be one of %s"
+                         % (method, COMPRESSION_METHODS))
+    return import_module(method)
+
+#-----------------------------------------------------------------------------
+# header codec
+#-----------------------------------------------------------------------------
+
+# the text keys of headers made by msg_header, in the order they are packed
+HEADER_KEYS = ('msg_id', 'msg_type', 'username', 'session', 'version')
+# packed headers start with a NUL byte, which starts no JSON, pickle or msgpack header
+PACKED_HEADER = b'\x00'
+_packed_date = struct.Struct('!HBBBBBI')
+_packed_len = struct.Struct('!H')
+
+def pack_header(header):
+    """Pack a header made by msg_header into compact bytes.
+
+    The date is packed as its fields, and each text value as its length
+    and utf8 bytes.  Returns None for headers with any other keys or types,
+    which must be packed as JSON.
+    """
+    if not isinstance(header, dict) or len(header) != len(HEADER_KEYS) + 1:
+        return None
+    date = header.get('date', None)
+    if not isinstance(date, datetime) or date.tzinfo:
+        return None
+    parts = [PACKED_HEADER, _packed_date.pack(date.year, date.month, date.day,
+        date.hour, date.minute, date.second, date.microsecond)]
+    for key in HEADER_KEYS:
+        value = header.get(key, None)
+        if not isinstance(value, string_types):
+            return None
+        value = cast_bytes(value)
+        if len(value) > 0xffff:
+            return None
+        parts.append(_packed_len.pack(len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+def unpack_header(packed):
+    """Unpack a header packed by pack_header"""
+    header = {'date': datetime(*_packed_date.unpack_from(packed, 1))}
+    offset = 1 + _packed_date.size
+    for key in HEADER_KEYS:
+        n, = _packed_len.unpack_from(packed, offset)
+        offset += _packed_len.size
+        header[key] = packed[offset:offset + n].decode('utf8')
+        offset += n
+    return header
+
+def parse_header_date(s):
+    """Parse the ISO8601 date of a header.
+
+    Dates in the format of datetime.isoformat, as sent by Session,
+    are sliced into their fields, which is much faster than parse_date.
+    Other dates go through parse_date.
+    """
+    if not isinstance(s, string_types):
+        return s
+    n = len(s)
+    if ((n == 19 or n == 26 and s[19] == '.') and s[4] == s[7] == '-' and s[10] == 'T'
+            and s[13] == s[16] == ':'):
+        try:
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                int(s[20:26]) if n == 26 else 0,
+            )
+        except ValueError:
+            pass
+    return parse_date(s)
+
 #-----------------------------------------------------------------------------
 # Mixin tools for apps that use Sessions
 #-----------------------------------------------------------------------------
@@ -192,6 +272,50 @@ def __getitem__(self, k):
         return self.__dict__[k]
 
 
+class DigestHistory(object):
+    """A bounded history of message signatures, for detecting replayed messages.
+
+    Signatures are kept in a ring of sets, or generations, and the oldest
+    generation is forgotten when the newest one is full.
+    Adding and checking a signature are O(1), and at most `size` signatures
+    are remembered.  When the history is full, adding a signature forgets
+    the oldest 1/`generations` of it.
+    """
+
+    def __init__(self, size=2**16, generations=10):
+        self.size = size
+        self.capacity = max(1, size // generations)
+        self.generations = size // self.capacity if size else 0
+        self.clear()
+
+    def clear(self):
+        self._sets = deque([set()])
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, signature):
+        for digests in self._sets:
+            if signature in digests:
+                return True
+        return False
+
+    def add(self, signature):
+        """Add a new signature, which callers have checked is not in the history."""
+        if not self.generations:
+            return
+        current = self._sets[-1]
+        if len(current) >= self.capacity:
+            current = set()
+            self._sets.append(current)
+            if len(self._sets) > self.generations:
+                self._len -= len(self._sets.popleft())
+        before = len(current)
+        current.add(signature)
+        self._len += len(current) - before
+
+
 def msg_header(msg_id, msg_type, username, session):
     date = datetime.now()
     version = kernel_protocol_version
@@ -348,13 +472,17 @@ def _new_auth(self):
         else:
             self.auth = None
     
-    digest_history = Set()
+    digest_history = Instance(DigestHistory)
+    def _digest_history_default(self):
+        return DigestHistory(self.digest_history_size)
     digest_history_size = Integer(2**16, config=True,
         help="""The maximum number of digests to remember.
         
-        The digest history will be culled when it exceeds this value.
+        When the digest history reaches this size, the oldest 10% is forgotten.
         """
     )
+    def _digest_history_size_changed(self, name, old, new):
+        self.digest_history = DigestHistory(new)
 
     keyfile = Unicode('', config=True,
         help="""path to file containing execution key.""")
@@ -388,6 +516,34 @@ def _unpack_changed(self, name, old, new):
         Containers larger than this are pickled outright.
         """
     )
+    compression = Enum(('',) + COMPRESSION_METHODS, '', config=True,
+        help="""Compress buffers larger than buffer_threshold with this stdlib module
+        ('zlib', 'bz2' or 'lzma') before sending them.
+        
+        Compressed buffers are listed in the message metadata,
+        so any Session can receive them, whatever its own setting.
+        """
+    )
+    def _compression_changed(self, name, old, new):
+        if new:
+            # fail early if it is unavailable, e.g. lzma on Python 2
+            compressor(new)
+
+    packed_headers = Bool(False, config=True,
+        help="""Send headers in a compact binary format, instead of with the packer.
+        
+        Packed headers are recognized by their first byte,
+        so any Session can receive them, whatever its own setting,
+        but other implementations of the message protocol cannot.
+        Only enable this when all peers are IPython Sessions,
+        e.g. between the controller and engines of a cluster.
+        """
+    )
+    parent_cache_size = Integer(128, config=True,
+        help="""The number of recently received parent headers to keep unpacked,
+        since many messages, such as outputs, share the same parent."""
+    )
+    _parent_cache = Dict()
 
     
     def __init__(self, **kwargs):
@@ -512,6 +668,40 @@ def msg(self, msg_type, content=None, parent=None, header=None, metadata=None):
             msg['metadata'].update(metadata)
         return msg
 
+    def pack_header(self, header):
+        """Pack a header or parent header, in the compact format if packed_headers
+        is enabled and the header allows it, or with the packer."""
+        if self.packed_headers:
+            packed = pack_header(header)
+            if packed is not None:
+                return packed
+        return self.pack(header)
+
+    def unpack_header(self, msg_bytes):
+        """Unpack a header or parent header.
+
+        Only the date is parsed into a datetime, not every string that looks like one.
+        """
+        if msg_bytes[:1] == PACKED_HEADER:
+            return unpack_header(msg_bytes)
+        header = self.unpack(msg_bytes)
+        if isinstance(header, dict) and 'date' in header:
+            header['date'] = parse_header_date(header['date'])
+        return header
+
+    def _unpack_parent(self, msg_bytes):
+        """Unpack a parent header, reusing the result for recently seen parents."""
+        cache = self._parent_cache
+        parent = cache.get(msg_bytes, None)
+        if parent is None:
+            parent = self.unpack_header(msg_bytes)
+            if not self.parent_cache_size or not isinstance(parent, dict):
+                return parent
+            if len(cache) >= self.parent_cache_size:
+                cache.clear()
+            cache[msg_bytes] = parent
+        return dict(parent)
+
     def sign(self, msg_list):
         """Sign a message with HMAC digest. If no auth, return b''.
 
@@ -564,8 +754,8 @@ def serialize(self, msg, ident=None):
         else:
             raise TypeError("Content incorrect type: %s"%type(content))
 
-        real_message = [self.pack(msg['header']),
-                        self.pack(msg['parent_header']),
+        real_message = [self.pack_header(msg['header']),
+                        self.pack_header(msg['parent_header']),
                         self.pack(msg['metadata']),
                         content,
         ]
@@ -648,6 +838,8 @@ def send(self, stream, msg_or_type, content=None, parent=None, ident=None,
             io.rprint(msg)
             return
         buffers = [] if buffers is None else buffers
+        if self.compression and buffers:
+            msg, buffers = self.compress_buffers(msg, buffers)
         if self.adapt_version:
             msg = adapt(msg, self.adapt_version)
         to_send = self.serialize(msg, ident)
@@ -672,6 +864,52 @@ def send(self, stream, msg_or_type, content=None, parent=None, ident=None,
 
         return msg
 
+    def compress_buffers(self, msg, buffers):
+        """Compress the buffers of a message larger than buffer_threshold.
+
+        Buffers that do not shrink are left alone. The indices of the compressed
+        buffers and the method are recorded in the 'compression' metadata of the message,
+        which is signed, for `deserialize` to undo.
+        Messages that already have 'compression' metadata, such as resubmitted ones,
+        are left alone.
+
+        Returns (msg, buffers): a copy of the message and the new buffers.
+        """
+        if 'compression' in msg['metadata']:
+            return msg, buffers
+        compress = compressor(self.compression).compress
+        buffers = list(buffers)
+        compressed = []
+        for i, buf in enumerate(buffers):
+            if len(buf) <= self.buffer_threshold:
+                continue
+            zbuf = compress(buf)
+            if len(zbuf) < len(buf):
+                buffers[i] = zbuf
+                compressed.append(i)
+        if compressed:
+            msg = dict(msg)
+            msg['metadata'] = dict(msg['metadata'], compression=dict(
+                method=self.compression, buffers=compressed,
+            ))
+        return msg, buffers
+
+    def decompress_buffers(self, metadata, buffers):
+        """Decompress the buffers listed in a message's 'compression' metadata.
+
+        The 'compression' key is removed from the metadata.
+        """
+        info = metadata.pop('compression')
+        decompress = compressor(info['method']).decompress
+        buffers = list(buffers)
+        for i in info['buffers']:
+            buf = buffers[i]
+            if isinstance(buf, zmq.Frame):
+                # zlib and bz2 on Python 2 do not take memoryviews
+                buf = buf.buffer if PY3 else buf.bytes
+            buffers[i] = decompress(buf)
+        return buffers
+
     def send_raw(self, stream, msg_list, flags=0, copy=True, ident=None):
         """Send a raw message via ident path.
 
@@ -772,27 +1010,7 @@ def feed_identities(self, msg_list, copy=True):
 
     def _add_digest(self, signature):
         """add a digest to history to protect against replay attacks"""
-        if self.digest_history_size == 0:
-            # no history, never add digests
-            return
-        
         self.digest_history.add(signature)
-        if len(self.digest_history) > self.digest_history_size:
-            # threshold reached, cull 10%
-            self._cull_digest_history()
-    
-    def _cull_digest_history(self):
-        """cull the digest history
-        
-        Removes a randomly selected 10% of the digest history
-        """
-        current = len(self.digest_history)
-        n_to_cull = max(int(current // 10), current - self.digest_history_size)
-        if n_to_cull >= current:
-            self.digest_history = set()
-            return
-        to_cull = random.sample(self.digest_history, n_to_cull)
-        self.digest_history.difference_update(to_cull)
     
     def deserialize(self, msg_list, content=True, copy=True):
         """Unserialize a msg_list to a nested message dict.
@@ -808,7 +1026,8 @@ def deserialize(self, msg_list, content=True, copy=True):
             p_metadata,p_content,buffer1,buffer2,...].
         content : bool (True)
             Whether to unpack the content dict (True), or leave it packed
-            (False).
+            (False). Compressed buffers are only decompressed with the content,
+            so messages that are just relayed are not decompressed.
         copy : bool (True)
             Whether to return the bytes (True), or the non-copying Message
             object in each place (False).
@@ -836,11 +1055,11 @@ def deserialize(self, msg_list, content=True, copy=True):
                 raise ValueError("Invalid Signature: %r" % signature)
         if not len(msg_list) >= minlen:
             raise TypeError("malformed message, must have at least %i elements"%minlen)
-        header = self.unpack(msg_list[1])
-        message['header'] = extract_dates(header)
+        header = self.unpack_header(msg_list[1])
+        message['header'] = header
         message['msg_id'] = header['msg_id']
         message['msg_type'] = header['msg_type']
-        message['parent_header'] = extract_dates(self.unpack(msg_list[2]))
+        message['parent_header'] = self._unpack_parent(msg_list[2])
         message['metadata'] = self.unpack(msg_list[3])
         if content:
             message['content'] = self.unpack(msg_list[4])
@@ -848,6 +1067,8 @@ def deserialize(self, msg_list, content=True, copy=True):
             message['content'] = msg_list[4]
 
         message['buffers'] = msg_list[5:]
+        if content and 'compression' in message['metadata']:
+            message['buffers'] = self.decompress_buffers(message['metadata'], message['buffers'])
         # adapt to the current version
         return adapt(message)
     
@@ -9,9 +9,14 @@
 import nose.tools as nt
 
 # from unittest import TestCaes
-from IPython.kernel.zmq.serialize import serialize_object, deserialize_object
+from IPython.kernel.zmq.serialize import (
+    serialize_object, deserialize_object,
+    pack_apply_batch, pack_apply_graph, pack_apply_message,
+    unpack_apply_message, unpack_apply_args,
+    function_hash, cacheable, FunctionCache, FunctionCacheMiss,
+)
 from IPython.testing import decorators as dec
-from IPython.utils.pickleutil import CannedArray, CannedClass
+from IPython.utils.pickleutil import CannedArray, CannedClass, Reference
 from IPython.utils.py3compat import iteritems
 from IPython.parallel import interactive
 
@@ -140,6 +145,30 @@ def test_numpy_in_dict():
             nt.assert_equal(A.dtype, B.dtype)
             assert_array_equal(A,B)
 
+@dec.skip_without('numpy')
+def test_numpy_frames():
+    """arrays are built on the memory of zmq Frames"""
+    import numpy
+    import zmq
+    from numpy.testing.utils import assert_array_equal
+    A = new_array((1024, 10), 'float64')
+    frames = [ zmq.Frame(buf) for buf in serialize_object(A) ]
+    B, r = deserialize_object(frames)
+    nt.assert_equal(r, [])
+    assert_array_equal(A, B)
+    nt.assert_false(B.flags.owndata)
+
+def test_many_buffers():
+    objs = [ b"x" * 1025 ] * 10
+    bufs = []
+    for obj in objs:
+        bufs.extend(serialize_object(obj))
+    result = []
+    while bufs:
+        obj, bufs = deserialize_object(bufs)
+        result.append(obj)
+    nt.assert_equal(result, objs)
+
 def test_class():
     @interactive
     class C(object):
@@ -206,3 +235,76 @@ class D(C):
     D2 = d['D']
     nt.assert_equal(D2.a, D.a)
     nt.assert_equal(D2.b, D.b)
+
+def test_apply_batch():
+    arg_list = [ (i, b'x' * (i * 1024)) for i in range(4) ]
+    bufs, nbufs = pack_apply_batch(len, arg_list, dict(k=5))
+    nt.assert_equal(len(nbufs), len(arg_list))
+    nt.assert_equal(len(bufs), 1 + sum(nbufs))
+    offset = 1
+    for args, n in zip(arg_list, nbufs):
+        f, args2, kwargs = unpack_apply_message([bufs[0]] + bufs[offset:offset+n])
+        offset += n
+        nt.assert_equal(f, len)
+        nt.assert_equal(args2, args)
+        nt.assert_equal(kwargs, dict(k=5))
+
+def test_apply_graph():
+    calls = [ (len, (b'abc',), {}), (max, (1, 2), {}), (len, (b'x' * 2048,), dict(k=5)) ]
+    bufs, nbufs, f_indices = pack_apply_graph(calls)
+    nt.assert_equal(f_indices, [0, 1, 0])
+    nt.assert_equal(len(bufs), 2 + sum(nbufs))
+    offset = 2
+    for call, n, i in zip(calls, nbufs, f_indices):
+        f, args, kwargs = unpack_apply_message([bufs[i]] + bufs[offset:offset+n])
+        offset += n
+        nt.assert_equal((f, args, kwargs), call)
+
+def test_unpack_apply_args():
+    bufs = pack_apply_message(len, (1, b'x' * 2048), dict(k=5))
+    args, kwargs = unpack_apply_args(bufs[1:])
+    nt.assert_equal(args, (1, b'x' * 2048))
+    nt.assert_equal(kwargs, dict(k=5))
+
+def test_function_hash():
+    def foo(a):
+        return a+1
+    def bar(a):
+        return a+2
+    h = function_hash(pack_apply_message(foo, (1,), {})[0])
+    nt.assert_equal(h, function_hash(pack_apply_message(foo, (2,), {})[0]))
+    nt.assert_not_equal(h, function_hash(pack_apply_message(bar, (1,), {})[0]))
+
+def test_cacheable():
+    def foo(a):
+        return a+1
+    def bar(a, b=Reference('b')):
+        return a+b
+    r = Reference('foo')
+    def baz(a):
+        return r
+    nt.assert_true(cacheable(foo))
+    # uncanning these depends on the namespace
+    nt.assert_false(cacheable(Reference('foo')))
+    nt.assert_false(cacheable(bar))
+    nt.assert_false(cacheable(baz))
+
+def test_function_cache():
+    cache = FunctionCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    # touch a, so b is evicted
+    nt.assert_equal(cache['a'], 1)
+    cache['c'] = 3
+    nt.assert_equal(len(cache), 2)
+    nt.assert_in('a', cache)
+    nt.assert_not_in('b', cache)
+    with nt.assert_raises(FunctionCacheMiss):
+        cache['b']
+    cache.discard('a')
+    nt.assert_not_in('a', cache)
+
+def test_function_cache_disabled():
+    cache = FunctionCache(0)
+    cache['a'] = 1
+    nt.assert_not_in('a', cache)
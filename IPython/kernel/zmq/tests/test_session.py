@@ -6,6 +6,7 @@
 import hmac
 import os
 import uuid
+import zlib
 from datetime import datetime
 
 import zmq
@@ -125,6 +126,54 @@ def test_send(self):
         B.close()
         ctx.term()
 
+    def test_compression(self):
+        ctx = zmq.Context.instance()
+        A = ctx.socket(zmq.PAIR)
+        B = ctx.socket(zmq.PAIR)
+        A.bind("inproc://test")
+        B.connect("inproc://test")
+
+        sender = ss.Session(compression='zlib', key=self.session.key)
+        big = b'x' * 10000
+        small = b'y' * 10
+        noise = os.urandom(10000)
+        msg = sender.send(A, 'execute', content=dict(a=10), buffers=[big, small, noise])
+        self.assertEqual(msg['metadata']['compression'], dict(method='zlib', buffers=[0]))
+
+        msg_list = B.recv_multipart()
+        self.assertTrue(len(msg_list[-3]) < len(big))
+        self.assertEqual(msg_list[-2:], [small, noise])
+        # any session can decompress
+        ident, relayed = self.session.feed_identities(msg_list)
+        new_msg = self.session.deserialize(list(relayed))
+        self.assertEqual(new_msg['buffers'], [big, small, noise])
+        self.assertNotIn('compression', new_msg['metadata'])
+        # unless only relaying
+        relay = ss.Session(key=self.session.key)
+        new_msg = relay.deserialize(list(relayed), content=False)
+        self.assertEqual(new_msg['metadata']['compression']['method'], 'zlib')
+        self.assertTrue(len(new_msg['buffers'][0]) < len(big))
+
+        # without copying
+        sender.send(A, 'execute', content=dict(a=10), buffers=[big])
+        ident, new_msg = self.session.recv(B, mode=0, copy=False)
+        self.assertEqual(new_msg['buffers'], [big])
+
+        # buffers that are already compressed are sent as they are
+        md = dict(compression=dict(method='zlib', buffers=[1]))
+        sender.send(A, 'execute', content=dict(a=10), metadata=md,
+            buffers=[big, zlib.compress(big)])
+        ident, new_msg = self.session.recv(B, mode=0)
+        self.assertEqual(new_msg['buffers'], [big, big])
+
+        A.close()
+        B.close()
+        ctx.term()
+
+    def test_bad_compression(self):
+        with self.assertRaises(Exception):
+            ss.Session(compression='gzip')
+
     def test_args(self):
         """initialization arguments for Session"""
         s = self.session
@@ -216,6 +265,28 @@ def test_cull_digest_history(self):
         self.assertTrue(len(session.digest_history) == 100)
         session._add_digest(uuid.uuid4().bytes)
         self.assertTrue(len(session.digest_history) == 91)
+
+    def test_digest_history_oldest_first(self):
+        session = ss.Session(digest_history_size=20)
+        first = [uuid.uuid4().bytes for i in range(5)]
+        for digest in first:
+            session._add_digest(digest)
+        for i in range(30):
+            session._add_digest(uuid.uuid4().bytes)
+        self.assertTrue(len(session.digest_history) <= 20)
+        for digest in first:
+            self.assertNotIn(digest, session.digest_history)
+        last = uuid.uuid4().bytes
+        session._add_digest(last)
+        self.assertIn(last, session.digest_history)
+
+    def test_replay(self):
+        session = ss.Session(key=b'secret')
+        msg_list = session.serialize(session.msg('execute_request'))[1:]
+        session.deserialize(msg_list)
+        self.assertRaises(ValueError, session.deserialize, msg_list)
+        session.digest_history.clear()
+        session.deserialize(msg_list)
     
     def test_bad_pack(self):
         try:
@@ -292,6 +363,55 @@ def test_datetimes_msgpack(self):
         )
         self._datetime_test(session)
     
+    def test_datetimes_packed_headers(self):
+        session = ss.Session(packed_headers=True)
+        self._datetime_test(session)
+
+    def test_packed_headers(self):
+        sender = ss.Session(packed_headers=True, key=self.session.key)
+        p = sender.msg('request')
+        msg = sender.msg('reply', parent=p)
+        msg_list = sender.feed_identities(sender.serialize(msg))[1]
+        self.assertEqual(msg_list[1][:1], ss.PACKED_HEADER)
+        self.assertEqual(msg_list[2][:1], ss.PACKED_HEADER)
+        # any Session can receive them
+        for receiver in (sender, self.session):
+            msg2 = receiver.deserialize(list(msg_list))
+            self.assertEqual(msg2['header'], msg['header'])
+            self.assertEqual(msg2['parent_header'], msg['parent_header'])
+        # empty and custom headers are still packed with the packer
+        self.assertEqual(sender.pack_header({}), sender.pack({}))
+        header = dict(msg['header'], extra='x')
+        self.assertEqual(sender.unpack_header(sender.pack_header(header)), header)
+
+    def test_header_dates(self):
+        header = self.session.msg_header('msg')
+        header['other'] = datetime.now().isoformat()
+        header2 = self.session.unpack_header(self.session.pack(header))
+        self.assertEqual(header2['date'], header['date'])
+        # only the date is parsed
+        self.assertEqual(header2['other'], header['other'])
+        for date in (datetime(2015, 1, 2, 3, 4, 5, 6), datetime(2015, 1, 2, 3, 4, 5)):
+            self.assertEqual(ss.parse_header_date(date.isoformat()), date)
+        self.assertEqual(ss.parse_header_date('2015-01-02T03:04:05.000006Z'),
+            datetime(2015, 1, 2, 3, 4, 5, 6))
+        self.assertEqual(ss.parse_header_date('not a date'), 'not a date')
+
+    def test_parent_cache(self):
+        session = self.session
+        p = session.msg('request')
+        parents = []
+        for i in range(3):
+            msg = session.msg('output', parent=p)
+            msg_list = session.feed_identities(session.serialize(msg))[1]
+            parents.append(session.deserialize(msg_list)['parent_header'])
+        self.assertEqual(parents[0], p['header'])
+        self.assertEqual(parents[2], p['header'])
+        # each message gets its own copy
+        parents[0]['msg_id'] = 'changed'
+        self.assertEqual(parents[1], p['header'])
+        self.assertEqual(len(session._parent_cache), 1)
+
     def test_send_raw(self):
         ctx = zmq.Context.instance()
         A = ctx.socket(zmq.PAIR)
@@ -426,7 +426,8 @@ def init_schedulers(self):
                     disambiguate_url(f.client_url('registration')),
             )
             kwargs = dict(logname='scheduler', loglevel=self.log_level,
-                            log_url = self.log_url, config=dict(self.config))
+                            log_url = self.log_url, config=dict(self.config),
+                            ctl_addr=disambiguate_url(f.client_url('control')))
             if 'Process' in self.mq_class:
                 # run the Python scheduler in a Process
                 q = Process(target=launch_scheduler, args=sargs, kwargs=kwargs)
@@ -522,6 +523,7 @@ def start(self):
         except KeyboardInterrupt:
             self.log.critical("Interrupted, Exiting...\n")
         finally:
+            self.factory.heartmonitor.stop()
             self.cleanup_connection_files()
             
 
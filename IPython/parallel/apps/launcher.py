@@ -27,6 +27,7 @@
 except ImportError:
     pass
 
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE, STDOUT
 try:
     from subprocess import check_output
@@ -353,10 +354,14 @@ class LocalEngineSetLauncher(LocalEngineLauncher):
     """Launch a set of engines as regular external processes."""
 
     delay = CFloat(0.1, config=True,
-        help="""delay (in seconds) between starting each engine after the first.
+        help="""delay (in seconds) between starting each group of `start_concurrency` engines.
         This can help force the engines to get their ids in order, or limit
         process flood when starting many engines."""
     )
+    start_concurrency = Integer(16, config=True,
+        help="""The number of engines to start at once, without waiting `delay` between them.
+        Set to 1 to start engines one at a time."""
+    )
 
     # launcher class
     launcher_class = LocalEngineLauncher
@@ -372,10 +377,8 @@ def __init__(self, work_dir=u'.', config=None, **kwargs):
 
     def start(self, n):
         """Start n engines by profile or profile_dir."""
-        dlist = []
+        launchers = []
         for i in range(n):
-            if i > 0:
-                time.sleep(self.delay)
             el = self.launcher_class(work_dir=self.work_dir, parent=self, log=self.log,
                                     profile_dir=self.profile_dir, cluster_id=self.cluster_id,
             )
@@ -383,11 +386,25 @@ def start(self, n):
             # Copy the engine args over to each engine launcher.
             el.engine_cmd = copy.deepcopy(self.engine_cmd)
             el.engine_args = copy.deepcopy(self.engine_args)
+            launchers.append((i, el))
+        dlist = self._start_launchers(launchers)
+        self.notify_start(dlist)
+        return dlist
+
+    def _start_launchers(self, launchers):
+        """Start a list of (key, launcher), `start_concurrency` at a time.
+
+        Returns the list of their start data.
+        """
+        dlist = []
+        batch = max(1, self.start_concurrency)
+        for i, (key, el) in enumerate(launchers):
+            if i > 0 and i % batch == 0:
+                time.sleep(self.delay)
             el.on_stop(self._notice_engine_stopped)
             d = el.start()
-            self.launchers[i] = el
+            self.launchers[key] = el
             dlist.append(d)
-        self.notify_start(dlist)
         return dlist
 
     def find_args(self):
@@ -751,7 +768,7 @@ def start(self, n):
         `n` is ignored, and the `engines` config property is used instead.
         """
 
-        dlist = []
+        launchers = []
         for host, n in iteritems(self.engines):
             if isinstance(n, (tuple, list)):
                 n, args = n
@@ -763,22 +780,32 @@ def start(self, n):
             else:
                 user=None
             for i in range(n):
-                if i > 0:
-                    time.sleep(self.delay)
                 el = self.launcher_class(work_dir=self.work_dir, parent=self, log=self.log,
                                         profile_dir=self.profile_dir, cluster_id=self.cluster_id,
                 )
                 if i > 0:
                     # only send files for the first engine on each host
                     el.to_send = []
+                if user:
+                    el.user = user
+                el.hostname = host
 
                 # Copy the engine args over to each engine launcher.
                 el.engine_cmd = self.engine_cmd
                 el.engine_args = args
-                el.on_stop(self._notice_engine_stopped)
-                d = el.start(user=user, hostname=host)
-                self.launchers[ "%s/%i" % (host,i) ] = el
-                dlist.append(d)
+                launchers.append(("%s/%i" % (host,i), el))
+
+        # send files to all the hosts at once, since each takes a few round trips
+        senders = [ el for key, el in launchers if el.to_send ]
+        if senders:
+            pool = ThreadPool(min(len(senders), max(1, self.start_concurrency)))
+            try:
+                pool.map(lambda el: el.send_files(), senders)
+            finally:
+                pool.close()
+            for el in senders:
+                el.to_send = []
+        dlist = self._start_launchers(launchers)
         self.notify_start(dlist)
         return dlist
 
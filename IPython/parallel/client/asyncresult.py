@@ -5,10 +5,17 @@
 
 from __future__ import print_function
 
+import logging
 import sys
 import time
 from datetime import datetime
 
+try:
+    from concurrent.futures import Future
+except ImportError:
+    # Python 2 without the futures backport
+    Future = None
+
 from zmq import MessageTracker
 
 from IPython.core.display import clear_output, display, display_pretty
@@ -24,6 +31,40 @@ def _raw_text(s):
 # global empty tracker that's always done:
 finished_tracker = MessageTracker()
 
+if Future is None:
+    class Future(object):
+        """Minimal stand-in for concurrent.futures.Future, supporting only done callbacks."""
+        def __init__(self):
+            self._done = False
+            self._done_callbacks = []
+            self._result = None
+            self._exception = None
+
+        def done(self):
+            return self._done
+
+        def add_done_callback(self, fn):
+            if self._done:
+                fn(self)
+            else:
+                self._done_callbacks.append(fn)
+
+        def set_result(self, result):
+            self._result = result
+            self._set_done()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._set_done()
+
+        def _set_done(self):
+            self._done = True
+            for fn in self._done_callbacks:
+                try:
+                    fn(self)
+                except Exception:
+                    logging.getLogger(__name__).exception("exception calling callback for %r", self)
+
 @decorator
 def check_ready(f, self, *args, **kwargs):
     """Call spin() to sync state prior to calling the method."""
@@ -36,17 +77,25 @@ class AsyncResult(object):
     """Class for representing results of non-blocking calls.
 
     Provides the same interface as :py:class:`multiprocessing.pool.AsyncResult`.
+
+    AsyncResults take done callbacks, can be awaited in asyncio coroutines,
+    and have a :py:class:`concurrent.futures.Future` as their `future` attribute,
+    for use with :py:func:`concurrent.futures.wait` and the like.
+    They are resolved as the Client receives results, so unless something else
+    is waiting on the Client, it must be spinning in a thread (see :meth:`Client.spin_thread`).
     """
 
     msg_ids = None
     _targets = None
     _tracker = None
     _single_result = False
+    _countdown = None
     owner = False,
 
     def __init__(self, client, msg_ids, fname='unknown', targets=None, tracker=None,
         owner=False,
     ):
+        self._future = Future()
         if isinstance(msg_ids, string_types):
             # always a list
             msg_ids = [msg_ids]
@@ -66,7 +115,14 @@ def __init__(self, client, msg_ids, fname='unknown', targets=None, tracker=None,
         self._ready = False
         self._outputs_ready = False
         self._success = None
+        # keep our results until we have collected them
+        self._client.results.pin(self.msg_ids)
+        self._fetch_evicted()
         self._metadata = [self._client.metadata[id] for id in self.msg_ids]
+        # counted down by the client as results arrive
+        self._countdown = self._client._countdown(self.msg_ids, self._countdown_done)
+        if not self._countdown.remaining:
+            self._countdown_done()
 
     def __repr__(self):
         if self._ready:
@@ -126,34 +182,101 @@ def wait(self, timeout=-1):
         if self._ready:
             self._wait_for_outputs(timeout)
             return
-        self._ready = self._client.wait(self.msg_ids, timeout)
-        if self._ready:
+        if not self.done():
+            self._client._wait_countdown(self._countdown, timeout)
+        if self.done():
+            self._ready = True
+            if timeout is None or timeout < 0:
+                # cutoff infinite wait at 10s
+                timeout = 10
+            self._wait_for_outputs(timeout)
+            
+            if self.owner:
+                
+                # metadata of evicted results is already gone
+                self._metadata = [ self._client.metadata.pop(mid, md)
+                                   for mid, md in zip(self.msg_ids, self._metadata) ]
+                [self._client.results.pop(mid, None) for mid in self.msg_ids]
+
+    def _fetch_evicted(self):
+        """Fetch those of our results evicted from the Client's results from the Hub again.
+
+        This is done when we are created, because _resolve may be called
+        from the spin thread, which must not use the Client's query socket.
+        """
+        evicted = [ m for m in self.msg_ids if m in self._client.results.evicted ]
+        if not evicted:
+            return
+        try:
+            self._client.result_status(evicted, status_only=False)
+        except error.RemoteError:
+            # failed tasks are stored as their exceptions, raised by get()
+            pass
+
+    def _countdown_done(self):
+        """Called by the Client when all of our results have arrived."""
+        self._resolve()
+
+    def _resolve(self):
+        """Collect our results from the Client, and finish our Future with them.
+
+        This calls the done callbacks.
+        """
+        if self.done():
+            return
+        try:
             try:
                 results = list(map(self._client.results.get, self.msg_ids))
-                self._result = results
-                if self._single_result:
-                    r = results[0]
-                    if isinstance(r, Exception):
-                        raise r
-                else:
-                    results = error.collect_exceptions(results, self._fname)
-                self._result = self._reconstruct_result(results)
-            except Exception as e:
-                self._exception = e
-                self._success = False
-            else:
-                self._success = True
             finally:
-                if timeout is None or timeout < 0:
-                    # cutoff infinite wait at 10s
-                    timeout = 10
-                self._wait_for_outputs(timeout)
-                
-                if self.owner:
-                    
-                    self._metadata = [self._client.metadata.pop(mid) for mid in self.msg_ids]
-                    [self._client.results.pop(mid) for mid in self.msg_ids]
-                
+                self._client.results.unpin(self.msg_ids)
+            self._result = results
+            if self._single_result:
+                r = results[0]
+                if isinstance(r, Exception):
+                    raise r
+            else:
+                results = error.collect_exceptions(results, self._fname)
+            self._result = self._reconstruct_result(results)
+        except Exception as e:
+            self._exception = e
+            self._success = False
+            self._future.set_exception(e)
+        else:
+            self._success = True
+            self._future.set_result(self._result)
+
+    #----------------------------------------------------------------
+    # Future interface
+    #----------------------------------------------------------------
+
+    @property
+    def future(self):
+        """A :py:class:`concurrent.futures.Future` resolved with the result of :meth:`get`.
+
+        On Python 2 without the futures backport, this only supports done callbacks.
+        """
+        return self._future
+
+    def done(self):
+        """Return whether all of our results have arrived, without waiting."""
+        return self._future.done()
+
+    def add_done_callback(self, fn):
+        """Call `fn(self)` when all of our results have arrived.
+
+        Callbacks are called from whichever thread spins the Client,
+        which is the spin thread if there is one (see :meth:`Client.spin_thread`).
+        They may be called before the stdout and displayed outputs
+        of the tasks have arrived.
+        If our results are already here, `fn` is called right away.
+        """
+        self._future.add_done_callback(lambda future: fn(self))
+
+    def __await__(self):
+        """Wait for the result in an asyncio event loop."""
+        import asyncio
+        # wrap_future copies the result into the loop's thread
+        return asyncio.wrap_future(self._future).__await__()
 
 
     def successful(self):
@@ -331,7 +454,9 @@ def progress(self):
         Fractional progress would be given by 1.0 * ar.progress / len(ar)
         """
         self.wait(0)
-        return len(self) - len(set(self.msg_ids).intersection(self._client.outstanding))
+        if self._ready:
+            return len(self)
+        return len(self) - self._countdown.remaining
     
     @property
     def elapsed(self):
@@ -571,10 +696,11 @@ class AsyncMapResult(AsyncResult):
     """
 
     def __init__(self, client, msg_ids, mapObject, fname='', ordered=True):
-        AsyncResult.__init__(self, client, msg_ids, fname=fname)
+        # before AsyncResult.__init__, which may already resolve the result
         self._mapObject = mapObject
-        self._single_result = False
         self.ordered = ordered
+        AsyncResult.__init__(self, client, msg_ids, fname=fname)
+        self._single_result = False
 
     def _reconstruct_result(self, res):
         """Perform the gather on the actual results."""
@@ -615,20 +741,16 @@ def _unordered_iter(self):
         try:
             rlist = self.get(0)
         except error.TimeoutError:
-            pending = set(self.msg_ids)
-            while pending:
-                try:
-                    self._client.wait(pending, 1e-3)
-                except error.TimeoutError:
-                    # ignore timeout error, because that only means
-                    # *some* jobs are outstanding
-                    pass
-                # update ready set with those no longer outstanding:
-                ready = pending.difference(self._client.outstanding)
-                # update pending to exclude those that are finished
-                pending = pending.difference(ready)
-                while ready:
-                    msg_id = ready.pop()
+            # msg_ids are appended to countdown.finished as they arrive,
+            # after those already finished
+            countdown = self._countdown
+            done = 0
+            while done < len(countdown.finished) or countdown.remaining:
+                if done == len(countdown.finished):
+                    self._client._wait_countdown(countdown, progress=True)
+                while done < len(countdown.finished):
+                    msg_id = countdown.finished[done]
+                    done += 1
                     ar = AsyncResult(self._client, msg_id, self._fname)
                     rlist = ar.get()
                     try:
@@ -655,6 +777,14 @@ class AsyncHubResult(AsyncResult):
     def _wait_for_outputs(self, timeout=-1):
         """no-op, because HubResults are never incomplete"""
         self._outputs_ready = True
+
+    def _fetch_evicted(self):
+        """Results are collected from the Hub in wait."""
+        pass
+
+    def _countdown_done(self):
+        """Results may still be on the Hub, they are collected in wait."""
+        pass
     
     def wait(self, timeout=-1):
         """wait for result to complete."""
@@ -678,26 +808,14 @@ def wait(self, timeout=-1):
                 if not pending:
                     self._ready = True
         if self._ready:
+            # before _resolve unpins our results, which may evict them and their metadata
+            self._metadata = [self._client.metadata[mid] for mid in self.msg_ids]
             try:
-                results = list(map(self._client.results.get, self.msg_ids))
-                self._result = results
-                if self._single_result:
-                    r = results[0]
-                    if isinstance(r, Exception):
-                        raise r
-                else:
-                    results = error.collect_exceptions(results, self._fname)
-                self._result = self._reconstruct_result(results)
-            except Exception as e:
-                self._exception = e
-                self._success = False
-            else:
-                self._success = True
+                self._resolve()
             finally:
-                self._metadata = [self._client.metadata[mid] for mid in self.msg_ids]
                 if self.owner:
-                    [self._client.metadata.pop(mid) for mid in self.msg_ids]
-                    [self._client.results.pop(mid) for mid in self.msg_ids]
+                    [self._client.metadata.pop(mid, None) for mid in self.msg_ids]
+                    [self._client.results.pop(mid, None) for mid in self.msg_ids]
             
 
 __all__ = ['AsyncResult', 'AsyncMapResult', 'AsyncHubResult']
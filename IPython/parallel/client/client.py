@@ -41,6 +41,7 @@
 from IPython.kernel.zmq import serialize
 
 from .asyncresult import AsyncResult, AsyncHubResult
+from .resultstore import ResultStore
 from .view import DirectView, LoadBalancedView
 
 #--------------------------------------------------------------------------
@@ -152,6 +153,21 @@ def _repr_pretty_(self, p, cycle):
         )
 
 
+class Countdown(object):
+    """Count of the msg_ids in a set that are still outstanding.
+
+    The Client decrements `remaining` as results arrive, and appends
+    the msg_ids to `finished`, so a wait doesn't need to rescan its msg_ids.
+    msg_ids that were not outstanding when the Countdown was created
+    are at the start of `finished`.
+    `callback`, if given, is called when the last result has been stored.
+    """
+    def __init__(self, callback=None):
+        self.remaining = 0
+        self.finished = []
+        self.callback = callback
+
+
 class Metadata(dict):
     """Subclass of dict for initializing metadata values.
 
@@ -167,6 +183,11 @@ def __init__(self, *args, **kwargs):
               'started' : None,
               'completed' : None,
               'received' : None,
+              'pack_time' : None,
+              'queued' : None,
+              'dispatched' : None,
+              'unpacked' : None,
+              'finished' : None,
               'engine_uuid' : None,
               'engine_id' : None,
               'follow' : None,
@@ -286,12 +307,34 @@ class Client(HasTraits):
         results have not yet been received.
 
     results : dict
-        a dict of all our results, keyed by msg_id
+        a dict of all our results, keyed by msg_id.
+        It can be bounded with `results_limit` and `results_bytes_limit`.
+
+    results_limit : int
+        the maximum number of results to keep in `results` [default: 0, no limit].
+        The least recently used results are evicted, along with their metadata,
+        and fetched again from the Hub when they are needed.
+        Results are not evicted while an AsyncResult is waiting for them.
+
+    results_bytes_limit : int
+        the maximum estimated size (in bytes) of the results in `results`
+        [default: 0, no limit].
+
+    results_spill_dir : str
+        a directory to pickle evicted results of at least 1MB to, instead of dropping them
+        [default: '', drop all evicted results].
+        Spilled results are loaded again when they are accessed.
 
     block : bool
         determines default behavior when block not specified
         in execution methods
 
+    zero_copy : bool
+        whether results are received without copying [default: False].
+        If True, large arrays in results are built directly on the memory
+        of the received zmq Frames, which saves a copy of each result,
+        but the arrays are read-only and keep their whole frame in memory.
+
     Methods
     -------
 
@@ -320,10 +363,22 @@ class Client(HasTraits):
 
     block = Bool(False)
     outstanding = Set()
-    results = Instance('collections.defaultdict', (dict,))
+    results = Instance(ResultStore, ())
+    results_limit = Integer(0)
+    def _results_limit_changed(self, name, old, new):
+        self.results.limit = new
+        self.results.evict()
+    results_bytes_limit = Integer(0)
+    def _results_bytes_limit_changed(self, name, old, new):
+        self.results.bytes_limit = new
+        self.results.evict()
+    results_spill_dir = Unicode('')
+    def _results_spill_dir_changed(self, name, old, new):
+        self.results.spill_dir = new
     metadata = Instance('collections.defaultdict', (Metadata,))
     history = List()
     debug = Bool(False)
+    zero_copy = Bool(False)
     _spin_thread = Any()
     _stop_spinning = Any()
 
@@ -342,6 +397,13 @@ def _profile_default(self):
 
 
     _outstanding_dict = Instance('collections.defaultdict', (set,))
+    _countdowns = Instance('collections.defaultdict', (list,)) # dict by msg_id of Countdowns
+    # functions each engine has cached, by engine uuid
+    _functions = Instance('collections.defaultdict', (serialize.FunctionCache,))
+    # requests sent without their function, by msg_id, in case of a cache miss
+    _omitted_functions = Dict()
+    # urls of the engines' broadcast relays, by engine id
+    _relay_urls = Dict()
     _ids = List()
     _connected=Bool(False)
     _ssh=Bool(False)
@@ -377,6 +439,7 @@ def __init__(self, url_file=None, profile=None, profile_dir=None, ipython_dir=No
             context = zmq.Context.instance()
         self._context = context
         self._stop_spinning = Event()
+        self.results.on_evict = self._result_evicted
         
         if 'url_or_file' in extra_args:
             url_file = extra_args['url_or_file']
@@ -683,8 +746,11 @@ def _extract_metadata(self, msg):
 
         if 'date' in parent:
             md['submitted'] = parent['date']
-        if 'started' in msg_meta:
-            md['started'] = parse_date(msg_meta['started'])
+        if 'pack_time' in msg_meta:
+            md['pack_time'] = msg_meta['pack_time']
+        for key in ('started', 'queued', 'dispatched', 'unpacked', 'finished'):
+            if key in msg_meta:
+                md[key] = parse_date(msg_meta[key])
         if 'date' in header:
             md['completed'] = header['date']
         return md
@@ -703,6 +769,8 @@ def _unregister_engine(self, msg):
         if eid in self._ids:
             self._ids.remove(eid)
             uuid = self._engines.pop(eid)
+            self._functions.pop(cast_bytes(uuid), None)
+            self._relay_urls.pop(eid, None)
 
             self._handle_stranded_msgs(eid, uuid)
 
@@ -772,6 +840,7 @@ def _handle_execute_reply(self, msg):
             pass
         else:
             self.results[msg_id] = self._unwrap_exception(content)
+        self._count_down(msg_id)
 
     def _handle_apply_reply(self, msg):
         """Save the reply to an apply_request into our results."""
@@ -780,10 +849,13 @@ def _handle_apply_reply(self, msg):
         if msg_id not in self.outstanding:
             if msg_id in self.history:
                 print("got stale result: %s"%msg_id)
-                print(self.results[msg_id])
+                print(self.results.get(msg_id))
                 print(msg)
             else:
                 print("got unknown result: %s"%msg_id)
+        elif self._handle_function_cache(msg):
+            # request was resent with its function, this isn't the result
+            return
         else:
             self.outstanding.remove(msg_id)
         content = msg['content']
@@ -809,6 +881,103 @@ def _handle_apply_reply(self, msg):
             pass
         else:
             self.results[msg_id] = self._unwrap_exception(content)
+        self._count_down(msg_id)
+
+    def _result_evicted(self, msg_id):
+        """Drop the metadata of a result evicted from our results.
+
+        Both are restored if the result is fetched from the Hub again.
+        """
+        self.metadata.pop(msg_id, None)
+
+    def _count_down(self, msg_id):
+        """Count down msg_id in the Countdowns waiting on it, after its result is stored."""
+        for countdown in self._countdowns.pop(msg_id, ()):
+            countdown.remaining -= 1
+            countdown.finished.append(msg_id)
+            if not countdown.remaining and countdown.callback is not None:
+                countdown.callback()
+
+    def _countdown(self, msg_ids, callback=None):
+        """Return a new Countdown of msg_ids."""
+        countdown = Countdown(callback)
+        for msg_id in set(msg_ids):
+            if msg_id in self.outstanding:
+                self._countdowns[msg_id].append(countdown)
+                countdown.remaining += 1
+            else:
+                countdown.finished.append(msg_id)
+        return countdown
+
+    def _discard_countdown(self, countdown, msg_ids):
+        """Stop counting down msg_ids in countdown."""
+        for msg_id in msg_ids:
+            countdowns = self._countdowns.get(msg_id, [])
+            if countdown in countdowns:
+                countdowns.remove(countdown)
+                if not countdowns:
+                    del self._countdowns[msg_id]
+
+    def _poll_results(self, timeout=-1):
+        """Block until a message arrives on a socket with results, for up to `timeout` seconds.
+
+        The messages are left for spin() to handle.
+        """
+        poller = zmq.Poller()
+        for socket in (self._notification_socket, self._iopub_socket,
+                        self._mux_socket, self._task_socket):
+            if socket:
+                poller.register(socket, zmq.POLLIN)
+        if self._spin_thread is not None:
+            # the spin thread may take the results we are waiting for
+            # without waking us up
+            timeout = 0.01 if timeout < 0 else min(timeout, 0.01)
+        poller.poll(None if timeout < 0 else 1000 * timeout)
+
+    def _wait_countdown(self, countdown, timeout=-1, progress=False):
+        """Wait until all of countdown's msg_ids have finished, for up to `timeout` seconds.
+
+        If `progress`, return as soon as any of them finishes.
+        Returns whether all have finished.
+        """
+        tic = time.time()
+        start = countdown.remaining
+        self.spin()
+        while countdown.remaining and not (progress and countdown.remaining < start):
+            if timeout >= 0:
+                left = timeout - (time.time() - tic)
+                if left <= 0:
+                    break
+                self._poll_results(left)
+            else:
+                self._poll_results()
+            self.spin()
+        return countdown.remaining == 0
+
+    def _handle_function_cache(self, msg):
+        """Track the functions engines have cached, from an apply_reply.
+
+        Returns True if the engine didn't have a function we omitted,
+        in which case the request is sent again with the function.
+        """
+        msg_id = msg['parent_header']['msg_id']
+        md = msg['metadata']
+        omitted = self._omitted_functions.pop(msg_id, None)
+        if 'f_hash' not in md or 'engine' not in md:
+            return False
+        functions = self._functions[cast_bytes(md['engine'])]
+        if md.get('function_cached', False):
+            functions[md['f_hash']] = True
+        elif md.get('function_cache_miss', False):
+            functions.discard(md['f_hash'])
+            if omitted is not None:
+                socket, ident, request, f_buf = omitted
+                # new metadata, or the engine would reject the resent message as a replay
+                request['metadata'] = dict(request['metadata'], function_resent=True)
+                self.session.send(socket, request, ident=ident,
+                    buffers=[f_buf] + request['buffers'][1:])
+                return True
+        return False
 
     def _flush_notifications(self):
         """Flush notifications of engine registrations waiting
@@ -827,7 +996,8 @@ def _flush_notifications(self):
 
     def _flush_results(self, sock):
         """Flush task or queue results waiting in ZMQ queue."""
-        idents,msg = self.session.recv(sock, mode=zmq.NOBLOCK)
+        copy = not self.zero_copy
+        idents,msg = self.session.recv(sock, mode=zmq.NOBLOCK, copy=copy)
         while msg is not None:
             if self.debug:
                 pprint(msg)
@@ -837,7 +1007,7 @@ def _flush_results(self, sock):
                 raise Exception("Unhandled message type: %s" % msg_type)
             else:
                 handler(msg)
-            idents,msg = self.session.recv(sock, mode=zmq.NOBLOCK)
+            idents,msg = self.session.recv(sock, mode=zmq.NOBLOCK, copy=copy)
 
     def _flush_control(self, sock):
         """Flush replies from the control channel waiting
@@ -955,6 +1125,45 @@ def ids(self):
         # always copy:
         return list(self._ids)
 
+    def wait_for_engines(self, n, timeout=-1):
+        """Wait until at least `n` engines are registered.
+
+        This blocks on the Hub's registration notifications,
+        instead of polling `ids`.
+
+        Parameters
+        ----------
+
+        n : int
+            The number of engines to wait for.
+        timeout : float
+            How long to wait, in seconds. The default (-1) is forever.
+
+        Returns
+        -------
+
+        ids : list of ints
+            The ids of the registered engines.
+
+        Raises TimeoutError if there are fewer than `n` engines after `timeout` seconds.
+        """
+        tic = time.time()
+        self._flush_notifications()
+        while len(self._ids) < n:
+            if timeout >= 0:
+                left = timeout - (time.time() - tic)
+                if left <= 0:
+                    raise error.TimeoutError("%i engines are registered after %.1f seconds, not %i"
+                        % (len(self._ids), timeout, n))
+            else:
+                left = -1
+            if self._spin_thread is not None:
+                # the spin thread may take the notifications without waking us up
+                left = 0.01 if left < 0 else min(left, 0.01)
+            self._notification_socket.poll(None if left < 0 else 1000 * left)
+            self._flush_notifications()
+        return self.ids
+
     def activate(self, targets='all', suffix=''):
         """Create a DirectView and register it with IPython magics
         
@@ -1080,7 +1289,6 @@ def wait(self, jobs=None, timeout=-1):
         True : when all msg_ids are done
         False : timeout reached, some msg_ids still outstanding
         """
-        tic = time.time()
         if jobs is None:
             theids = self.outstanding
         else:
@@ -1095,15 +1303,14 @@ def wait(self, jobs=None, timeout=-1):
                     theids.update(job.msg_ids)
                     continue
                 theids.add(job)
-        if not theids.intersection(self.outstanding):
+        countdown = self._countdown(theids)
+        if not countdown.remaining:
             return True
-        self.spin()
-        while theids.intersection(self.outstanding):
-            if timeout >= 0 and ( time.time()-tic ) > timeout:
-                break
-            time.sleep(1e-3)
-            self.spin()
-        return len(theids.intersection(self.outstanding)) == 0
+        theids = list(theids)
+        if self._wait_countdown(countdown, timeout):
+            return True
+        self._discard_countdown(countdown, theids)
+        return False
 
     #--------------------------------------------------------------------------
     # Control methods
@@ -1271,28 +1478,159 @@ def send_apply_request(self, socket, f, args=None, kwargs=None, metadata=None, t
         if not isinstance(metadata, dict):
             raise TypeError("metadata must be dict, not %s"%type(metadata))
 
+        tic = time.time()
         bufs = serialize.pack_apply_message(f, args, kwargs,
             buffer_threshold=self.session.buffer_threshold,
             item_threshold=self.session.item_threshold,
         )
+        metadata = dict(metadata, pack_time=time.time() - tic)
+        f_hash = None
+        if serialize.cacheable(f):
+            f_hash = metadata['f_hash'] = serialize.function_hash(bufs[0])
+
+        engine = ident[-1] if isinstance(ident, list) else ident
+        f_buf = None
+        if engine and f_hash and f_hash in self._functions.get(cast_bytes(engine), ()):
+            # the engine has this function, only send the hash
+            f_buf = bufs[0]
+            bufs = [b''] + bufs[1:]
 
         msg = self.session.send(socket, "apply_request", buffers=bufs, ident=ident,
                             metadata=metadata, track=track)
 
         msg_id = msg['header']['msg_id']
         self.outstanding.add(msg_id)
-        if ident:
+        if f_buf is not None:
+            msg['buffers'] = bufs
+            self._omitted_functions[msg_id] = (socket, ident, msg, f_buf)
+        if engine:
             # possibly routed to a specific engine
-            if isinstance(ident, list):
-                ident = ident[-1]
-            if ident in self._engines.values():
+            if engine in self._engines.values():
                 # save for later, in case of engine death
-                self._outstanding_dict[ident].add(msg_id)
+                self._outstanding_dict[engine].add(msg_id)
         self.history.append(msg_id)
         self.metadata[msg_id]['submitted'] = datetime.now()
 
         return msg
 
+    def send_apply_batch(self, socket, f, arg_list, kwargs=None, metadata=None, track=False):
+        """construct and send a batch of apply requests in a single message.
+
+        Each element of `arg_list` is the args for one call of `f`,
+        and all calls share `kwargs` and `metadata`.
+        The function is serialized only once for the whole batch.
+
+        Batches are unpacked into individual tasks by the Python task scheduler,
+        so this is only valid on the task socket with a non-pure scheme.
+
+        Returns the message, whose content['msg_ids'] are the msg_ids of the tasks.
+        """
+
+        if self._closed:
+            raise RuntimeError("Client cannot be used after its sockets have been closed")
+
+        # defaults:
+        kwargs = kwargs if kwargs is not None else {}
+        metadata = metadata if metadata is not None else {}
+
+        # validate arguments
+        if not callable(f) and not isinstance(f, Reference):
+            raise TypeError("f must be callable, not %s"%type(f))
+        for args in arg_list:
+            if not isinstance(args, (tuple, list)):
+                raise TypeError("args must be tuple or list, not %s"%type(args))
+        if not isinstance(kwargs, dict):
+            raise TypeError("kwargs must be dict, not %s"%type(kwargs))
+        if not isinstance(metadata, dict):
+            raise TypeError("metadata must be dict, not %s"%type(metadata))
+
+        tic = time.time()
+        bufs, nbufs = serialize.pack_apply_batch(f, arg_list, kwargs,
+            buffer_threshold=self.session.buffer_threshold,
+            item_threshold=self.session.item_threshold,
+        )
+        msg_ids = [ self.session.msg_id for args in arg_list ]
+        content = dict(msg_ids=msg_ids, nbufs=nbufs)
+        # each task gets its share of the time spent packing the batch
+        pack_time = (time.time() - tic) / max(len(msg_ids), 1)
+        metadata = dict(metadata, pack_time=pack_time)
+        if serialize.cacheable(f):
+            metadata['f_hash'] = serialize.function_hash(bufs[0])
+
+        msg = self.session.send(socket, "batch_apply_request", content=content,
+                            buffers=bufs, metadata=metadata, track=track)
+
+        now = datetime.now()
+        self.outstanding.update(msg_ids)
+        self.history.extend(msg_ids)
+        for msg_id in msg_ids:
+            self.metadata[msg_id]['submitted'] = now
+
+        return msg
+
+    def send_apply_graph(self, socket, calls, metadata=None, track=False):
+        """construct and send a graph of apply requests in a single message.
+
+        `calls` is a list of ``(msg_id, f, args, kwargs, task_metadata)``, one per task.
+        Every task gets `metadata`, updated with its own `task_metadata`,
+        e.g. the `parents` it depends on, msg_ids of earlier tasks in `calls`.
+        Tasks must come after the tasks they depend on.
+        Each distinct function is serialized only once.
+
+        The graph is sent as a batch_apply_request, so this is only valid
+        on the task socket with a non-pure scheme.
+
+        Returns the message, whose content['msg_ids'] are the msg_ids of the tasks.
+        """
+
+        if self._closed:
+            raise RuntimeError("Client cannot be used after its sockets have been closed")
+
+        metadata = metadata if metadata is not None else {}
+        if not isinstance(metadata, dict):
+            raise TypeError("metadata must be dict, not %s"%type(metadata))
+
+        msg_ids = []
+        task_metadata = []
+        packed = []
+        for msg_id, f, args, kwargs, task_md in calls:
+            if not callable(f) and not isinstance(f, Reference):
+                raise TypeError("f must be callable, not %s"%type(f))
+            if not isinstance(args, (tuple, list)):
+                raise TypeError("args must be tuple or list, not %s"%type(args))
+            if not isinstance(kwargs, dict):
+                raise TypeError("kwargs must be dict, not %s"%type(kwargs))
+            msg_ids.append(msg_id)
+            task_metadata.append(dict(task_md))
+            packed.append((f, args, kwargs))
+
+        tic = time.time()
+        bufs, nbufs, f_indices = serialize.pack_apply_graph(packed,
+            buffer_threshold=self.session.buffer_threshold,
+            item_threshold=self.session.item_threshold,
+        )
+        # each task gets its share of the time spent packing the graph
+        metadata = dict(metadata, pack_time=(time.time() - tic) / max(len(msg_ids), 1))
+        nfuncs = max(f_indices) + 1 if f_indices else 0
+        f_hashes = [ serialize.function_hash(f_buf) for f_buf in bufs[:nfuncs] ]
+        for task_md, f_idx, (f, args, kwargs) in zip(task_metadata, f_indices, packed):
+            if serialize.cacheable(f):
+                task_md['f_hash'] = f_hashes[f_idx]
+        content = dict(msg_ids=msg_ids, nbufs=nbufs, nfuncs=nfuncs,
+            f_indices=f_indices, task_metadata=task_metadata,
+        )
+
+        msg = self.session.send(socket, "batch_apply_request", content=content,
+                            buffers=bufs, metadata=metadata, track=track)
+
+        now = datetime.now()
+        self.outstanding.update(msg_ids)
+        self.history.extend(msg_ids)
+        for msg_id in msg_ids:
+            self.metadata[msg_id]['submitted'] = now
+
+        return msg
+
     def send_execute_request(self, socket, code, silent=True, metadata=None, ident=None):
         """construct and send an execute request via a socket.
 
@@ -1568,7 +1906,8 @@ def result_status(self, msg_ids, status_only=True):
             content = dict(msg_ids=theids, status_only=status_only)
             msg = self.session.send(self._query_socket, "result_request", content=content)
             zmq.select([self._query_socket], [], [])
-            idents,msg = self.session.recv(self._query_socket, zmq.NOBLOCK)
+            idents,msg = self.session.recv(self._query_socket, zmq.NOBLOCK,
+                copy=not self.zero_copy)
             if self.debug:
                 pprint(msg)
             content = msg['content']
@@ -1663,6 +2002,54 @@ def queue_status(self, targets='all', verbose=False):
         else:
             return content
 
+    @spin_first
+    def stats(self, targets='all'):
+        """Fetch rolling statistics of engine queues from the Hub,
+        to find where time is spent on busy engines.
+
+        Histograms are lists of counts in power-of-two bins:
+        times have upper bounds of 1, 2, 4, ... ms,
+        and queue depths of 1, 2, 4, ... requests, except the last bin.
+
+        Parameters
+        ----------
+
+        targets : int/str/list of ints/strs
+                the engines whose stats are to be queried.
+                default : all
+
+        Returns
+        -------
+
+        dict with the `window` (in seconds) covered by the histograms,
+        the `unassigned` histogram of the depth of the task scheduler queue,
+        and for each engine id a dict of:
+
+        queue_depth : histogram of requests on the engine, as each one arrives
+        dispatch_latency : histogram of time tasks waited in the task scheduler
+        runtime : histogram of time from start to completion of requests
+        throughput : completed requests per second
+        heartbeat_latency : histogram of heartbeat latencies
+        """
+        if targets == 'all':
+            engine_ids = None
+        else:
+            engine_ids = self._build_targets(targets)[1]
+        content = dict(targets=engine_ids)
+        self.session.send(self._query_socket, "stats_request", content=content)
+        idents,msg = self.session.recv(self._query_socket, 0)
+        if self.debug:
+            pprint(msg)
+        content = msg['content']
+        status = content.pop('status')
+        if status != 'ok':
+            raise self._unwrap_exception(content)
+        content = rekey(content)
+        if isinstance(targets, int):
+            return content[targets]
+        else:
+            return content
+
     def _build_msgids_from_target(self, targets=None):
         """Build a list of msg_ids from the list of engine targets"""
         if not targets: # needed as _build_targets otherwise uses all engines
@@ -151,19 +151,25 @@ class ParallelFunction(RemoteFunction):
     ordered : bool [default: True]
         Whether the result should be kept in order. If False,
         results become available as they arrive, regardless of submission order.
+    batchsize : int or None
+        The number of load-balanced tasks to submit per message.
+        The default (None) submits each task in its own message.
     **flags
         remaining kwargs are passed to View.temp_flags
     """
 
     chunksize = None
     ordered = None
+    batchsize = None
     mapObject = None
     _mapping = False
 
-    def __init__(self, view, f, dist='b', block=None, chunksize=None, ordered=True, **flags):
+    def __init__(self, view, f, dist='b', block=None, chunksize=None, ordered=True,
+                    batchsize=None, **flags):
         super(ParallelFunction, self).__init__(view, f, block=block, **flags)
         self.chunksize = chunksize
         self.ordered = ordered
+        self.batchsize = batchsize
 
         mapClass = Map.dists[dist]
         self.mapObject = mapClass()
@@ -219,6 +225,18 @@ def __call__(self, *sequences):
                 targets = [targets]
             nparts = len(targets)
 
+        if self._mapping:
+            if sys.version_info[0] >= 3:
+                f = lambda f, *sequences: list(map(f, *sequences))
+            else:
+                f = map
+        else:
+            f = self.func
+
+        batch = balanced and self.batchsize and self.batchsize > 1 and \
+            self.view._task_scheme != 'pure'
+        arg_list = []
+
         msg_ids = []
         for index, t in enumerate(targets):
             args = []
@@ -230,13 +248,14 @@ def __call__(self, *sequences):
                 continue
 
             if self._mapping:
-                if sys.version_info[0] >= 3:
-                    f = lambda f, *sequences: list(map(f, *sequences))
-                else:
-                    f = map
                 args = [self.func] + args
-            else:
-                f=self.func
+
+            if batch:
+                arg_list.append(args)
+                if len(arg_list) >= self.batchsize:
+                    msg_ids.extend(self._submit_batch(f, arg_list))
+                    arg_list = []
+                continue
 
             view = self.view if balanced else client[t]
             with view.temp_flags(block=False, **self.flags):
@@ -244,6 +263,9 @@ def __call__(self, *sequences):
 
             msg_ids.extend(ar.msg_ids)
 
+        if arg_list:
+            msg_ids.extend(self._submit_batch(f, arg_list))
+
         r = AsyncMapResult(self.view.client, msg_ids, self.mapObject,
                             fname=getname(self.func),
                             ordered=self.ordered
@@ -257,6 +279,11 @@ def __call__(self, *sequences):
         else:
             return r
 
+    def _submit_batch(self, f, arg_list):
+        """submit one load-balanced task per args in arg_list, in a single message"""
+        with self.view.temp_flags(block=False, **self.flags):
+            return self.view._really_apply_batch(f, arg_list)
+
     def map(self, *sequences):
         """call a function on each element of one or more sequence(s) remotely.
         This should behave very much like the builtin map, but return an AsyncMapResult
@@ -0,0 +1,186 @@
+"""A bounded store for results in the Client"""
+
+# Copyright (c) IPython Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import os
+import sys
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from IPython.utils.pickleutil import PICKLE_PROTOCOL
+
+
+def result_size(obj):
+    """Estimate the memory used by a result, in bytes.
+
+    Arrays and buffers are counted by their data,
+    and the items of lists, tuples and dicts are counted one level deep.
+    """
+    if hasattr(obj, 'nbytes'):
+        # numpy array, memoryview
+        return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(getattr(item, 'nbytes', sys.getsizeof(item)) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(getattr(item, 'nbytes', sys.getsizeof(item)) for item in obj.values())
+    return size
+
+
+class ResultStore(dict):
+    """dict of results by msg_id, with optional LRU eviction.
+
+    When there are more than `limit` results, or their estimated size is more than
+    `bytes_limit` bytes, the least recently used results are evicted.
+    If `spill_dir` is set, evicted results of at least `spill_threshold` bytes
+    are pickled to files there, and loaded again when they are accessed.
+    Other evicted results are dropped, and have to be fetched again from the Hub.
+    Their msg_ids are in `evicted`, and `on_evict` is called with each of them.
+    Results that are `pin`ned, e.g. those an unresolved AsyncResult is waiting for,
+    are not evicted until they are unpinned.
+
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, on_evict=None):
+        dict.__init__(self)
+        self.limit = 0
+        self.bytes_limit = 0
+        self.spill_dir = ''
+        self.spill_threshold = 1 << 20
+        self.on_evict = on_evict
+        self.nbytes = 0
+        self.evicted = set()
+        self._sizes = OrderedDict() # sizes by msg_id, least recently used first
+        self._spilled = set()
+        self._pins = {} # pin counts by msg_id
+
+    def __setitem__(self, msg_id, result):
+        if msg_id in self:
+            self.pop(msg_id)
+        dict.__setitem__(self, msg_id, result)
+        size = result_size(result)
+        self._sizes[msg_id] = size
+        self.nbytes += size
+        self.evicted.discard(msg_id)
+        self.evict()
+
+    def __getitem__(self, msg_id):
+        if msg_id in self._spilled:
+            self._load(msg_id)
+        result = dict.__getitem__(self, msg_id)
+        # move to the end of the LRU order
+        self._sizes[msg_id] = self._sizes.pop(msg_id)
+        return result
+
+    def get(self, msg_id, default=None):
+        if msg_id in self:
+            return self[msg_id]
+        return default
+
+    def __contains__(self, msg_id):
+        return dict.__contains__(self, msg_id) or msg_id in self._spilled
+
+    def __delitem__(self, msg_id):
+        if msg_id in self._spilled:
+            self._spilled.remove(msg_id)
+            os.remove(self._spill_path(msg_id))
+        else:
+            dict.__delitem__(self, msg_id)
+            self.nbytes -= self._sizes.pop(msg_id)
+
+    def pop(self, msg_id, *default):
+        if msg_id not in self:
+            self.evicted.discard(msg_id)
+            if default:
+                return default[0]
+            raise KeyError(msg_id)
+        result = self[msg_id]
+        del self[msg_id]
+        return result
+
+    def clear(self):
+        for msg_id in list(self._spilled):
+            del self[msg_id]
+        dict.clear(self)
+        self._sizes.clear()
+        self.nbytes = 0
+        self.evicted.clear()
+
+    def update(self, *args, **kwargs):
+        for msg_id, result in dict(*args, **kwargs).items():
+            self[msg_id] = result
+
+    def pin(self, msg_ids):
+        """Keep the results of msg_ids from being evicted, until they are unpinned.
+
+        Pins are counted, so each pin needs its own unpin.
+        """
+        for msg_id in msg_ids:
+            self._pins[msg_id] = self._pins.get(msg_id, 0) + 1
+
+    def unpin(self, msg_ids):
+        """Allow the results of msg_ids to be evicted again."""
+        for msg_id in msg_ids:
+            count = self._pins.pop(msg_id, 0) - 1
+            if count > 0:
+                self._pins[msg_id] = count
+        self.evict()
+
+    def _over_limits(self):
+        return ((self.limit and len(self._sizes) > self.limit) or
+            (self.bytes_limit and self.nbytes > self.bytes_limit))
+
+    def evict(self):
+        """Evict the least recently used results until we are within our limits.
+
+        The most recent result and pinned results are never evicted.
+        """
+        if not self._over_limits():
+            return
+        for msg_id in list(self._sizes)[:-1]:
+            if not self._over_limits():
+                break
+            if msg_id in self._pins:
+                continue
+            size = self._sizes.pop(msg_id)
+            self.nbytes -= size
+            result = dict.pop(self, msg_id)
+            if self.spill_dir and size >= self.spill_threshold and self._spill(msg_id, result):
+                continue
+            self.evicted.add(msg_id)
+            if self.on_evict is not None:
+                self.on_evict(msg_id)
+
+    def _spill_path(self, msg_id):
+        return os.path.join(self.spill_dir, '%s.pickle' % msg_id)
+
+    def _spill(self, msg_id, result):
+        """Pickle a result to the spill directory. Returns whether it succeeded."""
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        path = self._spill_path(msg_id)
+        try:
+            with open(path, 'wb') as f:
+                pickle.dump(result, f, PICKLE_PROTOCOL)
+        except Exception:
+            # e.g. unpicklable
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        self._spilled.add(msg_id)
+        return True
+
+    def _load(self, msg_id):
+        """Load a spilled result back into memory."""
+        path = self._spill_path(msg_id)
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        os.remove(path)
+        self._spilled.remove(msg_id)
+        self[msg_id] = result
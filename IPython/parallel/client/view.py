@@ -7,8 +7,11 @@
 
 import imp
 import sys
+import uuid
 import warnings
+from collections import deque
 from contextlib import contextmanager
+from itertools import count, cycle, islice
 from types import ModuleType
 
 import zmq
@@ -24,6 +27,8 @@
 from IPython.parallel.controller.dependency import Dependency, dependent
 from IPython.utils.py3compat import string_types, iteritems, PY3
 
+from IPython.parallel.engine import relay
+
 from . import map as Map
 from .asyncresult import AsyncResult, AsyncMapResult
 from .remotefunction import ParallelFunction, parallel, remote, getname
@@ -39,8 +44,7 @@ def save_ids(f, self, *args, **kwargs):
     try:
         ret = f(self, *args, **kwargs)
     finally:
-        nmsgs = len(self.client.history) - n_previous
-        msg_ids = self.client.history[-nmsgs:]
+        msg_ids = self.client.history[n_previous:]
         self.history.extend(msg_ids)
         self.outstanding.update(msg_ids)
     return ret
@@ -357,11 +361,94 @@ def map_sync(self, f, *sequences, **kwargs):
     def imap(self, f, *sequences, **kwargs):
         """Parallel version of :func:`itertools.imap`.
 
-        See `self.map` for details.
+        Unlike `map`, the sequences are consumed lazily:
+        elements are submitted `chunksize` at a time, each chunk as a single task,
+        and new chunks are only submitted as results arrive,
+        with at most `max_pending` chunks waiting for results at once.
+        So the sequences can be generators, or even infinite,
+        and neither the client nor the Hub hold more than a window of tasks.
+
+        Parameters
+        ----------
+
+        f : callable
+            function to be mapped
+        *sequences: one or more iterables
+            the arguments of `f`. Iteration stops when the shortest is exhausted.
+        chunksize : int [default 1]
+            how many elements to submit in each task.
+        max_pending : int [default: twice the number of engines]
+            how many tasks can be waiting for results at once.
+        ordered : bool [default True]
+            whether to yield results in the order of the sequences,
+            or a task's results as soon as it finishes.
+
+        Returns
+        -------
 
+        An iterator of the results of `f`.
+        """
+        chunksize = kwargs.pop('chunksize', 1)
+        max_pending = kwargs.pop('max_pending', None)
+        ordered = kwargs.pop('ordered', True)
+        if kwargs:
+            raise TypeError("Invalid kwargs: %s" % list(kwargs))
+        assert len(sequences) > 0, "must have some sequences to map onto!"
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1, not %r" % chunksize)
+        if max_pending is None:
+            max_pending = 2 * len(self.client._build_targets(self.targets)[1])
+        elif max_pending < 1:
+            raise ValueError("max_pending must be at least 1, not %r" % max_pending)
+        return self._imap(f, [ iter(seq) for seq in sequences ], chunksize, max_pending, ordered)
+
+    def _imap(self, f, iterators, chunksize, max_pending, ordered):
+        """The generator behind `imap`"""
+        pending = deque()
+        chunks = count()
+
+        def fill():
+            while len(pending) < max_pending:
+                columns = [ list(islice(it, chunksize)) for it in iterators ]
+                n = min(len(column) for column in columns)
+                if n == 0:
+                    return
+                columns = [ column[:n] for column in columns ]
+                pending.append(self._map_chunk(f, columns, next(chunks)))
+
+        fill()
+        while pending:
+            if ordered:
+                ar = pending.popleft()
+            else:
+                ar = self._wait_any(pending)
+                pending.remove(ar)
+            results = ar.get()
+            # keep the engines busy while the caller handles these results
+            fill()
+            for result in results:
+                yield result
+
+    def _map_chunk(self, f, columns, index):
+        """Submit one chunk of `imap` as a single task.
+
+        `index` counts the chunks of the imap.
+        Returns an AsyncMapResult.
         """
+        raise NotImplementedError
 
-        return iter(self.map_async(f,*sequences, **kwargs))
+    def _wait_any(self, ars):
+        """Wait until any of a collection of AsyncResults is done, and return it."""
+        msg_ids = [ msg_id for ar in ars for msg_id in ar.msg_ids ]
+        countdown = self.client._countdown(msg_ids)
+        try:
+            while True:
+                for ar in ars:
+                    if ar.done():
+                        return ar
+                self.client._wait_countdown(countdown, progress=True)
+        finally:
+            self.client._discard_countdown(countdown, msg_ids)
 
     #-------------------------------------------------------------------
     # Decorators
@@ -620,6 +707,12 @@ def map(self, f, *sequences, **kwargs):
         pf = ParallelFunction(self, f, block=block, **kwargs)
         return pf.map(*sequences)
 
+    def _map_chunk(self, f, columns, index):
+        """Submit each chunk of `imap` to the next of our targets, round-robin."""
+        targets = self.client._build_targets(self.targets)[1]
+        with self.temp_flags(targets=targets[index % len(targets)]):
+            return self.map(f, *columns, block=False)
+
     @sync_results
     @save_ids
     def execute(self, code, silent=True, targets=None, block=None):
@@ -707,6 +800,80 @@ def push(self, ns, targets=None, block=None, track=None):
             raise TypeError("Must be a dict, not %s"%type(ns))
         return self._really_apply(util._push, kwargs=ns, block=block, track=track, targets=targets)
 
+    @sync_results
+    @save_ids
+    def broadcast(self, ns, targets=None, block=None, track=None, fanout=2, timeout=60):
+        """update remote namespaces with dict `ns`, relaying it through a tree of engines
+
+        Like `push`, but `ns` is only sent to the first target.
+        Each engine then forwards it to up to `fanout` other engines,
+        so the data leaves the client once, instead of once per engine.
+        This is worthwhile for large data and many engines.
+
+        Engines connect directly to each other for this,
+        with zmq sockets on random ports of `EngineFactory.relay_ip`.
+
+        Parameters
+        ----------
+
+        ns : dict
+            dict of keys with which to update engine namespace(s)
+        block : bool [default : self.block]
+            whether to wait to be notified of engine receipt
+        track : bool [default: self.track]
+            whether to track the message to the first target, for safe non-copying sends
+        fanout : int [default: 2]
+            the number of engines each engine forwards to
+        timeout : float [default: 60]
+            how long engines wait for their data from their parent,
+            before failing with a TimeoutError.
+
+        Returns
+        -------
+
+        AsyncResult, with one msg_id per engine, like `push`.
+        """
+        block = block if block is not None else self.block
+        track = track if track is not None else self.track
+        targets = targets if targets is not None else self.targets
+        if not isinstance(ns, dict):
+            raise TypeError("Must be a dict, not %s"%type(ns))
+        if isinstance(targets, int):
+            return self.push(ns, targets=targets, block=block, track=track)
+
+        _idents, _targets = self.client._build_targets(targets)
+        # ask the engines we haven't seen yet where their relays are
+        relay_urls = self.client._relay_urls
+        missing = [ eid for eid in _targets[1:] if eid not in relay_urls ]
+        if missing:
+            urls = self.client[missing].apply_sync(relay.relay_url)
+            relay_urls.update(zip(missing, urls))
+
+        tree = relay.kary_tree(list(range(len(_targets))), fanout)
+        def urls(subtrees):
+            return [ [relay_urls[_targets[i]], urls(children)] for i, children in subtrees ]
+
+        tag = str(uuid.uuid4())
+        msg = self.client.send_apply_request(self._socket, relay.broadcast_root,
+            (tag, urls(tree[1]), ns), track=track, ident=_idents[0],
+        )
+        msg_ids = [msg['header']['msg_id']]
+        for ident in _idents[1:]:
+            m = self.client.send_apply_request(self._socket, relay.broadcast_recv,
+                (tag, timeout), ident=ident,
+            )
+            msg_ids.append(m['header']['msg_id'])
+        tracker = msg['tracker'] if track else None
+        ar = AsyncResult(self.client, msg_ids, fname='broadcast', targets=_targets,
+            tracker=tracker, owner=True,
+        )
+        if block:
+            try:
+                ar.get()
+            except KeyboardInterrupt:
+                pass
+        return ar
+
     def get(self, key_s):
         """get object(s) by `key_s` from remote namespace
 
@@ -773,6 +940,98 @@ def scatter(self, key, seq, dist='b', flatten=False, targets=None, block=None, t
         else:
             return r
 
+    def scatter_stream(self, key, seq, chunksize=65536, max_pending=4, targets=None, track=None):
+        """Scatter a sequence in chunks, without holding all of it in memory.
+
+        Sequences with a length, such as lists or memory-mapped numpy arrays,
+        are partitioned like ``scatter(dist='b')``, and each partition is sent
+        in chunks of at most `chunksize` items. Other iterables are read
+        `chunksize` items at a time, and the chunks are dealt to the engines
+        in turn. The engines join their chunks into `key` once they have all arrived.
+
+        At most `max_pending` chunks are in flight at once: this waits for
+        the engines to receive older chunks before reading and sending more.
+        This always blocks.
+        """
+        track = track if track is not None else self.track
+        targets = self.client._build_targets(targets)[1]
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1, not %r" % chunksize)
+
+        pending = deque()
+        def send(engineid, chunk):
+            while len(pending) >= max_pending:
+                pending.popleft().get()
+            pending.append(self._really_apply(util._append_chunk, (key, chunk),
+                targets=engineid, block=False, track=track,
+            ))
+
+        if hasattr(seq, '__len__') and hasattr(seq, '__getitem__'):
+            mapObject = Map.dists['b']()
+            nparts = len(targets)
+            for index, engineid in enumerate(targets):
+                partition = mapObject.getPartition(seq, index, nparts)
+                for start in range(0, len(partition), chunksize):
+                    send(engineid, partition[start:start+chunksize])
+        else:
+            it = iter(seq)
+            for engineid in cycle(targets):
+                chunk = list(islice(it, chunksize))
+                if not chunk:
+                    break
+                send(engineid, chunk)
+
+        for ar in pending:
+            ar.get()
+        self._really_apply(util._join_chunks, (key,), targets=targets, block=True)
+
+    def gather_stream(self, key, out=None, chunksize=65536, max_pending=4, targets=None):
+        """Gather a partitioned sequence in chunks, into `out`.
+
+        The partitions of `key` on the engines are pulled `chunksize` items
+        at a time, with at most `max_pending` chunks in flight, and written
+        one after the other into `out`, which can be a preallocated or
+        memory-mapped numpy array at least as long as all of them together.
+        If `out` is not given, the items are collected in a list.
+
+        This is the reverse of ``scatter(dist='b')`` and `scatter_stream`
+        of a sequence with a length. This always blocks.
+
+        Returns `out`.
+        """
+        targets = self.client._build_targets(targets)[1]
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1, not %r" % chunksize)
+        lengths = self._really_apply(util._pull, ('len(%s)' % key,),
+            targets=targets, block=True,
+        )
+        if out is None:
+            out = []
+        elif len(out) < sum(lengths):
+            raise ValueError("out has length %i, but the partitions of %r have %i items"
+                % (len(out), key, sum(lengths)))
+
+        pending = deque()
+        def receive(n):
+            while len(pending) > n:
+                start, ar = pending.popleft()
+                chunk = ar.get()
+                if isinstance(out, list):
+                    out.extend(chunk)
+                else:
+                    out[start:start+len(chunk)] = chunk
+
+        offset = 0
+        for engineid, length in zip(targets, lengths):
+            for start in range(0, length, chunksize):
+                receive(max_pending - 1)
+                expr = '%s[%i:%i]' % (key, start, start+chunksize)
+                ar = self._really_apply(util._pull, (expr,), targets=engineid, block=False)
+                pending.append((offset + start, ar))
+            offset += length
+        receive(0)
+        return out
+
     @sync_results
     @save_ids
     def gather(self, key, dist='b', targets=None, block=None):
@@ -865,9 +1124,12 @@ class LoadBalancedView(View):
     after=Any()
     timeout=CFloat()
     retries = Integer(0)
+    memoize = Bool(False)
+    data = Any()
 
     _task_scheme = Any()
-    _flag_names = List(['targets', 'block', 'track', 'follow', 'after', 'timeout', 'retries'])
+    _flag_names = List(['targets', 'block', 'track', 'follow', 'after', 'timeout', 'retries',
+                        'memoize', 'data'])
 
     def __init__(self, client=None, socket=None, **flags):
         super(LoadBalancedView, self).__init__(client=client, socket=socket, **flags)
@@ -946,6 +1208,20 @@ def set_flags(self, **kwargs):
 
         retries : int
             Number of times a task will be retried on failure.
+
+        memoize : bool
+            Only for load-balanced execution (targets=None)
+            Whether the scheduler may answer a task with the stored result
+            of an earlier task with the same function and arguments,
+            instead of running it again.  Only use this with functions
+            whose result depends only on their arguments.
+            The results of successful tasks submitted with memoize=True are stored.
+
+        data : str or list of str
+            Only for load-balanced execution (targets=None)
+            The names of the objects in the engines' namespace a task uses.
+            Tasks are sent to the engines that have the most of them, if any do.
+            Unlike `follow`, this is only a preference: tasks still run elsewhere.
         """
 
         super(LoadBalancedView, self).set_flags(**kwargs)
@@ -966,11 +1242,63 @@ def set_flags(self, **kwargs):
                     raise ValueError("Invalid timeout: %s"%t)
             self.timeout = t
 
+    def _task_metadata(self, f, after=None, follow=None, timeout=None,
+                                targets=None, retries=None, memoize=None, data=None):
+        """Validate scheduler flags, and build the metadata dict for task requests.
+
+        Flags that are None are taken from the View.
+        """
+        # validate whether we can run
+        if self._socket.closed:
+            msg = "Task farming is disabled"
+            if self._task_scheme == 'pure':
+                msg += " because the pure ZMQ scheduler cannot handle"
+                msg += " disappearing engines."
+            raise RuntimeError(msg)
+
+        if self._task_scheme == 'pure':
+            # pure zmq scheme doesn't support extra features
+            msg = "Pure ZMQ scheduler doesn't support the following flags:"
+            "follow, after, retries, targets, timeout, memoize, data"
+            if (follow or after or retries or targets or timeout or memoize or data):
+                # hard fail on Scheduler flags
+                raise RuntimeError(msg)
+            if isinstance(f, dependent):
+                # soft warn on functional dependencies
+                warnings.warn(msg, RuntimeWarning)
+
+        after = self.after if after is None else after
+        retries = self.retries if retries is None else retries
+        follow = self.follow if follow is None else follow
+        timeout = self.timeout if timeout is None else timeout
+        targets = self.targets if targets is None else targets
+        memoize = self.memoize if memoize is None else memoize
+        data = self.data if data is None else data
+
+        if not isinstance(retries, int):
+            raise TypeError('retries must be int, not %r'%type(retries))
+
+        if targets is None:
+            idents = []
+        else:
+            idents = self.client._build_targets(targets)[0]
+            # ensure *not* bytes
+            idents = [ ident.decode() for ident in idents ]
+
+        after = self._render_dependency(after)
+        follow = self._render_dependency(follow)
+        md = dict(after=after, follow=follow, timeout=timeout, targets=idents, retries=retries)
+        if memoize:
+            md['memoize'] = True
+        if data:
+            md['data'] = [data] if isinstance(data, string_types) else list(data)
+        return md
+
     @sync_results
     @save_ids
     def _really_apply(self, f, args=None, kwargs=None, block=None, track=None,
                                         after=None, follow=None, timeout=None,
-                                        targets=None, retries=None):
+                                        targets=None, retries=None, memoize=None, data=None):
         """calls f(*args, **kwargs) on a remote engine, returning the result.
 
         This method temporarily sets all of `apply`'s flags for a single call.
@@ -1002,49 +1330,14 @@ def _really_apply(self, f, args=None, kwargs=None, block=None, track=None,
             the single result if self.targets is an integer engine id
         """
 
-        # validate whether we can run
-        if self._socket.closed:
-            msg = "Task farming is disabled"
-            if self._task_scheme == 'pure':
-                msg += " because the pure ZMQ scheduler cannot handle"
-                msg += " disappearing engines."
-            raise RuntimeError(msg)
-
-        if self._task_scheme == 'pure':
-            # pure zmq scheme doesn't support extra features
-            msg = "Pure ZMQ scheduler doesn't support the following flags:"
-            "follow, after, retries, targets, timeout"
-            if (follow or after or retries or targets or timeout):
-                # hard fail on Scheduler flags
-                raise RuntimeError(msg)
-            if isinstance(f, dependent):
-                # soft warn on functional dependencies
-                warnings.warn(msg, RuntimeWarning)
-
         # build args
         args = [] if args is None else args
         kwargs = {} if kwargs is None else kwargs
         block = self.block if block is None else block
         track = self.track if track is None else track
-        after = self.after if after is None else after
-        retries = self.retries if retries is None else retries
-        follow = self.follow if follow is None else follow
-        timeout = self.timeout if timeout is None else timeout
-        targets = self.targets if targets is None else targets
-
-        if not isinstance(retries, int):
-            raise TypeError('retries must be int, not %r'%type(retries))
-
-        if targets is None:
-            idents = []
-        else:
-            idents = self.client._build_targets(targets)[0]
-            # ensure *not* bytes
-            idents = [ ident.decode() for ident in idents ]
-
-        after = self._render_dependency(after)
-        follow = self._render_dependency(follow)
-        metadata = dict(after=after, follow=follow, timeout=timeout, targets=idents, retries=retries)
+        metadata = self._task_metadata(f, after=after, follow=follow, timeout=timeout,
+                                targets=targets, retries=retries, memoize=memoize,
+                                data=data)
 
         msg = self.client.send_apply_request(self._socket, f, args, kwargs, track=track,
                                 metadata=metadata)
@@ -1060,6 +1353,107 @@ def _really_apply(self, f, args=None, kwargs=None, block=None, track=None,
                 pass
         return ar
 
+    @sync_results
+    @save_ids
+    def _really_apply_batch(self, f, arg_list, kwargs=None, track=None, **flags):
+        """submit f(*args, **kwargs) for each args in arg_list as one batch message.
+
+        Scheduler flags are shared by every task in the batch.
+
+        Returns the list of msg_ids of the tasks.
+        """
+        track = self.track if track is None else track
+        metadata = self._task_metadata(f, **flags)
+        msg = self.client.send_apply_batch(self._socket, f, arg_list, kwargs,
+                                metadata=metadata, track=track)
+        return msg['content']['msg_ids']
+
+    @sync_results
+    @save_ids
+    def submit_graph(self, dag, track=None, **flags):
+        """Submit a graph of dependent tasks in a single message.
+
+        Submitting tasks one at a time with `after` dependencies costs a message,
+        and a database insert on the Hub, for each task.
+        With `submit_graph`, the whole graph is serialized and sent at once,
+        each distinct function only once, and the scheduler and Hub
+        queue and record all of its tasks from that one message.
+
+        Parameters
+        ----------
+
+        dag : dict
+            The tasks of the graph, by node.  Each task is a tuple
+            ``(f, args, kwargs, parents)``, where trailing items may be left out.
+            `parents` is a collection of the nodes whose tasks must succeed
+            before this task runs.  The graph must not have cycles.
+        track : bool [default: self.track]
+            whether to ask zmq to track the message, for safe non-copying sends
+        **flags : follow, after, timeout, targets, retries, memoize, data
+            scheduler flags for every task, taken from the View if not given.
+            An `after` dependency applies with its own flags, in addition to
+            the parents of each task, which must all succeed.
+
+        Returns
+        -------
+
+        A dict of AsyncResults, by node.
+        """
+        if self._task_scheme == 'pure':
+            raise RuntimeError("Pure ZMQ scheduler doesn't support task graphs")
+        track = self.track if track is None else track
+
+        tasks = {}
+        for node, task in iteritems(dag):
+            task = tuple(task)
+            if not 1 <= len(task) <= 4:
+                raise ValueError("Task %r should be (f, args, kwargs, parents), not %r"
+                                 % (node, task))
+            f, args, kwargs, parents = task + ((), {}, ())[len(task)-1:]
+            tasks[node] = (f, args, kwargs, list(parents))
+        if not tasks:
+            return {}
+
+        # sort the tasks so that each comes after its parents
+        children = dict((node, []) for node in tasks)
+        waiting = {}
+        for node, (f, args, kwargs, parents) in iteritems(tasks):
+            for parent in parents:
+                if parent not in tasks:
+                    raise KeyError("Task %r depends on %r, which is not in the graph"
+                                   % (node, parent))
+                children[parent].append(node)
+            waiting[node] = len(parents)
+        order = [ node for node, n in iteritems(waiting) if n == 0 ]
+        for node in order:
+            for child in children[node]:
+                waiting[child] -= 1
+                if not waiting[child]:
+                    order.append(child)
+        if len(order) < len(tasks):
+            raise ValueError("The graph has a cycle")
+
+        metadata = self._task_metadata(None, **flags)
+        msg_ids = dict((node, self.client.session.msg_id) for node in order)
+        calls = []
+        for node in order:
+            f, args, kwargs, parents = tasks[node]
+            task_md = {}
+            if parents:
+                # required in full, separately from the flags of `after`
+                task_md['parents'] = [ msg_ids[parent] for parent in set(parents) ]
+            calls.append((msg_ids[node], f, args, kwargs, task_md))
+
+        msg = self.client.send_apply_graph(self._socket, calls, metadata=metadata, track=track)
+        tracker = None if track is False else msg['tracker']
+
+        results = {}
+        for node in order:
+            results[node] = AsyncResult(self.client, msg_ids[node], fname=getname(tasks[node][0]),
+                targets=None, tracker=tracker, owner=True,
+            )
+        return results
+
     @sync_results
     @save_ids
     def map(self, f, *sequences, **kwargs):
@@ -1094,6 +1488,11 @@ def map(self, f, *sequences, **kwargs):
             
             Only applies when iterating through AsyncMapResult as results arrive.
             Has no effect when block=True.
+        batchsize : int [default 256]
+            how many tasks to submit per message.
+            The function is only serialized once per message,
+            and the Hub records each message with a single database insert.
+            Ignored with the pure ZMQ scheduler.
 
         Returns
         -------
@@ -1111,15 +1510,21 @@ def map(self, f, *sequences, **kwargs):
         block = kwargs.get('block', self.block)
         chunksize = kwargs.get('chunksize', 1)
         ordered = kwargs.get('ordered', True)
+        batchsize = kwargs.get('batchsize', 256)
 
         keyset = set(kwargs.keys())
-        extra_keys = keyset.difference_update(set(['block', 'chunksize']))
+        extra_keys = keyset.difference_update(set(['block', 'chunksize', 'batchsize']))
         if extra_keys:
             raise TypeError("Invalid kwargs: %s"%list(extra_keys))
 
         assert len(sequences) > 0, "must have some sequences to map onto!"
 
-        pf = ParallelFunction(self, f, block=block, chunksize=chunksize, ordered=ordered)
+        pf = ParallelFunction(self, f, block=block, chunksize=chunksize, ordered=ordered,
+                                batchsize=batchsize)
         return pf.map(*sequences)
 
+    def _map_chunk(self, f, columns, index):
+        """Submit each chunk of `imap` as a single load-balanced task."""
+        return self.map(f, *columns, block=False, chunksize=len(columns[0]))
+
 __all__ = ['LoadBalancedView', 'DirectView']
@@ -35,6 +35,9 @@
 DictDB supports a subset of mongodb operators::
 
     $lt,$gt,$lte,$gte,$ne,$in,$nin,$all,$mod,$exists
+
+Queries are planned against indexes on msg_id, engine_uuid, client_uuid and completed
+(for equality and $in) and submitted (for ranges), so only candidate records are checked.
 """
 #-----------------------------------------------------------------------------
 #  Copyright (C) 2010-2011  The IPython Development Team
@@ -43,8 +46,10 @@
 #  the file COPYING, distributed as part of this software.
 #-----------------------------------------------------------------------------
 
+from bisect import bisect_left, insort
 from copy import deepcopy as copy
 from datetime import datetime
+from itertools import count
 
 from IPython.config.configurable import LoggingConfigurable
 
@@ -53,7 +58,7 @@
 
 filters = {
  '$lt' : lambda a,b: a < b,
- '$gt' : lambda a,b: b > a,
+ '$gt' : lambda a,b: a > b,
  '$eq' : lambda a,b: a == b,
  '$ne' : lambda a,b: a != b,
  '$lte': lambda a,b: a <= b,
@@ -82,11 +87,116 @@ def __call__(self, value):
                 return False
         return True
 
+# sorts after any (value, seq, msg_id) entry of a SortedIndex with the same value
+_AFTER = float('inf')
+
+class HashIndex(object):
+    """Index of msg_ids by the value of one record key, for equality and $in queries."""
+
+    def __init__(self, key):
+        self.key = key
+        self.msg_ids = {}
+
+    def add(self, msg_id, rec):
+        self.msg_ids.setdefault(rec.get(self.key, None), set()).add(msg_id)
+
+    def remove(self, msg_id, rec):
+        value = rec.get(self.key, None)
+        msg_ids = self.msg_ids[value]
+        msg_ids.discard(msg_id)
+        if not msg_ids:
+            del self.msg_ids[value]
+
+    def find(self, test):
+        """Return the set of msg_ids that may match test, or None if the index can't tell."""
+        if isinstance(test, dict):
+            if '$in' in test:
+                values = test['$in']
+            elif '$eq' in test:
+                values = [test['$eq']]
+            else:
+                return None
+        else:
+            values = [test]
+        found = set()
+        try:
+            for value in values:
+                found.update(self.msg_ids.get(value, ()))
+        except TypeError:
+            # unhashable
+            return None
+        return found
+
+class SortedIndex(object):
+    """Index of msg_ids sorted by the value of one record key, for range queries.
+
+    Records where the key is None are not indexed.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.entries = [] # sorted list of (value, seq, msg_id)
+        self._entries = {} # entry by msg_id
+        self._seq = count()
+
+    def __iter__(self):
+        """iterate through msg_ids, ordered by value (ties in the order they were added)"""
+        for entry in self.entries:
+            yield entry[2]
+
+    def add(self, msg_id, rec):
+        value = rec.get(self.key, None)
+        if value is None:
+            return
+        entry = (value, next(self._seq), msg_id)
+        self._entries[msg_id] = entry
+        if not self.entries or entry > self.entries[-1]:
+            # the usual case
+            self.entries.append(entry)
+        else:
+            insort(self.entries, entry)
+
+    def remove(self, msg_id, rec):
+        entry = self._entries.pop(msg_id, None)
+        if entry is not None:
+            del self.entries[bisect_left(self.entries, entry)]
+
+    def find(self, test):
+        """Return the set of msg_ids that may match test, or None if the index can't tell."""
+        if not isinstance(test, dict):
+            test = {'$eq' : test}
+        entries = self.entries
+        lo, hi = 0, len(entries)
+        planned = False
+        for op, value in iteritems(test):
+            if value is None:
+                continue
+            if op in ('$eq', '$gte'):
+                lo = max(lo, bisect_left(entries, (value,)))
+            if op in ('$eq', '$lte'):
+                hi = min(hi, bisect_left(entries, (value, _AFTER)))
+            if op == '$gt':
+                lo = max(lo, bisect_left(entries, (value, _AFTER)))
+            if op == '$lt':
+                hi = min(hi, bisect_left(entries, (value,)))
+            planned = planned or op in ('$eq', '$gte', '$lte', '$gt', '$lt')
+        if not planned:
+            return None
+        return set(entry[2] for entry in entries[lo:hi])
+
 class BaseDB(LoggingConfigurable):
     """Empty Parent class so traitlets work on DB."""
     # base configurable traits:
     session = Unicode("")
 
+    def add_records(self, records):
+        """Add several new Task Records.
+
+        Backends that support bulk inserts should override this.
+        """
+        for rec in records:
+            self.add_record(rec['msg_id'], rec)
+
 class DictDB(BaseDB):
     """Basic in-memory dict-based object for saving Task Records.
 
@@ -127,6 +237,62 @@ class DictDB(BaseDB):
         """
     )
 
+    def __init__(self, **kwargs):
+        super(DictDB, self).__init__(**kwargs)
+        self._indexes = {
+            'engine_uuid' : HashIndex('engine_uuid'),
+            'client_uuid' : HashIndex('client_uuid'),
+            'completed' : HashIndex('completed'),
+            'submitted' : SortedIndex('submitted'),
+        }
+
+    def _index(self, msg_id, rec, keys=None):
+        for key, index in iteritems(self._indexes):
+            if keys is None or key in keys:
+                index.add(msg_id, rec)
+
+    def _unindex(self, msg_id, rec, keys=None):
+        for key, index in iteritems(self._indexes):
+            if keys is None or key in keys:
+                index.remove(msg_id, rec)
+
+    def _plan(self, check):
+        """Find the msg_ids of the candidate records for a check dict, using our indexes.
+
+        Returns None if no index applies, and every record must be checked.
+        """
+        candidates = None
+        for key, test in iteritems(check):
+            if key == 'msg_id':
+                found = self._find_msg_ids(test)
+            elif key in self._indexes:
+                found = self._indexes[key].find(test)
+            else:
+                continue
+            if found is None:
+                continue
+            if candidates is None:
+                candidates = found
+            else:
+                candidates = candidates.intersection(found)
+        return candidates
+
+    def _find_msg_ids(self, test):
+        """The msg_ids index is self._records itself"""
+        if isinstance(test, dict):
+            if '$in' in test:
+                values = test['$in']
+            elif '$eq' in test:
+                values = [test['$eq']]
+            else:
+                return None
+        else:
+            values = [test]
+        try:
+            return set(values)
+        except TypeError:
+            return None
+
     def _match_one(self, rec, tests):
         """Check if a specific record matches tests."""
         for key,test in iteritems(tests):
@@ -135,18 +301,27 @@ def _match_one(self, rec, tests):
         return True
 
     def _match(self, check):
-        """Find all the matches for a check dict."""
+        """Find all the matches for a check dict.
+
+        Returns the records themselves, not copies.
+        """
         matches = []
         tests = {}
         for k,v in iteritems(check):
             if isinstance(v, dict):
                 tests[k] = CompositeFilter(v)
             else:
-                tests[k] = lambda o: o==v
+                tests[k] = lambda o, v=v: o==v
+
+        candidates = self._plan(check)
+        if candidates is None:
+            records = itervalues(self._records)
+        else:
+            records = ( self._records[m] for m in candidates if m in self._records )
 
-        for rec in itervalues(self._records):
+        for rec in records:
             if self._match_one(rec, tests):
-                matches.append(copy(rec))
+                matches.append(rec)
         return matches
 
     def _extract_subdict(self, rec, keys):
@@ -216,6 +391,7 @@ def add_record(self, msg_id, rec):
             raise KeyError("Already have msg_id %r"%(msg_id))
         self._check_dates(rec)
         self._records[msg_id] = rec
+        self._index(msg_id, rec)
         self._add_bytes(rec)
         self._maybe_cull()
 
@@ -234,20 +410,22 @@ def update_record(self, msg_id, rec):
         self._check_dates(rec)
         _rec = self._records[msg_id]
         self._drop_bytes(_rec)
+        self._unindex(msg_id, _rec, rec)
         _rec.update(rec)
+        self._index(msg_id, _rec, rec)
         self._add_bytes(_rec)
 
     def drop_matching_records(self, check):
         """Remove a record from the DB."""
         matches = self._match(check)
         for rec in matches:
-            self._drop_bytes(rec)
-            del self._records[rec['msg_id']]
+            self.drop_record(rec['msg_id'])
 
     def drop_record(self, msg_id):
         """Remove a record from the DB."""
         rec = self._records[msg_id]
         self._drop_bytes(rec)
+        self._unindex(msg_id, rec)
         del self._records[msg_id]
 
     def find_records(self, check, keys=None):
@@ -268,16 +446,14 @@ def find_records(self, check, keys=None):
         if keys:
             return [ self._extract_subdict(rec, keys) for rec in matches ]
         else:
-            return matches
+            return [ copy(rec) for rec in matches ]
 
     def get_history(self):
         """get all msg_ids, ordered by time submitted."""
-        msg_ids = self._records.keys()
-        # Remove any that do not have a submitted timestamp.
+        # records without a submitted timestamp are not in the index.
         # This is extremely unlikely to happen,
         # but it seems to come up in some tests on VMs.
-        msg_ids = [ m for m in msg_ids if self._records[m]['submitted'] is not None ]
-        return sorted(msg_ids, key=lambda m: self._records[m]['submitted'])
+        return list(self._indexes['submitted'])
 
 
 class NoData(KeyError):
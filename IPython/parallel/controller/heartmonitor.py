@@ -10,6 +10,8 @@
 from __future__ import print_function
 import time
 import uuid
+from array import array
+from threading import Lock, Thread
 
 import zmq
 from zmq.devices import ThreadDevice, ThreadMonitoredQueue
@@ -17,7 +19,7 @@
 
 from IPython.config.configurable import LoggingConfigurable
 from IPython.utils.py3compat import str_to_bytes
-from IPython.utils.traitlets import Set, Instance, CFloat, Integer, Dict, Bool
+from IPython.utils.traitlets import Set, Instance, Integer, Dict, Bool
 
 from IPython.parallel.util import log_errors
 
@@ -61,7 +63,17 @@ class HeartMonitor(LoggingConfigurable):
     """A basic HeartMonitor class
     pingstream: a PUB stream
     pongstream: an ROUTER stream
-    period: the period of the heartbeat in milliseconds"""
+    period: the period of the heartbeat in milliseconds
+
+    Pings are numbered, and hearts echo the number back.
+    Each heart has a slot in compact arrays of the last beat it answered
+    and its latency histogram, so a pong is a couple of array updates.
+    Misses are found with a timer wheel: a heart is only checked on the beat
+    its deadline comes up, rather than every heart on every beat.
+
+    If the streams are on another loop than `loop`, that loop is run in a thread,
+    and the new heart and heart failure handlers are called on `loop`.
+    """
     
     debug = Bool(False, config=True,
         help="""Whether to include every heartbeat in debugging output.
@@ -76,6 +88,13 @@ class HeartMonitor(LoggingConfigurable):
     max_heartmonitor_misses = Integer(10, config=True,
         help='Allowed consecutive missed pings from controller Hub to engine before unregistering.',
     )
+    latency_bins = Integer(12, config=True,
+        help="""The number of bins in the latency histogram of each heart.
+
+        The first bin counts pongs under 1 ms, and each of the others
+        twice as long as the previous one. The last bin counts the rest.
+        """
+    )
 
     pingstream=Instance('zmq.eventloop.zmqstream.ZMQStream')
     pongstream=Instance('zmq.eventloop.zmqstream.ZMQStream')
@@ -84,24 +103,43 @@ def _loop_default(self):
         return ioloop.IOLoop.instance()
 
     # not settable:
-    hearts=Set()
-    responses=Set()
-    on_probation=Dict()
-    last_ping=CFloat(0)
+    hearts=Dict() # slots by heart
+    beat_count=Integer(0)
+    thread=Instance('threading.Thread')
     _new_handlers = Set()
     _failure_handlers = Set()
-    lifetime = CFloat(0)
-    tic = CFloat(0)
 
     def __init__(self, **kwargs):
         super(HeartMonitor, self).__init__(**kwargs)
-
+        self._lock = Lock()
+        self._slots = [] # hearts by slot, None for free slots
+        self._free = []
+        self._last_seen = array('l') # the last beat answered, by slot
+        self._histograms = array('l') # latency_bins counts per slot
+        # slots to check on each beat, by beat % len(wheel)
+        self._wheel = [ set() for i in range(self.max_heartmonitor_misses + 3) ]
+        self._ping_times = [0.] * len(self._wheel)
         self.pongstream.on_recv(self.handle_pong)
 
+    @property
+    def hb_loop(self):
+        """The loop beats and pongs are handled on"""
+        return self.pingstream.io_loop
+
     def start(self):
-        self.tic = time.time()
-        self.caller = ioloop.PeriodicCallback(self.beat, self.period, self.loop)
+        self.caller = ioloop.PeriodicCallback(self.beat, self.period, self.hb_loop)
         self.caller.start()
+        if self.hb_loop is not self.loop:
+            self.thread = Thread(target=self.hb_loop.start, name='heartbeat')
+            self.thread.start()
+
+    def stop(self):
+        """Stop beating, and stop hb_loop and its thread if it has one"""
+        self.caller.stop()
+        if self.thread is not None:
+            self.hb_loop.add_callback(self.hb_loop.stop)
+            self.thread.join()
+            self.thread = None
 
     def add_new_heart_handler(self, handler):
         """add a new handler for new hearts"""
@@ -113,53 +151,85 @@ def add_heart_failure_handler(self, handler):
         self.log.debug("heartbeat::new heart failure handler: %s", handler)
         self._failure_handlers.add(handler)
 
+    def has_heart(self, heart):
+        """Whether a heart is beating, safe to call from any thread"""
+        with self._lock:
+            return heart in self.hearts
+
+    def add_heart(self, heart):
+        """Start tracking a heart as beating now, without calling the new heart handlers."""
+        with self._lock:
+            if heart not in self.hearts:
+                self._add(heart, self.beat_count)
+
+    def _add(self, heart, beat):
+        if self._free:
+            slot = self._free.pop()
+            self._slots[slot] = heart
+            self._last_seen[slot] = beat
+            start = slot * self.latency_bins
+            self._histograms[start:start + self.latency_bins] = array('l', [0] * self.latency_bins)
+        else:
+            slot = len(self._slots)
+            self._slots.append(heart)
+            self._last_seen.append(beat)
+            self._histograms.extend([0] * self.latency_bins)
+        self.hearts[heart] = slot
+        self._schedule(slot)
+        return slot
+
+    def _remove(self, heart):
+        slot = self.hearts.pop(heart)
+        self._slots[slot] = None
+        self._free.append(slot)
+
+    def _deadline(self, slot):
+        """The beat at which a heart will have missed too many pings"""
+        return self._last_seen[slot] + self.max_heartmonitor_misses + 2
+
+    def _schedule(self, slot):
+        self._wheel[self._deadline(slot) % len(self._wheel)].add(slot)
+
+    def _dispatch(self, handler, heart):
+        """Call a handler on the Hub's loop"""
+        if self.hb_loop is self.loop:
+            handler(heart)
+        else:
+            self.loop.add_callback(handler, heart)
+
     def beat(self):
         self.pongstream.flush()
-        self.last_ping = self.lifetime
-
-        toc = time.time()
-        self.lifetime += toc-self.tic
-        self.tic = toc
+        failures = []
+        with self._lock:
+            self.beat_count += 1
+            beat = self.beat_count
+            n = len(self._wheel)
+            due = self._wheel[beat % n]
+            self._wheel[beat % n] = set()
+            for slot in due:
+                deadline = self._deadline(slot)
+                if deadline > beat:
+                    # answered since it was scheduled, check again later
+                    self._wheel[deadline % n].add(slot)
+                else:
+                    failures.append(self._slots[slot])
+            for heart in failures:
+                self._remove(heart)
+            self._ping_times[beat % n] = time.time()
         if self.debug:
-            self.log.debug("heartbeat::sending %s", self.lifetime)
-        goodhearts = self.hearts.intersection(self.responses)
-        missed_beats = self.hearts.difference(goodhearts)
-        newhearts = self.responses.difference(goodhearts)
-        for heart in newhearts:
-            self.handle_new_heart(heart)
-        heartfailures, on_probation = self._check_missed(missed_beats, self.on_probation,
-                                                         self.hearts)
-        for failure in heartfailures:
-            self.handle_heart_failure(failure)
-        self.on_probation = on_probation
-        self.responses = set()
-        #print self.on_probation, self.hearts
-        # self.log.debug("heartbeat::beat %.3f, %i beating hearts", self.lifetime, len(self.hearts))
-        self.pingstream.send(str_to_bytes(str(self.lifetime)))
+            self.log.debug("heartbeat::sending %i", beat)
+        for heart in failures:
+            self._dispatch(self.handle_heart_failure, heart)
+        self.pingstream.send(str_to_bytes(str(beat)))
         # flush stream to force immediate socket send
         self.pingstream.flush()
 
-    def _check_missed(self, missed_beats, on_probation, hearts):
-        """Update heartbeats on probation, identifying any that have too many misses.
-        """
-        failures = []
-        new_probation = {}
-        for cur_heart in (b for b in missed_beats if b in hearts):
-            miss_count = on_probation.get(cur_heart, 0) + 1
-            self.log.info("heartbeat::missed %s : %s" % (cur_heart, miss_count))
-            if miss_count > self.max_heartmonitor_misses:
-                failures.append(cur_heart)
-            else:
-                new_probation[cur_heart] = miss_count
-        return failures, new_probation
-
     def handle_new_heart(self, heart):
         if self._new_handlers:
             for handler in self._new_handlers:
                 handler(heart)
         else:
             self.log.info("heartbeat::yay, got new heart %s!", heart)
-        self.hearts.add(heart)
 
     def handle_heart_failure(self, heart):
         if self._failure_handlers:
@@ -171,23 +241,49 @@ def handle_heart_failure(self, heart):
                     pass
         else:
             self.log.info("heartbeat::Heart %s failed :(", heart)
-        self.hearts.remove(heart)
-
 
     @log_errors
     def handle_pong(self, msg):
         "a heart just beat"
-        current = str_to_bytes(str(self.lifetime))
-        last = str_to_bytes(str(self.last_ping))
-        if msg[1] == current:
-            delta = time.time()-self.tic
-            if self.debug:
-                self.log.debug("heartbeat::heart %r took %.2f ms to respond", msg[0], 1000*delta)
-            self.responses.add(msg[0])
-        elif msg[1] == last:
-            delta = time.time()-self.tic + (self.lifetime-self.last_ping)
-            self.log.warn("heartbeat::heart %r missed a beat, and took %.2f ms to respond", msg[0], 1000*delta)
-            self.responses.add(msg[0])
-        else:
-            self.log.warn("heartbeat::got bad heartbeat (possibly old?): %s (current=%.3f)", msg[1], self.lifetime)
+        heart = msg[0]
+        try:
+            beat = int(msg[1])
+        except ValueError:
+            self.log.warn("heartbeat::got bad heartbeat from %r: %r", heart, msg[1])
+            return
+        n = len(self._wheel)
+        with self._lock:
+            current = self.beat_count
+            if not current - n < beat <= current:
+                self.log.warn("heartbeat::got old heartbeat from %r: %i (current=%i)", heart, beat, current)
+                return
+            delta = time.time() - self._ping_times[beat % n]
+            slot = self.hearts.get(heart)
+            new = slot is None
+            if new:
+                slot = self._add(heart, beat)
+            elif beat > self._last_seen[slot]:
+                self._last_seen[slot] = beat
+            ms = int(1000 * delta)
+            self._histograms[slot * self.latency_bins + min(ms.bit_length(), self.latency_bins - 1)] += 1
+        if self.debug:
+            self.log.debug("heartbeat::heart %r took %.2f ms to respond to beat %i", heart, 1000*delta, beat)
+        if new:
+            self._dispatch(self.handle_new_heart, heart)
+
+    def latency_histogram(self, heart):
+        """The latency histogram of a heart, as a list of `latency_bins` counts.
+
+        The upper bounds of the bins are 1, 2, 4, ... ms, except the last one.
+        """
+        with self._lock:
+            return self._histogram(self.hearts[heart])
+
+    def latency_histograms(self):
+        """The latency histograms of all hearts, by heart"""
+        with self._lock:
+            return dict((heart, self._histogram(slot)) for heart, slot in self.hearts.items())
 
+    def _histogram(self, slot):
+        start = slot * self.latency_bins
+        return self._histograms[start:start + self.latency_bins].tolist()
@@ -13,9 +13,11 @@
 import os
 import sys
 import time
+from collections import deque
 from datetime import datetime
 
 import zmq
+from zmq.eventloop import ioloop
 from zmq.eventloop.zmqstream import ZMQStream
 
 # internal:
@@ -24,7 +26,8 @@
 from IPython.utils.localinterfaces import localhost
 from IPython.utils.py3compat import cast_bytes, unicode_type, iteritems
 from IPython.utils.traitlets import (
-        HasTraits, Any, Instance, Integer, Unicode, Dict, Set, Tuple, DottedObjectName
+        HasTraits, Any, Instance, Integer, Float, Unicode, Dict, Set, Tuple,
+        DottedObjectName
         )
 
 from IPython.parallel import error, util
@@ -113,6 +116,63 @@ class EngineConnector(HasTraits):
     stallback = Any()
 
 
+class StreamBuffer(object):
+    """stdout/stderr output of a task, waiting to be written to the db.
+    Attributes are:
+    chunks (dict): lists of text, keyed by stream name
+    size (int): total length of the buffered text
+    timeout: tornado timeout for flushing the buffer
+    """
+    
+    def __init__(self):
+        self.chunks = {}
+        self.size = 0
+        self.timeout = None
+    
+    def append(self, name, text):
+        self.chunks.setdefault(name, []).append(text)
+        self.size += len(text)
+
+
+class RollingHistogram(object):
+    """Counts of values in power-of-two bins, over the last `window` seconds.
+
+    Bin i counts values below ``scale * 2**i``, and the last bin counts the rest,
+    like the latency histograms of the HeartMonitor.
+    The window is kept as a few slices of counts, and whole slices expire,
+    so adding a value is O(1) and the window is only accurate to a slice.
+    """
+
+    def __init__(self, window=60., scale=1., nbins=20, nslices=6):
+        self.window = window
+        self.scale = scale
+        self.nbins = nbins
+        self.span = float(window) / nslices
+        self.slices = deque() # [start, counts]
+
+    def _expire(self, now):
+        while self.slices and now - self.slices[0][0] >= self.window:
+            self.slices.popleft()
+
+    def add(self, value, now=None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        if not self.slices or now - self.slices[-1][0] >= self.span:
+            self.slices.append([now, [0] * self.nbins])
+        idx = int(value / self.scale).bit_length()
+        self.slices[-1][1][min(idx, self.nbins - 1)] += 1
+
+    def counts(self, now=None):
+        """The counts of each bin in the window, as a list."""
+        now = time.time() if now is None else now
+        self._expire(now)
+        counts = [0] * self.nbins
+        for start, slice_counts in self.slices:
+            for i, n in enumerate(slice_counts):
+                counts[i] += n
+        return counts
+
+
 _db_shortcuts = {
     'sqlitedb' : 'IPython.parallel.controller.sqlitedb.SQLiteDB',
     'mongodb'  : 'IPython.parallel.controller.mongodb.MongoDB',
@@ -210,6 +270,23 @@ def _registration_timeout_default(self):
             # heartmonitor period is in milliseconds, so 10x in seconds is .01
         return max(30, int(.01 * self.heartmonitor.period))
 
+    stream_buffer_size = Integer(65536, config=True,
+        help="""The number of characters of stdout/stderr output the Hub buffers
+        for a task before writing it to the db."""
+    )
+    stream_flush_interval = Float(1., config=True,
+        help="""The maximum time (in seconds) buffered stdout/stderr output
+        waits before being written to the db."""
+    )
+    stream_limit = Integer(0, config=True,
+        help="""The maximum number of characters each of stdout and stderr to store
+        for a task.  Further output is discarded.  0 means no limit."""
+    )
+    stats_window = Float(60., config=True,
+        help="""The time (in seconds) over which the Hub keeps the histograms
+        of queue depths, latencies and runtimes returned by stats requests."""
+    )
+
     # not configurable
     db = Instance('IPython.parallel.controller.dictdb.BaseDB')
     heartmonitor = Instance('IPython.parallel.controller.heartmonitor.HeartMonitor')
@@ -297,15 +374,16 @@ def init_hub(self):
 
         ### Engine connections ###
 
-        # heartbeat
+        # heartbeat, on a loop in its own thread
+        hb_loop = ioloop.IOLoop()
         hpub = ctx.socket(zmq.PUB)
         hpub.bind(self.engine_url('hb_ping'))
         hrep = ctx.socket(zmq.ROUTER)
         util.set_hwm(hrep, 0)
         hrep.bind(self.engine_url('hb_pong'))
         self.heartmonitor = HeartMonitor(loop=loop, parent=self, log=self.log,
-                                pingstream=ZMQStream(hpub,loop),
-                                pongstream=ZMQStream(hrep,loop)
+                                pingstream=ZMQStream(hpub,hb_loop),
+                                pongstream=ZMQStream(hrep,hb_loop)
                             )
 
         ### Client connections ###
@@ -338,7 +416,12 @@ def init_hub(self):
         self.hub = Hub(loop=loop, session=self.session, monitor=sub, heartmonitor=self.heartmonitor,
                 query=q, notifier=n, resubmit=r, db=self.db,
                 engine_info=self.engine_info, client_info=self.client_info,
-                log=self.log, registration_timeout=self.registration_timeout)
+                log=self.log, registration_timeout=self.registration_timeout,
+                stream_buffer_size=self.stream_buffer_size,
+                stream_flush_interval=self.stream_flush_interval,
+                stream_limit=self.stream_limit,
+                stats_window=self.stats_window,
+        )
 
 
 class Hub(SessionFactory):
@@ -379,6 +462,14 @@ class Hub(SessionFactory):
     unassigned=Set() # set of task msg_ds not yet assigned a destination
     incoming_registrations=Dict()
     registration_timeout=Integer()
+    streams=Dict() # StreamBuffers of output not yet in the db, keyed by msg_id
+    stream_buffer_size=Integer(65536)
+    stream_flush_interval=Float(1.)
+    stream_limit=Integer(0)
+    dispatch_times=Dict() # (queued, dispatched) of tasks in the scheduler, keyed by msg_id
+    stats_window=Float(60.)
+    unassigned_depth=Instance(RollingHistogram)
+    engine_stats=Dict() # dicts of RollingHistograms, keyed by engine_id
     _idcounter=Integer(0)
 
     # objects from constructor:
@@ -408,6 +499,7 @@ def __init__(self, **kwargs):
         """
 
         super(Hub, self).__init__(**kwargs)
+        self.unassigned_depth = RollingHistogram(self.stats_window)
 
         # register our callbacks
         self.query.on_recv(self.dispatch_query)
@@ -437,6 +529,7 @@ def __init__(self, **kwargs):
                                 'registration_request' : self.register_engine,
                                 'unregistration_request' : self.unregister_engine,
                                 'connection_request': self.connection_request,
+                                'stats_request': self.stats_request,
         }
 
         # ignore resubmit replies
@@ -582,13 +675,33 @@ def handle_heart_failure(self, heart):
 
     #----------------------- MUX Queue Traffic ------------------------------
 
+    def _deserialize(self, msg):
+        """Deserialize a monitored message, without decompressing its buffers.
+
+        Compressed buffers are stored as they are, along with the 'compression'
+        metadata describing them, and only decompressed when a client asks for them.
+        """
+        msg = self.session.deserialize(msg, content=False)
+        msg['content'] = self.session.unpack(msg['content'])
+        return msg
+
+    def _decompress(self, metadata, buffers):
+        """Decompress stored buffers, if their metadata says they are compressed.
+
+        Returns (metadata, buffers), with 'compression' removed from a copy of metadata.
+        """
+        if metadata and 'compression' in metadata and buffers:
+            metadata = dict(metadata)
+            buffers = self.session.decompress_buffers(metadata, buffers)
+        return metadata, buffers
+
     def save_queue_request(self, idents, msg):
         if len(idents) < 2:
             self.log.error("invalid identity prefix: %r", idents)
             return
         queue_id, client_id = idents[:2]
         try:
-            msg = self.session.deserialize(msg)
+            msg = self._deserialize(msg)
         except Exception:
             self.log.error("queue::client %r sent invalid message to %r: %r", client_id, queue_id, msg, exc_info=True)
             return
@@ -628,6 +741,7 @@ def save_queue_request(self, idents, msg):
 
         self.pending.add(msg_id)
         self.queues[eid].append(msg_id)
+        self._engine_stats(eid)['queue_depth'].add(len(self.queues[eid]) + len(self.tasks[eid]))
 
     def save_queue_result(self, idents, msg):
         if len(idents) < 2:
@@ -636,7 +750,7 @@ def save_queue_result(self, idents, msg):
 
         client_id, queue_id = idents[:2]
         try:
-            msg = self.session.deserialize(msg)
+            msg = self._deserialize(msg)
         except Exception:
             self.log.error("queue::engine %r sent invalid message to %r: %r",
                     queue_id, client_id, msg, exc_info=True)
@@ -651,7 +765,18 @@ def save_queue_result(self, idents, msg):
         if not parent:
             return
         msg_id = parent['msg_id']
-        if msg_id in self.pending:
+        if msg['metadata'].get('function_cache_miss', False) and msg_id in self.pending:
+            # the client will send the request again, with its function
+            self.log.info("queue::request %r missed the function cache on %s", msg_id, eid)
+            self.pending.remove(msg_id)
+            self.queues[eid].remove(msg_id)
+            try:
+                self.db.drop_record(msg_id)
+            except Exception:
+                self.log.error("DB Error dropping record %r", msg_id, exc_info=True)
+            return
+        first = msg_id in self.pending
+        if first:
             self.pending.remove(msg_id)
             self.all_completed.add(msg_id)
             self.queues[eid].remove(msg_id)
@@ -667,6 +792,8 @@ def save_queue_result(self, idents, msg):
         md = msg['metadata']
         completed = rheader['date']
         started = extract_dates(md.get('started', None))
+        if first:
+            self._record_runtime(eid, started, completed)
         result = {
             'result_header' : rheader,
             'result_metadata': md,
@@ -681,6 +808,7 @@ def save_queue_result(self, idents, msg):
             self.db.update_record(msg_id, result)
         except Exception:
             self.log.error("DB Error updating record %r", msg_id, exc_info=True)
+        self.flush_streams(msg_id)
 
 
     #--------------------- Task Queue Traffic ------------------------------
@@ -690,19 +818,48 @@ def save_task_request(self, idents, msg):
         client_id = idents[0]
 
         try:
-            msg = self.session.deserialize(msg)
+            msg = self._deserialize(msg)
         except Exception:
             self.log.error("task::client %r sent invalid task message: %r",
                     client_id, msg, exc_info=True)
             return
+        if msg['header']['msg_type'] == 'batch_apply_request':
+            return self.save_task_batch(msg)
+
         record = init_record(msg)
 
         record['client_uuid'] = msg['header']['session']
         record['queue'] = 'task'
-        header = msg['header']
-        msg_id = header['msg_id']
+        msg_id = record['msg_id']
         self.pending.add(msg_id)
         self.unassigned.add(msg_id)
+        self.unassigned_depth.add(len(self.unassigned))
+        self._save_task_record(msg_id, record)
+
+    def save_task_batch(self, msg):
+        """Save the submission of a batch of tasks, with one bulk insert."""
+        records = []
+        for task in util.split_apply_batch(msg):
+            record = init_record(task)
+            record['client_uuid'] = task['header']['session']
+            record['queue'] = 'task'
+            records.append(record)
+            self.pending.add(record['msg_id'])
+            self.unassigned.add(record['msg_id'])
+        self.unassigned_depth.add(len(self.unassigned))
+        self.log.info("task::client %r submitted %i tasks in batch %r",
+            msg['header']['session'], len(records), msg['header']['msg_id'])
+        try:
+            self.db.add_records(records)
+        except Exception:
+            # some records may already exist (e.g. iopub arrived first)
+            self.log.debug("DB Error adding batch %r, saving records individually",
+                msg['header']['msg_id'], exc_info=True)
+            for record in records:
+                self._save_task_record(record['msg_id'], record)
+
+    def _save_task_record(self, msg_id, record):
+        """Add a new task record, or merge it into an existing one."""
         try:
             # it's posible iopub arrived first:
             existing = self.db.get_record(msg_id)
@@ -740,7 +897,7 @@ def save_task_result(self, idents, msg):
         """save the result of a completed task."""
         client_id = idents[0]
         try:
-            msg = self.session.deserialize(msg)
+            msg = self._deserialize(msg)
         except Exception:
             self.log.error("task::invalid task result message send to %r: %r",
                     client_id, msg, exc_info=True)
@@ -757,6 +914,9 @@ def save_task_result(self, idents, msg):
 
         header = msg['header']
         md = msg['metadata']
+        times = self.dispatch_times.pop(msg_id, None)
+        if times is not None:
+            md = dict(md, queued=times[0], dispatched=times[1])
         engine_uuid = md.get('engine', u'')
         eid = self.by_ident.get(cast_bytes(engine_uuid), None)
         
@@ -773,9 +933,11 @@ def save_task_result(self, idents, msg):
                     self.tasks[eid].remove(msg_id)
             completed = header['date']
             started = extract_dates(md.get('started', None))
+            if eid is not None and status != 'aborted':
+                self._record_runtime(eid, started, completed)
             result = {
                 'result_header' : header,
-                'result_metadata': msg['metadata'],
+                'result_metadata': md,
                 'result_content': msg['content'],
                 'started' : started,
                 'completed' : completed,
@@ -788,6 +950,7 @@ def save_task_result(self, idents, msg):
                 self.db.update_record(msg_id, result)
             except Exception:
                 self.log.error("DB Error saving task request %r", msg_id, exc_info=True)
+            self.flush_streams(msg_id)
 
         else:
             self.log.debug("task::unknown task %r finished", msg_id)
@@ -811,6 +974,13 @@ def save_task_destination(self, idents, msg):
         #     self.log.debug("task::task %r not listed as MIA?!"%(msg_id))
 
         self.tasks[eid].append(msg_id)
+        stats = self._engine_stats(eid)
+        stats['queue_depth'].add(len(self.queues[eid]) + len(self.tasks[eid]))
+        queued = extract_dates(content.get('queued', None))
+        dispatched = extract_dates(content.get('dispatched', None))
+        if isinstance(queued, datetime) and isinstance(dispatched, datetime):
+            self.dispatch_times[msg_id] = (queued, dispatched)
+            stats['dispatch_latency'].add((dispatched - queued).total_seconds())
         # self.pending[msg_id][1].update(received=datetime.now(),engine=(eid,engine_uuid))
         try:
             self.db.update_record(msg_id, dict(engine_uuid=engine_uuid))
@@ -818,6 +988,27 @@ def save_task_destination(self, idents, msg):
             self.log.error("DB Error saving task destination %r", msg_id, exc_info=True)
 
 
+    def _engine_stats(self, eid):
+        """The RollingHistograms of engine eid, created on first use.
+
+        Those of unregistered engines are empty, and not kept.
+        """
+        stats = self.engine_stats.get(eid, None)
+        if stats is None:
+            stats = {
+                'queue_depth': RollingHistogram(self.stats_window),
+                'dispatch_latency': RollingHistogram(self.stats_window, scale=1e-3),
+                'runtime': RollingHistogram(self.stats_window, scale=1e-3),
+            }
+            if self.keytable.get(eid) not in self.dead_engines:
+                self.engine_stats[eid] = stats
+        return stats
+
+    def _record_runtime(self, eid, started, completed):
+        """Count a request completed by engine eid, for its runtime and throughput."""
+        if isinstance(started, datetime) and isinstance(completed, datetime):
+            self._engine_stats(eid)['runtime'].add((completed - started).total_seconds())
+
     def mia_task_request(self, idents, msg):
         raise NotImplementedError
         client_id = idents[0]
@@ -844,20 +1035,13 @@ def save_iopub_message(self, topics, msg):
         msg_type = msg['header']['msg_type']
         content = msg['content']
         
-        # ensure msg_id is in db
-        try:
-            rec = self.db.get_record(msg_id)
-        except KeyError:
-            rec = None
-        
         # stream
-        d = {}
         if msg_type == 'stream':
-            name = content['name']
-            s = '' if rec is None else rec[name]
-            d[name] = s + content['text']
-
-        elif msg_type == 'error':
+            self.buffer_stream(msg_id, content['name'], content['text'])
+            return
+        
+        d = {}
+        if msg_type == 'error':
             d['error'] = content
         elif msg_type == 'execute_input':
             d['execute_input'] = content['code']
@@ -873,6 +1057,15 @@ def save_iopub_message(self, topics, msg):
         if not d:
             return
         
+        # ensure msg_id is in db
+        try:
+            rec = self.db.get_record(msg_id)
+        except KeyError:
+            rec = None
+        self._save_iopub_record(msg_id, rec, d)
+
+    def _save_iopub_record(self, msg_id, rec, d):
+        """Update the record of msg_id with iopub data d, creating it if rec is None."""
         if rec is None:
             # new record
             rec = empty_record()
@@ -888,6 +1081,60 @@ def save_iopub_message(self, topics, msg):
         except Exception:
             self.log.error("DB Error saving iopub message %r", msg_id, exc_info=True)
 
+    def buffer_stream(self, msg_id, name, text):
+        """Buffer stream output of a task, to be written to the db in chunks.
+
+        The buffer is flushed when it reaches stream_buffer_size,
+        after stream_flush_interval, when the task completes,
+        or before answering queries of the db.
+        """
+        buf = self.streams.get(msg_id, None)
+        if buf is None:
+            buf = self.streams[msg_id] = StreamBuffer()
+            buf.timeout = self.loop.add_timeout(self.loop.time() + self.stream_flush_interval,
+                lambda : self.flush_streams(msg_id)
+            )
+        buf.append(name, text)
+        if buf.size >= self.stream_buffer_size:
+            self.flush_streams(msg_id)
+
+    def flush_streams(self, msg_id=None):
+        """Write buffered stream output to the db.
+
+        Flushes the output of msg_id, or of every task if msg_id is None.
+        """
+        if msg_id is None:
+            msg_ids = list(self.streams)
+        else:
+            msg_ids = [msg_id]
+        for msg_id in msg_ids:
+            buf = self.streams.pop(msg_id, None)
+            if buf is None:
+                continue
+            if buf.timeout is not None:
+                self.loop.remove_timeout(buf.timeout)
+            
+            try:
+                rec = self.db.get_record(msg_id)
+            except KeyError:
+                rec = None
+            d = {}
+            for name, chunks in iteritems(buf.chunks):
+                stored = (rec or {}).get(name, None) or ''
+                text = ''.join(chunks)
+                if self.stream_limit:
+                    room = self.stream_limit - len(stored)
+                    if room <= 0:
+                        # already full
+                        continue
+                    if len(text) > room:
+                        self.log.info("iopub::discarding %s output of %r beyond %i characters",
+                            name, msg_id, self.stream_limit)
+                        text = text[:room] + '\n[output truncated]\n'
+                d[name] = stored + text
+            if d:
+                self._save_iopub_record(msg_id, rec, d)
+
 
 
     #-------------------------------------------------------------------------
@@ -950,7 +1197,7 @@ def register_engine(self, reg, msg):
         heart = cast_bytes(uuid)
 
         if content['status'] == 'ok':
-            if heart in self.heartmonitor.hearts:
+            if self.heartmonitor.has_heart(heart):
                 # already beating
                 self.incoming_registrations[heart] = EngineConnector(id=eid,uuid=uuid)
                 self.finish_registration(heart)
@@ -978,6 +1225,7 @@ def unregister_engine(self, ident, msg):
         uuid = self.keytable[eid]
         content=dict(id=eid, uuid=uuid)
         self.dead_engines.add(uuid)
+        self.engine_stats.pop(eid, None)
         
         self.loop.add_timeout(
             self.loop.time() + self.registration_timeout,
@@ -1000,6 +1248,9 @@ def _handle_stranded_msgs(self, eid, uuid):
 
         outstanding = self.queues[eid]
 
+        for msg_id in self.tasks[eid]:
+            self.dispatch_times.pop(msg_id, None)
+
         for msg_id in outstanding:
             self.pending.remove(msg_id)
             self.all_completed.add(msg_id)
@@ -1104,8 +1355,7 @@ def _load_engine_state(self):
         for eid, uuid in iteritems(state['engines']):
             heart = uuid.encode('ascii')
             # start with this heart as current and beating:
-            self.heartmonitor.responses.add(heart)
-            self.heartmonitor.hearts.add(heart)
+            self.heartmonitor.add_heart(heart)
             
             self.incoming_registrations[heart] = EngineConnector(id=int(eid), uuid=uuid)
             self.finish_registration(heart)
@@ -1127,6 +1377,7 @@ def shutdown_request(self, client_id, msg):
 
     def _shutdown(self):
         self.log.info("hub::hub shutting down.")
+        self.heartmonitor.stop()
         time.sleep(0.1)
         sys.exit(0)
 
@@ -1184,9 +1435,56 @@ def queue_status(self, client_id, msg):
         # print (content)
         self.session.send(self.query, "queue_reply", content=content, ident=client_id)
 
+    def stats_request(self, client_id, msg):
+        """Return rolling statistics of the queues of one or more targets,
+        over the last stats_window seconds.
+
+        Histograms are lists of counts in power-of-two bins, like the heartbeat
+        latency histograms: times have upper bounds of 1, 2, 4, ... ms,
+        and queue depths of 1, 2, 4, ... requests, except the last bin.
+
+        Keys:
+
+        * window (the length of the window, in seconds)
+        * unassigned (depth of the task scheduler queue, at each task submission)
+        * one dict per target still registered, with:
+
+          * queue_depth (requests on the engine, as each one arrives)
+          * dispatch_latency (time tasks waited in the task scheduler)
+          * runtime (time from start to completion of each request on the engine)
+          * throughput (completed requests per second)
+          * heartbeat_latency
+        """
+        content = msg['content']
+        try:
+            targets = self._validate_targets(content.get('targets', None))
+        except:
+            content = error.wrap_exception()
+            self.session.send(self.query, "hub_error",
+                    content=content, ident=client_id)
+            return
+        now = time.time()
+        latencies = self.heartmonitor.latency_histograms()
+        heart_latencies = dict((self.hearts[heart], hist)
+            for heart, hist in iteritems(latencies) if heart in self.hearts)
+        content = dict(status='ok', window=self.stats_window,
+            unassigned=self.unassigned_depth.counts(now),
+        )
+        for t in targets:
+            if self.keytable[t] in self.dead_engines:
+                # unregistered engines are still in self.ids
+                continue
+            stats = dict((key, hist.counts(now))
+                for key, hist in iteritems(self._engine_stats(t)))
+            stats['throughput'] = sum(stats['runtime']) / self.stats_window
+            stats['heartbeat_latency'] = heart_latencies.get(t, [])
+            content[str(t)] = stats
+        self.session.send(self.query, "stats_reply", content=content, ident=client_id)
+
     def purge_results(self, client_id, msg):
         """Purge results from memory. This method is more valuable before we move
         to a DB based message storage mechanism."""
+        self.flush_streams()
         content = msg['content']
         self.log.info("Dropping records with %s", content)
         msg_ids = content.get('msg_ids', [])
@@ -1242,7 +1540,7 @@ def finish(reply):
         reply = dict(status='ok')
         try:
             records = self.db.find_records({'msg_id' : {'$in' : msg_ids}}, keys=[
-                'header', 'content', 'buffers'])
+                'header', 'content', 'metadata', 'buffers'])
         except Exception:
             self.log.error('db::db error finding tasks to resubmit', exc_info=True)
             return finish(error.wrap_exception())
@@ -1289,6 +1587,10 @@ def finish(reply):
             header['msg_id'] = fresh['msg_id']
             header['date'] = fresh['date']
             msg['header'] = header
+            compression = (rec['metadata'] or {}).get('compression')
+            if compression:
+                # the buffers are stored compressed
+                msg['metadata'] = dict(compression=compression)
 
             self.session.send(self.resubmit, msg, buffers=rec['buffers'])
 
@@ -1316,24 +1618,23 @@ def _extract_record(self, rec):
         io_dict = {}
         for key in ('execute_input', 'execute_result', 'error', 'stdout', 'stderr'):
                 io_dict[key] = rec[key]
+        result_metadata, buffers = self._decompress(rec['result_metadata'],
+            list(rec['result_buffers'] or []))
         content = { 
             'header': rec['header'],
             'metadata': rec['metadata'],
-            'result_metadata': rec['result_metadata'],
+            'result_metadata': result_metadata,
             'result_header' : rec['result_header'],
             'result_content': rec['result_content'],
             'received' : rec['received'],
             'io' : io_dict,
         }
-        if rec['result_buffers']:
-            buffers = list(map(bytes, rec['result_buffers']))
-        else:
-            buffers = []
 
         return content, buffers
 
     def get_results(self, client_id, msg):
         """Get the result of 1 or more messages."""
+        self.flush_streams()
         content = msg['content']
         msg_ids = sorted(set(content['msg_ids']))
         statusonly = content.get('status_only', False)
@@ -1400,13 +1701,20 @@ def get_history(self, client_id, msg):
 
     def db_query(self, client_id, msg):
         """Perform a raw query on the task record database."""
+        self.flush_streams()
         content = msg['content']
         query = extract_dates(content.get('query', {}))
         keys = content.get('keys', None)
         buffers = []
         empty = list()
+        # buffers are decompressed according to their metadata, so get it too
+        extra_keys = []
+        if keys is not None:
+            for md_key, buf_key in (('metadata', 'buffers'), ('result_metadata', 'result_buffers')):
+                if buf_key in keys and md_key not in keys:
+                    extra_keys.append(md_key)
         try:
-            records = self.db.find_records(query, keys)
+            records = self.db.find_records(query, keys + extra_keys if extra_keys else keys)
         except Exception as e:
             content = error.wrap_exception()
             self.log.exception("DB query failed")
@@ -1423,12 +1731,16 @@ def db_query(self, client_id, msg):
                 # buffers may be None, so double check
                 b = rec.pop('buffers', empty) or empty
                 if buffer_lens is not None:
+                    rec['metadata'], b = self._decompress(rec['metadata'], b)
                     buffer_lens.append(len(b))
                     buffers.extend(b)
                 rb = rec.pop('result_buffers', empty) or empty
                 if result_buffer_lens is not None:
+                    rec['result_metadata'], rb = self._decompress(rec['result_metadata'], rb)
                     result_buffer_lens.append(len(rb))
                     buffers.extend(rb)
+                for key in extra_keys:
+                    rec.pop(key)
             content = dict(status='ok', records=records, buffer_lens=buffer_lens,
                                     result_buffer_lens=result_buffer_lens)
         # self.log.debug (content)
@@ -70,6 +70,11 @@ def add_record(self, msg_id, rec):
         # print rec
         rec = self._binary_buffers(rec)
         self._records.insert(rec)
+
+    def add_records(self, records):
+        """Add several new Task Records, with a single insert."""
+        if records:
+            self._records.insert([ self._binary_buffers(rec) for rec in records ])
     
     def get_record(self, msg_id):
         """Get a specific Task Record, by msg_id."""
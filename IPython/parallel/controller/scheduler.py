@@ -8,12 +8,15 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import hashlib
+import heapq
 import logging
 import sys
 import time
 
-from collections import deque
+from collections import deque, OrderedDict
 from datetime import datetime
+from itertools import count
 from random import randint, random
 from types import FunctionType
 
@@ -29,8 +32,10 @@
 from IPython.external.decorator import decorator
 from IPython.config.application import Application
 from IPython.config.loader import Config
-from IPython.utils.traitlets import Instance, Dict, List, Set, Integer, Enum, CBytes
+from IPython.utils.traitlets import Instance, Dict, List, Set, Integer, Float, Enum, CBytes, Bool
+from IPython.utils.jsonutil import extract_dates
 from IPython.utils.py3compat import cast_bytes
+from IPython.kernel.zmq.serialize import FunctionCache
 
 from IPython.parallel import error, util
 from IPython.parallel.factory import SessionFactory
@@ -106,6 +111,17 @@ def leastload(loads):
     """
     return loads.index(min(loads))
 
+def mintime(loads):
+    """Choose the engine expected to finish the new task first.
+
+    Instead of job counts, `loads` are the expected times for each engine
+    to finish its outstanding tasks plus the new one,
+    based on its observed task runtimes (see TaskScheduler.expected_times).
+    """
+    return loads.index(min(loads))
+# mintime needs expected completion times, not job counts, as its loads
+mintime.uses_runtimes = True
+
 #---------------------------------------------------------------------
 # Classes
 #---------------------------------------------------------------------
@@ -115,6 +131,23 @@ def leastload(loads):
 MET = Dependency([])
 
 
+class CombinedDependency(Dependency):
+    """A Dependency that is met when each of several Dependencies is met,
+    such as the `after` of a task in a graph and the parents of the task.
+
+    As a set, it is the union of their msg_ids.
+    """
+    def __init__(self, dependencies):
+        self.dependencies = [ dep for dep in dependencies if dep ]
+        Dependency.__init__(self, set().union(*self.dependencies))
+
+    def check(self, completed, failed=None):
+        return all(dep.check(completed, failed) for dep in self.dependencies)
+
+    def unreachable(self, completed, failed=None):
+        return any(dep.unreachable(completed, failed) for dep in self.dependencies)
+
+
 class Job(object):
     """Simple container for a job"""
     def __init__(self, msg_id, raw_msg, idents, msg, header, metadata,
@@ -134,6 +167,8 @@ def __init__(self, msg_id, raw_msg, idents, msg, header, metadata,
         self.timestamp = time.time()
         self.timeout_id = 0
         self.blacklist = set()
+        self.ready_token = None # identifies the live entries in the ReadyQueue
+        self.memo_key = None # key of the memoized result, if submitted with memoize=True
 
     def __lt__(self, other):
         return self.timestamp < other.timestamp
@@ -146,6 +181,112 @@ def dependents(self):
         return self.follow.union(self.after)
 
 
+class ReadyQueue(object):
+    """Index of jobs whose time dependencies are met, but which have not been assigned.
+
+    Jobs are split by where they are allowed to run, so that an engine
+    freeing a slot does not trigger a rescan of every queued job:
+
+    - `unrestricted` is a heap of jobs that can run on any engine.
+    - `targeted` is a dict by engine ident of heaps of jobs with explicit targets.
+    - `restricted` holds jobs with location dependencies or a blacklist,
+      which have to be checked individually, in the order they were added.
+
+    Heaps are ordered by job timestamp.  Deletion is lazy: entries whose
+    token no longer matches the job's `ready_token` are dropped as they are found.
+    """
+
+    def __init__(self):
+        self.jobs = {} # dict by msg_id of indexed Jobs
+        self.unrestricted = []
+        self.targeted = {}
+        self.restricted = deque()
+        self._tokens = count()
+        self._entries = 0 # number of live + stale entries
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.jobs
+
+    @staticmethod
+    def _live(entry):
+        return entry[1] == entry[2].ready_token
+
+    def add(self, job):
+        """Add a job to the index, if it is not already there."""
+        if job.msg_id in self.jobs:
+            return
+        self.jobs[job.msg_id] = job
+        token = job.ready_token = next(self._tokens)
+        entry = (job.timestamp, token, job)
+        if job.follow or job.blacklist:
+            self.restricted.append(entry)
+            self._entries += 1
+        elif job.targets:
+            for target in job.targets:
+                heapq.heappush(self.targeted.setdefault(target, []), entry)
+            self._entries += len(job.targets)
+        else:
+            heapq.heappush(self.unrestricted, entry)
+            self._entries += 1
+
+    def discard(self, job):
+        """Remove a job from the index, if it is there."""
+        if self.jobs.get(job.msg_id) is job:
+            del self.jobs[job.msg_id]
+            job.ready_token = None
+            if self._entries > 2 * len(self.jobs) + 1024:
+                self._compact()
+
+    def _head(self, heap):
+        """Return the oldest live entry in a heap, dropping stale ones."""
+        while heap and not self._live(heap[0]):
+            heapq.heappop(heap)
+            self._entries -= 1
+        if heap:
+            return heap[0]
+
+    def oldest(self, targets):
+        """Return the oldest unrestricted or targeted job that can run on one of `targets`.
+
+        Returns None if there is no such job.
+        """
+        best = self._head(self.unrestricted)
+        for target in targets:
+            heap = self.targeted.get(target)
+            if not heap:
+                continue
+            head = self._head(heap)
+            if head is not None and (best is None or head < best):
+                best = head
+        if best is not None:
+            return best[2]
+
+    def restricted_jobs(self):
+        """Return a list of the restricted jobs, oldest first."""
+        live = deque(entry for entry in self.restricted if self._live(entry))
+        self._entries -= len(self.restricted) - len(live)
+        self.restricted = live
+        return [ entry[2] for entry in live ]
+
+    def _compact(self):
+        """Drop all stale entries."""
+        self.unrestricted = [ e for e in self.unrestricted if self._live(e) ]
+        heapq.heapify(self.unrestricted)
+        for target, heap in list(self.targeted.items()):
+            heap = [ e for e in heap if self._live(e) ]
+            if heap:
+                heapq.heapify(heap)
+                self.targeted[target] = heap
+            else:
+                del self.targeted[target]
+        self.restricted = deque(e for e in self.restricted if self._live(e))
+        self._entries = len(self.unrestricted) + len(self.restricted) + \
+            sum(len(heap) for heap in self.targeted.values())
+
+
 class TaskScheduler(SessionFactory):
     """Python TaskScheduler object.
 
@@ -170,15 +311,44 @@ class TaskScheduler(SessionFactory):
 
         """
     )
-    scheme_name = Enum(('leastload', 'pure', 'lru', 'plainrandom', 'weighted', 'twobin'),
+    scheme_name = Enum(('leastload', 'pure', 'lru', 'plainrandom', 'weighted', 'twobin', 'mintime'),
         'leastload', config=True, allow_none=False,
         help="""select the task scheduler scheme  [default: Python LRU]
-        Options are: 'pure', 'lru', 'plainrandom', 'weighted', 'twobin','leastload'"""
+        Options are: 'pure', 'lru', 'plainrandom', 'weighted', 'twobin','leastload',
+        'mintime'.  'mintime' assigns each task to the engine expected to complete it first,
+        based on the observed runtimes of previous tasks on each engine."""
+    )
+    runtime_decay = Float(0.2, config=True,
+        help="""The weight of each new observation in the exponentially weighted average
+        of task runtimes on an engine, used by the 'mintime' scheme.
+        Higher values adapt faster to changes in task duration, but are noisier."""
     )
     def _scheme_name_changed(self, old, new):
         self.log.debug("Using scheme %r"%new)
         self.scheme = globals()[new]
 
+    work_stealing = Bool(False, config=True,
+        help="""Reassign tasks that are waiting in a busy engine's queue to idle engines.
+
+        With hwm other than 1, tasks can wait on an engine behind a long task,
+        while other engines are idle.  With work stealing, the scheduler asks the busy
+        engine to abort the waiting task, and sends it to an idle engine right away.
+        If the busy engine started the task before receiving the abort request,
+        the task runs on both engines, and only the first result is used,
+        so only enable this if tasks can safely be run more than once.
+        """
+    )
+
+    memo_ttl = Float(0, config=True,
+        help="""How long, in seconds, the result of a task submitted with memoize=True
+        is reused for later tasks calling the same function with the same arguments.
+        0 means results do not expire."""
+    )
+    memo_bytes_limit = Integer(256 << 20, config=True,
+        help="""The maximum total size, in bytes, of the buffers of memoized results.
+        The least recently used results are evicted first."""
+    )
+
     # input arguments:
     scheme = Instance(FunctionType) # function for determining the destination
     def _scheme_default(self):
@@ -188,12 +358,13 @@ def _scheme_default(self):
     notifier_stream = Instance(zmqstream.ZMQStream) # hub-facing sub stream
     mon_stream = Instance(zmqstream.ZMQStream) # hub-facing pub stream
     query_stream = Instance(zmqstream.ZMQStream) # hub-facing DEALER stream
+    control_stream = Instance(zmqstream.ZMQStream) # DEALER stream to the engines' control queue
 
     # internals:
-    queue = Instance(deque) # sorted list of Jobs
-    def _queue_default(self):
-        return deque()
-    queue_map = Dict() # dict by msg_id of Jobs (for O(1) access to the Queue)
+    ready = Instance(ReadyQueue) # index of Jobs that are only waiting for an engine
+    def _ready_default(self):
+        return ReadyQueue()
+    queue_map = Dict() # dict by msg_id of all waiting Jobs
     graph = Dict() # dict by msg_id of [ msg_ids that depend on key ]
     retries = Dict() # dict by msg_id of retries remaining (non-neg ints)
     # waiting = List() # list of msg_ids ready to run, but haven't due to HWM
@@ -209,6 +380,19 @@ def _queue_default(self):
     all_failed = Set() # set of all failed tasks
     all_done = Set() # set of all finished tasks=union(completed,failed)
     all_ids = Set() # set of all submitted task IDs
+    functions = Dict() # dict by engine_uuid of FunctionCaches of the functions engines have
+    engine_data = Dict() # dict by engine_uuid of the names engines advertise in their namespace
+    data_index = Dict() # dict by name of the engine_uuids that have it in their namespace
+    runtimes = Dict() # dict by engine_uuid of the average runtime of tasks, in seconds
+    stolen = Dict() # dict by msg_id of the engine_uuids tasks were stolen from, until they reply
+    steal_stats = Dict() # counts of stolen tasks, by outcome
+    def _steal_stats_default(self):
+        return dict(stolen=0, aborted=0, duplicated=0)
+    memo = Instance(OrderedDict, ()) # memoized replies by memo key, least recently used first
+    memo_nbytes = Integer(0) # total size of the buffers in memo
+    memo_stats = Dict() # counts of memoized results, by what happened to them
+    def _memo_stats_default(self):
+        return dict(stored=0, hits=0, expired=0, evicted=0)
 
     ident = CBytes() # ZMQ identity. This should just be self.session.session
                      # but ensure Bytes
@@ -227,6 +411,9 @@ def start(self):
             unregistration_notification = self._unregister_engine
         )
         self.notifier_stream.on_recv(self.dispatch_notification)
+        if self.control_stream is not None:
+            # abort replies aren't needed, the aborted tasks' replies confirm steals
+            self.control_stream.on_recv(lambda msg: None)
         self.log.info("Scheduler started [%s]" % self.scheme_name)
 
     def resume_receiving(self):
@@ -296,6 +483,7 @@ def _register_engine(self, uid):
         self.completed[uid] = set()
         self.failed[uid] = set()
         self.pending[uid] = {}
+        self.functions[uid] = FunctionCache()
 
         # rescan the graph:
         self.update_graph(None)
@@ -317,6 +505,10 @@ def _unregister_engine(self, uid):
         idx = self.targets.index(uid)
         self.targets.pop(idx)
         self.loads.pop(idx)
+        self.functions.pop(uid, None)
+        self.runtimes.pop(uid, None)
+        self.update_data_index(uid, removed=list(self.engine_data.get(uid, ())))
+        self.engine_data.pop(uid)
 
         # wait 5 seconds before cleaning up pending jobs, since the results might
         # still be incoming
@@ -339,7 +531,7 @@ def handle_stranded_tasks(self, engine):
 
             raw_msg = lost[msg_id].raw_msg
             idents,msg = self.session.feed_identities(raw_msg, copy=False)
-            parent = self.session.unpack(msg[1].bytes)
+            parent = self.session.unpack_header(msg[1].bytes)
             idents = [engine, idents[0]]
 
             # build fake error reply
@@ -384,6 +576,51 @@ def dispatch_submission(self, raw_msg):
         # send to monitor
         self.mon_stream.send_multipart([b'intask']+raw_msg, copy=False)
 
+        if msg['header']['msg_type'] == 'batch_apply_request':
+            self.dispatch_batch(idents, msg)
+        else:
+            self.queue_submission(idents, msg, raw_msg)
+
+
+    def _time_dependency(self, after):
+        """Build a time Dependency from its metadata, without the msg_ids that are
+        already done, or MET if it is met already."""
+        if not after:
+            return MET
+        after = Dependency(after)
+        if after.all:
+            if after.success:
+                after = Dependency(after.difference(self.all_completed),
+                            success=after.success,
+                            failure=after.failure,
+                            all=after.all,
+                )
+            if after.failure:
+                after = Dependency(after.difference(self.all_failed),
+                            success=after.success,
+                            failure=after.failure,
+                            all=after.all,
+                )
+        if after.check(self.all_completed, self.all_failed):
+            # recast as empty set, if `after` already met,
+            # to prevent unnecessary set comparisons
+            after = MET
+        return after
+
+    def dispatch_batch(self, idents, msg):
+        """Unpack a batch_apply_request into its tasks, and queue each one.
+
+        Each task is re-signed as an individual apply_request,
+        sharing the frame of the function buffer.
+        """
+        msg['content'] = self.session.unpack(msg['content'])
+        for task in util.split_apply_batch(msg):
+            raw_msg = list(map(zmq.Message, self.session.serialize(task, ident=idents)))
+            raw_msg.extend(task['buffers'])
+            self.queue_submission(idents, task, raw_msg)
+
+    def queue_submission(self, idents, msg, raw_msg):
+        """Create a Job for a submitted task, and run or save it."""
         header = msg['header']
         md = msg['metadata']
         msg_id = header['msg_id']
@@ -398,28 +635,12 @@ def dispatch_submission(self, raw_msg):
         self.retries[msg_id] = retries
 
         # time dependencies
-        after = md.get('after', None)
-        if after:
-            after = Dependency(after)
-            if after.all:
-                if after.success:
-                    after = Dependency(after.difference(self.all_completed),
-                                success=after.success,
-                                failure=after.failure,
-                                all=after.all,
-                    )
-                if after.failure:
-                    after = Dependency(after.difference(self.all_failed),
-                                success=after.success,
-                                failure=after.failure,
-                                all=after.all,
-                    )
-            if after.check(self.all_completed, self.all_failed):
-                # recast as empty set, if `after` already met,
-                # to prevent unnecessary set comparisons
-                after = MET
-        else:
-            after = MET
+        after = self._time_dependency(md.get('after', None))
+        # the parents of a task in a graph are required on top of its `after`,
+        # whatever the flags of that one
+        parents = self._time_dependency(md.get('parents', None))
+        if parents:
+            after = CombinedDependency([after, parents]) if after else parents
 
         # location dependencies
         follow = Dependency(md.get('follow', []))
@@ -432,6 +653,10 @@ def dispatch_submission(self, raw_msg):
                  header=header, targets=targets, after=after, follow=follow,
                  timeout=timeout, metadata=md,
         )
+        if md.get('memoize', False) and md.get('f_hash', None):
+            # without an f_hash, the function may be looked up in the engine's namespace,
+            # so the same message can stand for different functions
+            job.memo_key = self.task_hash(job)
         # validate and reduce dependencies:
         for dep in after,follow:
             if not dep: # empty dependency
@@ -482,9 +707,10 @@ def fail_unreachable(self, msg_id, why=error.ImpossibleDependency):
         job = self.queue_map.pop(msg_id)
         # lazy-delete from the queue
         job.removed = True
+        self.ready.discard(job)
         for mid in job.dependents:
             if mid in self.graph:
-                self.graph[mid].remove(msg_id)
+                self.graph[mid].discard(msg_id)
 
         try:
             raise why()
@@ -511,11 +737,17 @@ def available_engines(self):
                 available.append(idx)
         return available
 
-    def maybe_run(self, job):
-        """check location dependencies, and run if they are met."""
+    def maybe_run(self, job, available=None):
+        """check location dependencies, and run if they are met.
+
+        `available` may be passed to reuse a result of available_engines().
+        """
         msg_id = job.msg_id
+        if job.memo_key is not None and self.reply_memoized(job):
+            return True
         self.log.debug("Attempting to assign task %s", msg_id)
-        available = self.available_engines()
+        if available is None:
+            available = self.available_engines()
         if not available:
             # no engines, definitely can't run
             return False
@@ -566,19 +798,110 @@ def can_run(idx):
             indices = None
 
         self.submit_task(job, indices)
+        self._dequeue(job)
         return True
 
+    def _dequeue(self, job):
+        """Remove a job that is no longer waiting from the queue."""
+        msg_id = job.msg_id
+        if self.queue_map.pop(msg_id, None) is not None:
+            self.ready.discard(job)
+            for mid in job.dependents:
+                if mid in self.graph:
+                    self.graph[mid].discard(msg_id)
+
+    #-----------------------------------------------------------------------
+    # Memoization
+    #-----------------------------------------------------------------------
+
+    def task_hash(self, job):
+        """The memo key of a task: a hash of its function and arguments.
+
+        The function is identified by its f_hash,
+        so the key is the same whether or not the client omitted the function.
+        """
+        # idents, DELIM, signature, header, parent, metadata, content, f, args...
+        f_idx = len(job.idents) + 6
+        h = hashlib.sha1(cast_bytes(job.metadata.get('f_hash', '')))
+        for buf in job.raw_msg[f_idx+1:]:
+            h.update(memoryview(buf))
+        return h.hexdigest()
+
+    def reply_memoized(self, job):
+        """Reply to a task with a memoized result, instead of running it.
+
+        Returns whether there was a live result for the task's memo key.
+        """
+        entry = self.memo.pop(job.memo_key, None)
+        if entry is None:
+            return False
+        stored, content, md, buffers = entry
+        if self.memo_ttl and time.time() - stored > self.memo_ttl:
+            self.memo_nbytes -= sum(map(len, buffers))
+            self.memo_stats['expired'] += 1
+            return False
+        # move to the end of the LRU order
+        self.memo[job.memo_key] = entry
+        self.memo_stats['hits'] += 1
+
+        msg_id = job.msg_id
+        self.log.debug("task %r answered from memo %s", msg_id, job.memo_key)
+        self._dequeue(job)
+        self.retries.pop(msg_id, None)
+        self.all_done.add(msg_id)
+        self.all_completed.add(msg_id)
+        # the task counts as run on the engine that computed the result,
+        # which may have unregistered since
+        engine = cast_bytes(md['engine'])
+        if engine in self.completed:
+            self.completed[engine].add(msg_id)
+        self.destinations[msg_id] = engine
+
+        msg = self.session.send(self.client_stream, 'apply_reply', content,
+            parent=job.header, ident=job.idents, metadata=dict(md, memoized=True),
+            buffers=buffers,
+        )
+        self.session.send(self.mon_stream, msg, ident=[b'outtask']+job.idents)
+        self.update_graph(msg_id, success=True)
+        return True
+
+    def memoize_result(self, job, idents, msg, raw_msg):
+        """Store the successful reply to a task submitted with memoize=True."""
+        # idents, DELIM, signature, header, parent, metadata, content, buffers...
+        content_idx = len(idents) + 5
+        content = self.session.unpack(raw_msg[content_idx].bytes)
+        buffers = [ buf.bytes for buf in raw_msg[content_idx+1:] ]
+        nbytes = sum(map(len, buffers))
+        if nbytes > self.memo_bytes_limit:
+            return
+        old = self.memo.pop(job.memo_key, None)
+        if old is not None:
+            self.memo_nbytes -= sum(map(len, old[3]))
+        md = dict(msg['metadata'])
+        # the function cache of the engine is its own business
+        for key in ('function_cached', 'function_resent'):
+            md.pop(key, None)
+        self.memo[job.memo_key] = (time.time(), content, md, buffers)
+        self.memo_nbytes += nbytes
+        self.memo_stats['stored'] += 1
+        while self.memo_nbytes > self.memo_bytes_limit:
+            key, entry = self.memo.popitem(last=False)
+            self.memo_nbytes -= sum(map(len, entry[3]))
+            self.memo_stats['evicted'] += 1
+
     def save_unmet(self, job):
         """Save a message for later submission when its dependencies are met."""
         msg_id = job.msg_id
         self.log.debug("Adding task %s to the queue", msg_id)
         self.queue_map[msg_id] = job
-        self.queue.append(job)
         # track the ids in follow or after, but not those already finished
         for dep_id in job.after.union(job.follow).difference(self.all_done):
             if dep_id not in self.graph:
                 self.graph[dep_id] = set()
             self.graph[dep_id].add(msg_id)
+        if job.after.check(self.all_completed, self.all_failed):
+            # only waiting for an engine
+            self.ready.add(job)
         
         # schedule timeout callback
         if job.timeout:
@@ -590,7 +913,12 @@ def save_unmet(self, job):
 
     def submit_task(self, job, indices=None):
         """Submit a task to any of a subset of our targets."""
-        if indices:
+        data = job.metadata.get('data', None)
+        if data:
+            indices = self.local_indices(data, indices)
+        if getattr(self.scheme, 'uses_runtimes', False):
+            loads = self.expected_times(indices or None)
+        elif indices:
             loads = [self.loads[i] for i in indices]
         else:
             loads = self.loads
@@ -601,16 +929,76 @@ def submit_task(self, job, indices=None):
         # print (target, map(str, msg[:3]))
         # send job to the engine
         self.engine_stream.send(target, flags=zmq.SNDMORE, copy=False)
-        self.engine_stream.send_multipart(job.raw_msg, copy=False)
+        self.engine_stream.send_multipart(self._omit_function(job, target), copy=False)
         # update load
         self.add_job(idx)
         self.pending[target][job.msg_id] = job
-        # notify Hub
-        content = dict(msg_id=job.msg_id, engine_id=target.decode('ascii'))
+        # notify Hub, with when the job was queued and dispatched
+        content = dict(msg_id=job.msg_id, engine_id=target.decode('ascii'),
+            queued=datetime.fromtimestamp(job.timestamp), dispatched=datetime.now(),
+        )
         self.session.send(self.mon_stream, 'task_destination', content=content,
                         ident=[b'tracktask',self.ident])
 
 
+    def local_indices(self, names, indices=None):
+        """Narrow `indices` (default: all targets) to the engines with the most of `names`
+        in their namespace.
+
+        Returns `indices` unchanged if none of those engines have any of them.
+        """
+        counts = {}
+        for name in names:
+            for engine in self.data_index.get(name, ()):
+                counts[engine] = counts.get(engine, 0) + 1
+        if not counts:
+            return indices
+        candidates = range(len(self.targets)) if indices is None else indices
+        best = 0
+        local = []
+        for idx in candidates:
+            n = counts.get(self.targets[idx], 0)
+            if n > best:
+                best = n
+                local = [idx]
+            elif n and n == best:
+                local.append(idx)
+        return local or indices
+
+    def update_data_index(self, engine, added=(), removed=()):
+        """Record names added to and removed from the namespace of an engine."""
+        names = self.engine_data.setdefault(engine, set())
+        for name in removed:
+            names.discard(name)
+            engines = self.data_index.get(name)
+            if engines is not None:
+                engines.discard(engine)
+                if not engines:
+                    del self.data_index[name]
+        for name in added:
+            names.add(name)
+            self.data_index.setdefault(name, set()).add(engine)
+
+    def set_data_names(self, engine, names):
+        """Replace the names an engine advertises in its namespace."""
+        names = set(names)
+        old = self.engine_data.get(engine, set())
+        self.update_data_index(engine, added=names - old, removed=old - names)
+
+    def _omit_function(self, job, target):
+        """Return job.raw_msg, without the function if target has it cached.
+
+        Buffers are not part of the signature, so the message remains valid.
+        """
+        f_hash = job.metadata.get('f_hash', None)
+        if not f_hash or f_hash not in self.functions[target]:
+            return job.raw_msg
+        # idents, DELIM, signature, header, parent, metadata, content, f, ...
+        f_idx = len(job.idents) + 6
+        raw_msg = list(job.raw_msg)
+        raw_msg[f_idx] = b''
+        return raw_msg
+
     #-----------------------------------------------------------------------
     # Result Handling
     #-----------------------------------------------------------------------
@@ -635,7 +1023,20 @@ def dispatch_result(self, raw_msg):
 
         md = msg['metadata']
         parent = msg['parent_header']
-        if md.get('dependencies_met', True):
+        data_names = md.get('data_names', None)
+        if data_names is not None and engine in self.targets:
+            self.set_data_names(engine, data_names)
+        if parent['msg_id'] not in self.pending.get(engine, {}):
+            if self.handle_stolen_reply(idents, parent, md):
+                # the engine may have a free slot now
+                self.update_graph(None)
+                return
+        if md.get('function_cached', False) and engine in self.functions:
+            self.functions[engine][md['f_hash']] = True
+        if md.get('function_cache_miss', False):
+            self.handle_function_cache_miss(idents, parent, raw_msg, md['f_hash'])
+        elif md.get('dependencies_met', True):
+            self.record_runtime(engine, msg)
             success = (md['status'] == 'ok')
             msg_id = parent['msg_id']
             retries = self.retries[msg_id]
@@ -645,6 +1046,9 @@ def dispatch_result(self, raw_msg):
                 self.handle_unmet_dependency(idents, parent)
             else:
                 del self.retries[msg_id]
+                job = self.pending[engine].get(msg_id)
+                if success and job is not None and job.memo_key is not None:
+                    self.memoize_result(job, idents, msg, raw_msg)
                 # relay to client and update graph
                 self.handle_result(idents, parent, raw_msg, success)
                 # send to Hub monitor
@@ -652,6 +1056,109 @@ def dispatch_result(self, raw_msg):
         else:
             self.handle_unmet_dependency(idents, parent)
 
+    def handle_stolen_reply(self, idents, parent, md):
+        """Handle a reply to a task that is no longer pending on the replying engine.
+
+        That is either the engine a task was stolen from, or an engine whose result
+        came second.  Returns whether the reply was dropped.
+        If the engine the task was stolen from ran it anyway, and its result
+        is the first, it replaces the job on the engine the task was sent to,
+        and the later reply from there is dropped.
+        """
+        engine = idents[0]
+        msg_id = parent['msg_id']
+        if self.stolen.get(msg_id) != engine:
+            # the second result of a task that ran on both engines
+            self.log.debug("task::dropping duplicate result of %r from %r", msg_id, engine)
+            return True
+        del self.stolen[msg_id]
+        if md.get('status') == 'aborted' or md.get('function_cache_miss', False) \
+                or not md.get('dependencies_met', True):
+            # the task didn't run, the steal succeeded
+            self.steal_stats['aborted'] += 1
+            return True
+        self.steal_stats['duplicated'] += 1
+        self.log.warn("task::stolen task %r ran on %r anyway", msg_id, engine)
+        for thief, pending in self.pending.items():
+            if msg_id in pending:
+                # this result is first, take the job back from the thief
+                self.pending.setdefault(engine, {})[msg_id] = pending.pop(msg_id)
+                return False
+        # already finished on the thief
+        return True
+
+    def steal_jobs(self):
+        """Reassign jobs waiting on busy engines to idle engines.
+
+        The newest job behind at least one other on the engine with the most
+        assigned jobs is sent to the least recently used idle engine that can run it,
+        and the busy engine is asked to abort it.
+        """
+        if not self.work_stealing or self.control_stream is None:
+            return
+        while True:
+            idle = [ self.targets[idx] for idx, load in enumerate(self.loads) if load == 0 ]
+            if not idle:
+                return
+            busy = [ t for t in self.targets if len(self.pending[t]) > 1 ]
+            if not busy:
+                return
+            victim = max(busy, key=lambda t: len(self.pending[t]))
+            # the oldest job is probably running
+            for job in sorted(self.pending[victim].values())[:0:-1]:
+                if job.follow:
+                    continue
+                thieves = [ t for t in idle if t not in job.blacklist
+                            and (not job.targets or t in job.targets) ]
+                if thieves:
+                    break
+            else:
+                return
+            thief = thieves[0]
+            msg_id = job.msg_id
+            self.log.debug("task::stealing %r from %r for %r", msg_id, victim, thief)
+            self.session.send(self.control_stream, 'abort_request',
+                content=dict(msg_ids=[msg_id]), ident=victim)
+            self.pending[victim].pop(msg_id)
+            self.stolen[msg_id] = victim
+            self.steal_stats['stolen'] += 1
+            self.submit_task(job, [self.targets.index(thief)])
+
+    def record_runtime(self, engine, msg):
+        """Update the average runtime of tasks on engine with that of a finished task."""
+        if engine not in self.functions:
+            # dead engine
+            return
+        started = extract_dates(msg['metadata'].get('started', None))
+        completed = msg['header'].get('date', None)
+        if not isinstance(started, datetime) or not isinstance(completed, datetime):
+            return
+        delta = completed - started
+        runtime = max(delta.days * 86400 + delta.seconds + delta.microseconds * 1e-6, 0)
+        if engine in self.runtimes:
+            decay = self.runtime_decay
+            runtime = decay * runtime + (1 - decay) * self.runtimes[engine]
+        self.runtimes[engine] = runtime
+
+    def expected_times(self, indices=None):
+        """Return the expected time for each engine in indices to complete a new task.
+
+        That is the average runtime on the engine times the number of tasks it
+        would have, including the new one.  Engines without observed runtimes
+        are assumed to be as fast as the average engine.  Without any observations,
+        the loads themselves are returned.
+        """
+        if indices is None:
+            indices = range(len(self.targets))
+        if not self.runtimes:
+            return [ self.loads[idx] for idx in indices ]
+        default = sum(self.runtimes.values()) / len(self.runtimes)
+        times = []
+        for idx in indices:
+            runtime = self.runtimes.get(self.targets[idx], default)
+            times.append((self.loads[idx] + 1) * runtime)
+        return times
+
     def handle_result(self, idents, parent, raw_msg, success=True):
         """handle a real task result, either success or failure"""
         # first, relay result to client
@@ -675,6 +1182,37 @@ def handle_result(self, idents, parent, raw_msg, success=True):
 
         self.update_graph(msg_id, success)
 
+    def handle_function_cache_miss(self, idents, parent, raw_msg, f_hash):
+        """The engine didn't have a function we omitted, send the task again in full."""
+        engine = idents[0]
+        msg_id = parent['msg_id']
+        if engine in self.functions:
+            self.functions[engine].discard(f_hash)
+        job = self.pending[engine][msg_id]
+        f_idx = len(job.idents) + 6
+        if not len(job.raw_msg[f_idx]):
+            # the request itself didn't have the function (e.g. a resubmitted record),
+            # so this is a real failure
+            self.mon_stream.send_multipart([b'outtask']+raw_msg, copy=False)
+            self.retries.pop(msg_id, None)
+            self.handle_result(idents, parent, raw_msg, success=False)
+            return
+        self.log.debug("task::function %s evicted on %r, resending %r", f_hash, engine, msg_id)
+        self.pending[engine].pop(msg_id)
+        # re-sign with new metadata, or the engine would reject the resent message as a replay
+        msg = dict(job.msg)
+        job.metadata = msg['metadata'] = dict(job.metadata,
+            function_resent=job.metadata.get('function_resent', 0) + 1,
+        )
+        msg['content'] = job.raw_msg[f_idx-1].bytes
+        raw_msg = self.session.serialize(msg, ident=job.idents)
+        job.raw_msg = list(map(zmq.Message, raw_msg)) + job.raw_msg[f_idx:]
+        if engine in self.targets:
+            # the engine is still idle, keep the job there
+            self.submit_task(job, [self.targets.index(engine)])
+        elif not self.maybe_run(job):
+            self.save_unmet(job)
+
     def handle_unmet_dependency(self, idents, parent):
         """handle an unmet dependency"""
         engine = idents[0]
@@ -707,67 +1245,64 @@ def update_graph(self, dep_id=None, success=True):
 
         Called with dep_id=None to update entire graph for hwm, but without finishing a task.
         """
-        # print ("\n\n***********")
-        # pprint (dep_id)
-        # pprint (self.graph)
-        # pprint (self.queue_map)
-        # pprint (self.all_completed)
-        # pprint (self.all_failed)
-        # print ("\n\n***********\n\n")
         # update any jobs that depended on the dependency
         msg_ids = self.graph.pop(dep_id, [])
+        jobs = sorted( self.queue_map[msg_id] for msg_id in msg_ids )
 
-        # recheck *all* jobs if
-        # a) we have HWM and an engine just become no longer full
-        # or b) dep_id was given as None
-        
-        if dep_id is None or self.hwm and any( [ load==self.hwm-1 for load in self.loads ]):
-            jobs = self.queue
-            using_queue = True
-        else:
-            using_queue = False
-            jobs = deque(sorted( self.queue_map[msg_id] for msg_id in msg_ids ))
-        
-        to_restore = []
-        while jobs:
-            job = jobs.popleft()
+        for job in jobs:
             if job.removed:
                 continue
             msg_id = job.msg_id
-            
-            put_it_back = True
-            
+
             if job.after.unreachable(self.all_completed, self.all_failed)\
                     or job.follow.unreachable(self.all_completed, self.all_failed):
                 self.fail_unreachable(msg_id)
-                put_it_back = False
 
             elif job.after.check(self.all_completed, self.all_failed): # time deps met, maybe run
-                if self.maybe_run(job):
-                    put_it_back = False
-                    self.queue_map.pop(msg_id)
-                    for mid in job.dependents:
-                        if mid in self.graph:
-                            self.graph[mid].remove(msg_id)
-                    
-                    # abort the loop if we just filled up all of our engines.
-                    # avoids an O(N) operation in situation of full queue,
-                    # where graph update is triggered as soon as an engine becomes
-                    # non-full, and all tasks after the first are checked,
-                    # even though they can't run.
-                    if not self.available_engines():
-                        break
-            
-            if using_queue and put_it_back:
-                # popped a job from the queue but it neither ran nor failed,
-                # so we need to put it back when we are done
-                # make sure to_restore preserves the same ordering
-                to_restore.append(job)
-        
-        # put back any tasks we popped but didn't run
-        if using_queue:
-            self.queue.extendleft(to_restore)
-    
+                if not self.maybe_run(job) and msg_id in self.queue_map:
+                    # only waiting for an engine now
+                    self.ready.add(job)
+
+        # assign waiting jobs if
+        # a) we have HWM and an engine just become no longer full
+        # or b) dep_id was given as None
+        if dep_id is None or self.hwm and any( [ load==self.hwm-1 for load in self.loads ]):
+            self.dispatch_ready()
+        self.steal_jobs()
+
+    def dispatch_ready(self):
+        """Assign jobs that are only waiting for an engine to engines with free slots.
+
+        The oldest unrestricted or targeted job for an available engine is taken
+        from the ready index, so each assignment is O(log N) in the number of waiting jobs,
+        rather than a rescan of the whole queue.
+        Jobs with location dependencies or blacklists are then checked individually.
+        """
+        if not self.ready:
+            return
+        skipped = []
+        while True:
+            available = self.available_engines()
+            if not available:
+                break
+            job = self.ready.oldest([ self.targets[idx] for idx in available ])
+            if job is None:
+                break
+            self.ready.discard(job)
+            if not self.maybe_run(job, available) and job.msg_id in self.queue_map:
+                skipped.append(job)
+        # put back any tasks we popped but couldn't run
+        for job in skipped:
+            self.ready.add(job)
+
+        for job in self.ready.restricted_jobs():
+            available = self.available_engines()
+            if not available:
+                break
+            if job.ready_token is not None:
+                # may have been failed by a previous job
+                self.maybe_run(job, available)
+
     #----------------------------------------------------------------------
     # methods to be overridden by subclasses
     #----------------------------------------------------------------------
@@ -790,7 +1325,7 @@ def finish_job(self, idx):
 
 def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, reg_addr, config=None,
                         logname='root', log_url=None, loglevel=logging.DEBUG,
-                        identity=b'task', in_thread=False):
+                        identity=b'task', in_thread=False, ctl_addr=None):
 
     ZMQStream = zmqstream.ZMQStream
 
@@ -825,6 +1360,13 @@ def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, reg_addr, config=Non
     
     querys = ZMQStream(ctx.socket(zmq.DEALER),loop)
     querys.connect(reg_addr)
+
+    if ctl_addr:
+        ctls = ZMQStream(ctx.socket(zmq.DEALER),loop)
+        ctls.setsockopt(zmq.IDENTITY, identity + b'_control')
+        ctls.connect(ctl_addr)
+    else:
+        ctls = None
     
     # setup logging.
     if in_thread:
@@ -837,7 +1379,7 @@ def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, reg_addr, config=Non
 
     scheduler = TaskScheduler(client_stream=ins, engine_stream=outs,
                             mon_stream=mons, notifier_stream=nots,
-                            query_stream=querys,
+                            query_stream=querys, control_stream=ctls,
                             loop=loop, log=log,
                             config=config)
     scheduler.start()
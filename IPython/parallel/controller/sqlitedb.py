@@ -3,8 +3,14 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+import atexit
+import hashlib
 import json
+import mmap
 import os
+import threading
+from collections import OrderedDict
+from copy import deepcopy
 try:
     import cPickle as pickle
 except ImportError:
@@ -18,7 +24,7 @@
 
 from zmq.eventloop import ioloop
 
-from IPython.utils.traitlets import Unicode, Instance, List, Dict
+from IPython.utils.traitlets import Unicode, Instance, List, Dict, Bool, Float, Integer
 from .dictdb import BaseDB
 from IPython.utils.jsonutil import date_default, extract_dates, squash_dates
 from IPython.utils.py3compat import iteritems
@@ -77,8 +83,85 @@ def _adapt_bufs(bufs):
 def _convert_bufs(bs):
     if bs is None:
         return []
+    bs = bytes(bs)
+    if bs.startswith(_REFS):
+        return BufferRefs(bs[len(_REFS):].decode('ascii').split(','))
     else:
-        return pickle.loads(bytes(bs))
+        return pickle.loads(bs)
+
+def _adapt_refs(refs):
+    return sqlite3.Binary(_REFS + ','.join(refs).encode('ascii'))
+
+# prefix of buffers columns that refer to the BufferStore,
+# which can't be the start of a pickle
+_REFS = b'refs:'
+
+
+class BufferRefs(list):
+    """The list of digests of a record's buffers in a BufferStore"""
+    pass
+
+
+class BufferStore(object):
+    """A content-addressed store of buffers, one file per buffer.
+
+    Buffers are memory-mapped when they are loaded,
+    so they are only read from disk when they are used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put(self, buf):
+        """Store a buffer, and return its digest."""
+        digest = hashlib.sha1(buf).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            d = os.path.dirname(path)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            tmp = '%s.%i.tmp' % (path, threading.current_thread().ident)
+            with open(tmp, 'wb') as f:
+                f.write(buf)
+            os.rename(tmp, path)
+        return digest
+
+    def get(self, digest):
+        """Load a buffer, by digest."""
+        with open(self._path(digest), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def sweep(self, keep):
+        """Remove all buffers whose digests are not in keep."""
+        if not os.path.isdir(self.path):
+            return
+        for d in os.listdir(self.path):
+            for name in os.listdir(os.path.join(self.path, d)):
+                if d + name not in keep:
+                    try:
+                        os.remove(os.path.join(self.path, d, name))
+                    except OSError:
+                        # e.g. still mapped, on Windows
+                        pass
+
+def _copy_record(rec):
+    """Copy a record, so changes to the copy don't affect the original.
+
+    Buffers aren't copied.
+    """
+    copy = {}
+    for key, value in iteritems(rec):
+        if isinstance(value, dict):
+            value = deepcopy(value)
+        elif isinstance(value, list):
+            value = list(value)
+        copy[key] = value
+    return copy
 
 #-----------------------------------------------------------------------------
 # SQLiteDB class
@@ -97,6 +180,27 @@ class SQLiteDB(BaseDB):
         a new table will be created with the Hub's IDENT.  Specifying the table will result
         in tasks from previous sessions being available via Clients' db_query and
         get_result methods.""")
+    buffer_threshold = Integer(65536, config=True,
+        help="""The total size (in bytes) of the argument or result buffers of a task
+        at which they are stored in files next to the database, rather than in the table.
+        Only references are kept in the table, so queries don't have to read them,
+        and they are memory-mapped when they are loaded.
+        Set to 0 to store all buffers in the table.""")
+    journal_mode = Unicode(config=True,
+        help="""The SQLite journal mode (e.g. 'WAL', 'DELETE').
+        The default is 'WAL' when batch_writes is enabled, and sqlite's own default otherwise.
+        WAL should not be used if the database is on a network filesystem.""")
+    def _journal_mode_default(self):
+        return u'WAL' if self.batch_writes else u''
+
+    batch_writes = Bool(False, config=True,
+        help="""Queue additions, updates, and removals of records, and write them to the database
+        in batches from a background thread, instead of on the Hub's event loop.
+        Several updates to the same record are combined into one write,
+        and lookups of records with queued writes are answered from the queue.""")
+    batch_interval = Float(0.1, config=True,
+        help="""The maximum time (in seconds) queued writes wait before they are
+        committed, when batch_writes is enabled.""")
 
     if sqlite3 is not None:
         _db = Instance('sqlite3.Connection')
@@ -170,13 +274,27 @@ def __init__(self, **kwargs):
             else:
                 self.location = u'.'
         self._init_db()
-
-        # register db commit as 2s periodic callback
-        # to prevent clogging pipes
-        # assumes we are being run in a zmq ioloop app
-        loop = ioloop.IOLoop.instance()
-        pc = ioloop.PeriodicCallback(self._db.commit, 2000, loop)
-        pc.start()
+        self._update_sql = {}
+        self._pending = OrderedDict()
+        self._inflight = {}
+        self._closed = False
+        self._commit_callback = None
+
+        if self.batch_writes:
+            self._waiters = 0
+            self._cond = threading.Condition()
+            self._writer = threading.Thread(target=self._write_loop)
+            self._writer.daemon = True
+            self._writer.start()
+            # write what's still queued on exit
+            atexit.register(self.close)
+        else:
+            # register db commit as 2s periodic callback
+            # to prevent clogging pipes
+            # assumes we are being run in a zmq ioloop app
+            loop = ioloop.IOLoop.instance()
+            self._commit_callback = ioloop.PeriodicCallback(self._db.commit, 2000, loop)
+            self._commit_callback.start()
 
     def _defaults(self, keys=None):
         """create an empty record"""
@@ -220,12 +338,11 @@ def _init_db(self):
         sqlite3.register_converter('dict', _convert_dict)
         sqlite3.register_adapter(list, _adapt_bufs)
         sqlite3.register_converter('bufs', _convert_bufs)
+        sqlite3.register_adapter(BufferRefs, _adapt_refs)
         # connect to the db
-        dbfile = os.path.join(self.location, self.filename)
-        self._db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES,
-            # isolation_level = None)#,
-             cached_statements=64)
-        # print dir(self._db)
+        self._db = self._connect()
+        if self.journal_mode:
+            self._db.execute("PRAGMA journal_mode=%s" % self.journal_mode)
         first_table = previous_table = self.table
         i=0
         while not self._check_table():
@@ -261,11 +378,33 @@ def _init_db(self):
                 stdout text,
                 stderr text)
                 """%self.table)
+        for key in ('submitted', 'engine_uuid', 'client_uuid'):
+            self._db.execute("""CREATE INDEX IF NOT EXISTS '%s_%s' ON '%s' (%s)"""
+                % (self.table, key, self.table, key))
         self._db.commit()
+        self._buffer_store = BufferStore(
+            os.path.join(self.location, self.filename + '-buffers', self.table))
+        self._insert_sql = "INSERT INTO '%s' VALUES (%s)" % (
+            self.table, ','.join(['?'] * len(self._keys)))
+
+    def _connect(self):
+        dbfile = os.path.join(self.location, self.filename)
+        return sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES,
+             cached_statements=64)
+
+    def _get_update_sql(self, keys):
+        """The UPDATE statement for a sorted tuple of keys"""
+        try:
+            return self._update_sql[keys]
+        except KeyError:
+            sets = ', '.join([ '%s = ?' % key for key in keys ])
+            sql = self._update_sql[keys] = "UPDATE '%s' SET %s WHERE msg_id == ?" % (
+                self.table, sets)
+            return sql
 
     def _dict_to_list(self, d):
         """turn a mongodb-style record dict into a list."""
-
+        d = self._store_buffers(d)
         return [ d[key] for key in self._keys ]
 
     def _list_to_dict(self, line, keys=None):
@@ -273,10 +412,39 @@ def _list_to_dict(self, line, keys=None):
         keys = self._keys if keys is None else keys
         d = self._defaults(keys)
         for key,value in zip(keys, line):
+            if isinstance(value, BufferRefs):
+                value = [ self._buffer_store.get(digest) for digest in value ]
             d[key] = value
 
         return d
 
+    def _store_buffers(self, rec):
+        """Move large buffers in a record (or update) to the buffer store.
+
+        Returns the record with references in place of the stored buffers.
+        """
+        if self.buffer_threshold <= 0:
+            return rec
+        for key in ('buffers', 'result_buffers'):
+            bufs = rec.get(key)
+            if not bufs or isinstance(bufs, BufferRefs):
+                continue
+            if sum(len(buf) for buf in bufs) >= self.buffer_threshold:
+                rec = dict(rec)
+                rec[key] = BufferRefs(self._buffer_store.put(buf) for buf in bufs)
+        return rec
+
+    def _sweep_buffers(self):
+        """Remove buffers that are no longer referred to by any record."""
+        keep = set()
+        for key in ('buffers', 'result_buffers'):
+            # substr has no declared type, so the refs aren't converted
+            cursor = self._db.execute("SELECT substr(%s, %i) FROM '%s' WHERE substr(%s, 1, %i) == ?"
+                % (key, len(_REFS) + 1, self.table, key, len(_REFS)), (sqlite3.Binary(_REFS),))
+            for (refs,) in cursor:
+                keep.update(bytes(refs).decode('ascii').split(','))
+        self._buffer_store.sweep(keep)
+
     def _render_expression(self, check):
         """Turn a mongodb-style search dict into an SQL query."""
         expressions = []
@@ -322,41 +490,84 @@ def _render_expression(self, check):
         expr = " AND ".join(expressions)
         return expr, args
 
-    def add_record(self, msg_id, rec):
-        """Add a new Task Record, by msg_id."""
+    def _full_record(self, msg_id, rec):
         d = self._defaults()
         d.update(rec)
         d['msg_id'] = msg_id
-        line = self._dict_to_list(d)
-        tups = '(%s)'%(','.join(['?']*len(line)))
-        self._db.execute("INSERT INTO '%s' VALUES %s"%(self.table, tups), line)
+        return d
+
+    def add_record(self, msg_id, rec):
+        """Add a new Task Record, by msg_id."""
+        if self.batch_writes:
+            return self.add_records([dict(rec, msg_id=msg_id)])
+        line = self._dict_to_list(self._full_record(msg_id, rec))
+        self._db.execute(self._insert_sql, line)
         # self._db.commit()
 
+    def add_records(self, records):
+        """Add several new Task Records, with a single executemany."""
+        if self.batch_writes:
+            with self._cond:
+                for rec in records:
+                    if self._queued(rec['msg_id'])[0]:
+                        raise KeyError("Already have msg_id %r" % rec['msg_id'])
+                for rec in records:
+                    msg_id = rec['msg_id']
+                    queued = self._pending.get(msg_id)
+                    if queued is not None and queued[0] == 'delete':
+                        op = 'replace'
+                    else:
+                        op = 'insert'
+                    self._pending[msg_id] = (op, self._full_record(msg_id, rec))
+            return
+        lines = [ self._dict_to_list(self._full_record(rec['msg_id'], rec))
+                    for rec in records ]
+        if not lines:
+            return
+        self._db.executemany(self._insert_sql, lines)
+
     def get_record(self, msg_id):
         """Get a specific Task Record, by msg_id."""
+        updates = None
+        if self.batch_writes:
+            with self._cond:
+                record, updates = self._queued(msg_id)
+            if record is False:
+                raise KeyError("No such msg: %r"%msg_id)
+            elif record:
+                return _copy_record(record)
         cursor = self._db.execute("""SELECT * FROM '%s' WHERE msg_id==?"""%self.table, (msg_id,))
         line = cursor.fetchone()
         if line is None:
             raise KeyError("No such msg: %r"%msg_id)
-        return self._list_to_dict(line)
+        rec = self._list_to_dict(line)
+        if updates:
+            rec.update(_copy_record(updates))
+        return rec
 
     def update_record(self, msg_id, rec):
         """Update the data in an existing record."""
-        query = "UPDATE '%s' SET "%self.table
-        sets = []
-        keys = sorted(rec.keys())
-        values = []
-        for key in keys:
-            sets.append('%s = ?'%key)
-            values.append(rec[key])
-        query += ', '.join(sets)
-        query += ' WHERE msg_id == ?'
+        if self.batch_writes:
+            with self._cond:
+                queued = self._pending.get(msg_id)
+                if queued is None:
+                    self._pending[msg_id] = ('update', dict(rec))
+                elif queued[0] != 'delete':
+                    queued[1].update(rec)
+            return
+        rec = self._store_buffers(rec)
+        keys = tuple(sorted(rec.keys()))
+        values = [ rec[key] for key in keys ]
         values.append(msg_id)
-        self._db.execute(query, values)
+        self._db.execute(self._get_update_sql(keys), values)
         # self._db.commit()
 
     def drop_record(self, msg_id):
         """Remove a record from the DB."""
+        if self.batch_writes:
+            with self._cond:
+                self._pending[msg_id] = ('delete', None)
+            return
         self._db.execute("""DELETE FROM '%s' WHERE msg_id==?"""%self.table, (msg_id,))
         # self._db.commit()
 
@@ -364,8 +575,12 @@ def drop_matching_records(self, check):
         """Remove a record from the DB."""
         expr,args = self._render_expression(check)
         query = "DELETE FROM '%s' WHERE %s"%(self.table, expr)
+        self.flush()
         self._db.execute(query,args)
-        # self._db.commit()
+        if self.batch_writes:
+            # don't hold the lock the writer thread needs
+            self._db.commit()
+        self._sweep_buffers()
 
     def find_records(self, check, keys=None):
         """Find records matching a query dict, optionally extracting subset of keys.
@@ -396,6 +611,7 @@ def find_records(self, check, keys=None):
             req = '*'
         expr,args = self._render_expression(check)
         query = """SELECT %s FROM '%s' WHERE %s"""%(req, self.table, expr)
+        self.flush()
         cursor = self._db.execute(query, args)
         matches = cursor.fetchall()
         records = []
@@ -407,8 +623,148 @@ def find_records(self, check, keys=None):
     def get_history(self):
         """get all msg_ids, ordered by time submitted."""
         query = """SELECT msg_id FROM '%s' ORDER by submitted ASC"""%self.table
+        self.flush()
         cursor = self._db.execute(query)
         # will be a list of length 1 tuples
         return [ tup[0] for tup in cursor.fetchall()]
 
+    #-------------------------------------------------------------------------
+    # Batched writes
+    #-------------------------------------------------------------------------
+
+    def _queued(self, msg_id):
+        """The combined effect of the queued writes for msg_id.
+
+        Call with the lock held.
+
+        Returns (record, updates), where record is the whole record if it is queued to be added,
+        False if it is queued to be dropped, and None if the record is in the database,
+        in which case updates are the queued changes to it.
+        """
+        record, updates = None, {}
+        for queue in (self._inflight, self._pending):
+            if msg_id not in queue:
+                continue
+            op, rec = queue[msg_id]
+            if op == 'delete':
+                record, updates = False, {}
+            elif op == 'update':
+                if record is None:
+                    updates.update(rec)
+                elif record:
+                    record.update(rec)
+            else:
+                record, updates = dict(rec), {}
+        return record, updates
+
+    def _write_loop(self):
+        """The writer thread, which commits queued writes every batch_interval."""
+        db = self._connect()
+        try:
+            while True:
+                with self._cond:
+                    if not self._closed and not self._waiters:
+                        self._cond.wait(self.batch_interval)
+                    batch = self._inflight = self._pending
+                    self._pending = OrderedDict()
+                    closed = self._closed
+                if batch:
+                    self._write_batch(db, batch)
+                with self._cond:
+                    self._inflight = {}
+                    self._cond.notify_all()
+                if closed:
+                    break
+        finally:
+            db.close()
+
+    def _write_batch(self, db, batch):
+        """Write a batch of queued writes in a single transaction.
+
+        If the transaction fails, the writes are retried one at a time,
+        so that only the records that can't be written are lost.
+        """
+        try:
+            self._execute_batch(db, batch)
+            db.commit()
+            return
+        except Exception:
+            db.rollback()
+            if len(batch) == 1:
+                self.log.error("Failed to write task record %r", list(batch)[0], exc_info=True)
+                return
+            self.log.warn("Failed to write %i task records, retrying one at a time",
+                len(batch), exc_info=True)
+        for msg_id, write in iteritems(batch):
+            try:
+                self._execute_batch(db, {msg_id : write})
+                db.commit()
+            except Exception:
+                self.log.error("Failed to write task record %r", msg_id, exc_info=True)
+                db.rollback()
+
+    def _execute_batch(self, db, batch):
+        """Execute the statements for a batch of queued writes, without committing.
+
+        There is at most one write per msg_id in a batch,
+        so they can be grouped by kind.
+        """
+        deletes = []
+        replaces = []
+        inserts = []
+        updates = {}
+        for msg_id, (op, rec) in iteritems(batch):
+            if op == 'delete':
+                deletes.append((msg_id,))
+            elif op == 'update':
+                rec = self._store_buffers(rec)
+                keys = tuple(sorted(rec.keys()))
+                values = [ rec[key] for key in keys ]
+                values.append(msg_id)
+                updates.setdefault(keys, []).append(values)
+            elif op == 'replace':
+                replaces.append(self._dict_to_list(rec))
+            else:
+                inserts.append(self._dict_to_list(rec))
+        if deletes:
+            db.executemany("DELETE FROM '%s' WHERE msg_id==?" % self.table, deletes)
+        if replaces:
+            db.executemany(self._insert_sql.replace('INSERT', 'INSERT OR REPLACE', 1), replaces)
+        if inserts:
+            cursor = db.executemany(
+                self._insert_sql.replace('INSERT', 'INSERT OR IGNORE', 1), inserts)
+            if cursor.rowcount >= 0 and cursor.rowcount < len(inserts):
+                self.log.error("%i task records were already in the database",
+                    len(inserts) - cursor.rowcount)
+        for keys, lines in iteritems(updates):
+            db.executemany(self._get_update_sql(keys), lines)
+
+    def flush(self):
+        """Wait for all queued writes to be committed, if batch_writes is enabled."""
+        if not self.batch_writes:
+            return
+        with self._cond:
+            self._waiters += 1
+            try:
+                while self._pending or self._inflight:
+                    self._cond.notify_all()
+                    self._cond.wait(1)
+            finally:
+                self._waiters -= 1
+
+    def close(self):
+        """Commit any queued writes, and close the database."""
+        if self._closed:
+            return
+        if self.batch_writes:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._writer.join()
+        if self._commit_callback is not None:
+            self._commit_callback.stop()
+        self._closed = True
+        self._db.commit()
+        self._db.close()
+
 __all__ = ['SQLiteDB']
\ No newline at end of file
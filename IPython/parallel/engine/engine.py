@@ -15,7 +15,7 @@
 import zmq
 from zmq.eventloop import ioloop, zmqstream
 
-from IPython.utils.localinterfaces import localhost
+from IPython.utils.localinterfaces import localhost, public_ips
 from IPython.utils.traitlets import (
     Instance, Dict, Integer, Type, Float, Unicode, CBytes, Bool
 )
@@ -56,6 +56,16 @@ class EngineFactory(RegistrationFactory):
         help="""The SSH private key file to use when tunneling connections to the Controller.""")
     paramiko=Bool(sys.platform == 'win32', config=True,
         help="""Whether to use paramiko instead of openssh for tunnels.""")
+    relay_ip=Unicode(config=True,
+        help="""The IP address on which the engine listens for data relayed by
+        other engines, for DirectView.broadcast. It must be reachable from the other engines.
+        By default, localhost if the controller is reached on loopback without a tunnel,
+        so all engines are on this machine, and otherwise this machine's first public IP.""")
+    def _relay_ip_default(self):
+        if not self.sshserver and (self.ip.startswith('127.') or self.ip == localhost()):
+            return localhost()
+        ips = public_ips()
+        return ips[0] if ips else localhost()
     
     @property
     def tunnel_mod(self):
@@ -0,0 +1,165 @@
+"""Engine-to-engine relays for tree broadcasts.
+
+`DirectView.broadcast` sends a namespace to a single root engine.
+Each engine then forwards the serialized namespace to its children
+in a k-ary tree of engines, over direct zmq connections,
+so the data leaves the client only once.
+Relayed messages are signed and checked by the engines' Session,
+like all other messages in the cluster.
+
+The functions here are called on the engines via apply.
+"""
+
+# Copyright (c) IPython Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import time
+from types import FunctionType
+
+import zmq
+
+from IPython.core.getipython import get_ipython
+from IPython.kernel.zmq.serialize import serialize_object, deserialize_object
+from IPython.utils.py3compat import cast_unicode
+
+from IPython.parallel import util
+from IPython.parallel.error import TimeoutError
+
+
+def kary_tree(nodes, fanout=2):
+    """Arrange a list of nodes in a k-ary tree.
+
+    The first node is the root, and the children of the node at index i
+    are the nodes at indices ``i*fanout+1`` to ``i*fanout+fanout``.
+
+    Returns the tree as nested ``[node, [children]]`` lists.
+
+    >>> kary_tree(list(range(5)))
+    [0, [[1, [[3, []], [4, []]]], [2, []]]]
+    """
+    if fanout < 1:
+        raise ValueError("fanout must be at least 1, not %r" % fanout)
+
+    def subtree(i):
+        first = i * fanout + 1
+        last = min(first + fanout, len(nodes))
+        return [nodes[i], [subtree(c) for c in range(first, last)]]
+
+    return subtree(0)
+
+
+class Relay(object):
+    """The sockets an engine uses to receive and forward broadcasts.
+
+    Broadcasts are received on a PULL socket bound to a random port on `ip`,
+    and forwarded to the PULL sockets of other engines with PUSH sockets.
+    They are ``broadcast`` messages sent with `session`, whose content has
+    the `tag` of the broadcast and the subtree of urls the receiver forwards to,
+    as `children`. Messages that fail the Session's signature check are dropped.
+    """
+
+    def __init__(self, session, ip, context=None):
+        self.session = session
+        self.context = context or zmq.Context.instance()
+        self.pull = self.context.socket(zmq.PULL)
+        port = self.pull.bind_to_random_port('tcp://%s' % ip)
+        self.url = 'tcp://%s:%i' % (ip, port)
+        self.pushers = {}
+        # messages for later broadcasts that arrived early, by tag
+        self.early = {}
+        # broadcasts whose recv timed out, whose messages are dropped if they come
+        self.timed_out = set()
+
+    def forward(self, tag, children, buffers):
+        """Send buffers to each child, with its own subtree"""
+        for url, grandchildren in children:
+            sock = self.pushers.get(url)
+            if sock is None:
+                sock = self.pushers[url] = self.context.socket(zmq.PUSH)
+                sock.connect(url)
+            self.session.send(sock, 'broadcast', content=dict(tag=tag, children=grandchildren),
+                buffers=buffers)
+
+    def recv(self, tag, timeout=60):
+        """Receive the buffers of broadcast `tag` from our parent.
+
+        Raises TimeoutError if they don't arrive within `timeout` seconds.
+
+        Returns (children, buffers).
+        """
+        tag = cast_unicode(tag)
+        if tag in self.early:
+            msg = self.early.pop(tag)
+        else:
+            deadline = time.time() + timeout
+            while True:
+                left = deadline - time.time()
+                if left <= 0 or not self.pull.poll(int(1000 * left)):
+                    self.timed_out.add(tag)
+                    raise TimeoutError("Broadcast %s did not arrive in %s seconds" % (tag, timeout))
+                try:
+                    idents, msg = self.session.recv(self.pull, mode=zmq.NOBLOCK, copy=False)
+                except Exception:
+                    get_ipython().kernel.log.error("Invalid broadcast message", exc_info=True)
+                    continue
+                if msg is None:
+                    continue
+                msg_tag = msg['content']['tag']
+                if msg_tag == tag:
+                    break
+                if msg_tag in self.timed_out:
+                    # too late, nobody will ask for it again
+                    self.timed_out.remove(msg_tag)
+                    continue
+                self.early[msg_tag] = msg
+        return msg['content']['children'], msg['buffers']
+
+    def close(self):
+        for sock in self.pushers.values():
+            sock.close(linger=0)
+        self.pushers = {}
+        self.pull.close(linger=0)
+
+
+_relay = None
+
+def get_relay():
+    """Get the Relay of this engine, creating it on first use."""
+    global _relay
+    if _relay is None:
+        kernel = get_ipython().kernel
+        # the kernel's parent is the EngineFactory
+        _relay = Relay(kernel.session, kernel.parent.relay_ip)
+    return _relay
+
+def relay_url():
+    """The url other engines forward broadcasts to"""
+    return get_relay().url
+
+def _push(ns):
+    """Update the user namespace with `util._push`"""
+    # util._push is interactive, so it has the user namespace as its globals,
+    # but only when it is uncanned on the engine
+    FunctionType(util._push.__code__, get_ipython().user_ns)(**ns)
+
+def broadcast_root(tag, children, ns):
+    """Start broadcast `tag` at the root of the tree.
+
+    The namespace arrived in the apply request, so it is serialized once more
+    for the children.
+    """
+    get_relay().forward(tag, children, serialize_object(ns))
+    _push(ns)
+
+def broadcast_recv(tag, timeout=60):
+    """Receive broadcast `tag` from our parent, and forward it to our children
+    before unpacking it into the user namespace.
+
+    Raises TimeoutError if it doesn't arrive within `timeout` seconds,
+    e.g. because an engine above us in the tree died.
+    """
+    relay = get_relay()
+    children, buffers = relay.recv(tag, timeout)
+    relay.forward(tag, children, buffers)
+    ns, _ = deserialize_object(buffers)
+    _push(ns)
@@ -107,13 +107,17 @@ def add_engines(n=1, profile='iptest', total=False):
         launchers.append(ep)
         eps.append(ep)
     tic = time.time()
-    while len(rc) < base+n:
+    while True:
+        try:
+            rc.wait_for_engines(base+n, timeout=.1)
+        except error.TimeoutError:
+            pass
+        else:
+            break
         if any([ ep.poll() is not None for ep in eps ]):
             raise RuntimeError("A test engine failed to start.")
         elif time.time()-tic > 15:
             raise RuntimeError("Timeout waiting for engines to connect.")
-        time.sleep(.1)
-        rc.spin()
     rc.close()
     return eps
 
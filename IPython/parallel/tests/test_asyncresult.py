@@ -6,6 +6,7 @@
 import time
 
 import nose.tools as nt
+from nose import SkipTest
 
 from IPython.utils.io import capture_output
 
@@ -131,6 +132,66 @@ def test_abort(self):
         self.assertRaises(error.TaskAborted, ar2.get)
         ar.get()
     
+    def test_progress(self):
+        v = self.client.load_balanced_view()
+        ar = v.map_async(wait, [0.5] + [0] * 4)
+        ar.wait(0.25)
+        self.assertEqual(ar.progress, 4)
+        ar.get()
+        self.assertEqual(ar.progress, 5)
+        self.assertNotIn(ar.msg_ids[0], self.client._countdowns)
+
+    def test_wait_timeout_countdowns(self):
+        """timed out Client.wait doesn't leave its countdown behind"""
+        ar = self.client[-1].apply_async(wait, 0.5)
+        self.assertFalse(self.client.wait(ar, 0.1))
+        # only the AsyncResult's own countdown is left
+        self.assertEqual(self.client._countdowns[ar.msg_ids[0]], [ar._countdown])
+        self.assertTrue(self.client.wait(ar))
+        self.assertEqual(ar.get(), 0.5)
+
+    def test_done_callback(self):
+        called = []
+        ar = self.client[-1].apply_async(wait, 0.1)
+        ar.add_done_callback(called.append)
+        self.assertEqual(called, [])
+        ar.get()
+        self.assertEqual(called, [ar])
+        self.assertTrue(ar.done())
+        # called right away when done
+        ar.add_done_callback(called.append)
+        self.assertEqual(called, [ar, ar])
+
+    def test_done_callback_error(self):
+        ar = self.client[-1].apply_async(lambda : 1/0)
+        called = []
+        ar.add_done_callback(called.append)
+        self.assertRaises(error.RemoteError, ar.get)
+        self.assertEqual(called, [ar])
+        self.assertFalse(ar.successful())
+
+    def test_futures_wait(self):
+        try:
+            from concurrent import futures
+        except ImportError:
+            raise SkipTest("requires concurrent.futures")
+        self.client.spin_thread(0.01)
+        try:
+            v = self.client.load_balanced_view()
+            ars = [ v.apply_async(wait, 0.1 * i) for i in range(4) ]
+            fs = [ ar.future for ar in ars ]
+            done, not_done = futures.wait(fs, timeout=10)
+            self.assertEqual(not_done, set())
+            finished = list(futures.as_completed(fs, timeout=10))
+            self.assertEqual(sorted(finished, key=fs.index), fs)
+            self.assertEqual([ f.result() for f in fs ], [ ar.get() for ar in ars ])
+            # the result property is unaffected
+            self.assertEqual(ars[-1].result, ars[-1].get())
+            ar = v.apply_async(lambda : 1/0)
+            self.assertIsInstance(ar.future.exception(timeout=10), error.RemoteError)
+        finally:
+            self.client.stop_spin_thread()
+
     def test_len(self):
         v = self.client.load_balanced_view()
         ar = v.map_async(lambda x: x, list(range(10)))
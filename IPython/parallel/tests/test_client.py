@@ -16,7 +16,7 @@
 from IPython.parallel import AsyncResult, AsyncHubResult
 from IPython.parallel import LoadBalancedView, DirectView
 
-from .clienttest import ClusterTestCase, segfault, wait, add_engines
+from .clienttest import ClusterTestCase, segfault, wait, add_engines, skip_without
 
 def setup():
     add_engines(4, total=True)
@@ -200,6 +200,32 @@ def test_queue_status(self):
             self.assertTrue(isinstance(qs, dict))
             self.assertEqual(sorted(qs.keys()), ['completed', 'queue', 'tasks'])
 
+    def test_stats(self):
+        id0 = self.client.ids[0]
+        self.client[id0].apply_sync(lambda : None)
+        # give the monitor time to notice the result
+        time.sleep(.25)
+        stats = self.client.stats(targets=id0)
+        self.assertEqual(sorted(stats.keys()),
+            ['dispatch_latency', 'heartbeat_latency', 'queue_depth', 'runtime', 'throughput'])
+        self.assertTrue(sum(stats['runtime']) >= 1)
+        allstats = self.client.stats()
+        self.assertTrue(allstats.pop('window') > 0)
+        allstats.pop('unassigned')
+        self.assertEqual(sorted(allstats.keys()), sorted(self.client.ids))
+
+    def test_timings(self):
+        ar = self.client.load_balanced_view().apply_async(lambda : None)
+        ar.get()
+        md = ar.metadata
+        self.assertTrue(md.pack_time >= 0)
+        self.assertTrue(md.started <= md.unpacked <= md.finished <= md.completed)
+        # give the monitor time to notice the result
+        time.sleep(.25)
+        rec = self.client.db_query({'msg_id' : ar.msg_ids[0]}, keys=['result_metadata'])[0]
+        self.assertIn('queued', rec['result_metadata'])
+        self.assertIn('dispatched', rec['result_metadata'])
+
     def test_shutdown(self):
         ids = self.client.ids
         id0 = ids[0]
@@ -535,6 +561,56 @@ def test_stop_spin_thread(self):
             time.sleep(0.1)
             self.assertIsNone(md['received'], None)
     
+    @skip_without('numpy')
+    def test_zero_copy(self):
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        A = numpy.random.random((1024, 64))
+        self.client.zero_copy = True
+        try:
+            B = self.client[-1].apply_sync(lambda a: a * 2, A)
+        finally:
+            self.client.zero_copy = False
+        assert_array_equal(B, A * 2)
+        # B uses the memory of the received frame
+        self.assertFalse(B.flags.owndata)
+        self.assertFalse(B.flags.writeable)
+
+    def test_wait_for_engines(self):
+        n = len(self.client.ids)
+        self.assertEqual(self.client.wait_for_engines(n, timeout=1), self.client.ids)
+        tic = time.time()
+        self.assertRaises(error.TimeoutError, self.client.wait_for_engines, n + 1, timeout=0.1)
+        self.assertTrue(time.time() - tic < 1)
+        # new engines wake us up
+        add_engines(1, total=False)
+        self.assertEqual(len(self.client.wait_for_engines(n + 1, timeout=30)), n + 1)
+
+    def test_results_limit(self):
+        """evicted results are fetched again from the Hub"""
+        self.client.results_limit = 2
+        try:
+            ars = [ self.client[-1].apply_async(lambda x: x, i) for i in range(4) ]
+            self.client.wait(ars)
+            self.assertTrue(len(self.client.results) <= 2)
+            self.assertTrue(ars[0].msg_ids[0] in self.client.results.evicted)
+            ar = self.client.get_result(ars[0].msg_ids[0])
+            self.assertEqual(ar.get(), 0)
+            # results of a pending AsyncResult are kept until it has them
+            v = self.client.load_balanced_view()
+            amr = v.map_async(lambda x: x, range(4), chunksize=1)
+            self.assertEqual(len(amr.msg_ids), 4)
+            self.assertEqual(amr.get(), list(range(4)))
+            self.assertTrue(len(self.client.results) <= 2)
+            # and several evicted results are fetched again together
+            evicted = [ m for m in amr.msg_ids if m in self.client.results.evicted ]
+            self.assertTrue(len(evicted) >= 2)
+            ar = self.client.get_result(evicted)
+            # each message of the map is a chunk of one element
+            self.assertEqual(ar.get(), [ [amr.msg_ids.index(m)] for m in evicted ])
+        finally:
+            self.client.results_limit = 0
+
     def test_activate(self):
         ip = get_ipython()
         magics = ip.magics_manager.magics
@@ -75,6 +75,21 @@ def test_add_record(self):
         self.assertEqual(len(after), len(before)+5)
         self.assertEqual(after[:-5],before)
         
+    def test_add_records(self):
+        before = self.db.get_history()
+        records = []
+        for i in range(5):
+            msg = self.session.msg('apply_request', content=dict(a=5))
+            msg['buffers'] = [os.urandom(10)]
+            records.append(init_record(msg))
+        self.db.add_records(records)
+        after = self.db.get_history()
+        self.assertEqual(len(after), len(before)+5)
+        for rec in records:
+            rec2 = self.db.get_record(rec['msg_id'])
+            self.assertEqual(rec2['buffers'], rec['buffers'])
+            self.assertEqual(rec2['submitted'], rec['submitted'])
+
     def test_drop_record(self):
         msg_id = self.load_records()[-1]
         rec = self.db.get_record(msg_id)
@@ -152,6 +167,31 @@ def test_find_records_in(self):
         found = [ r['msg_id'] for r in recs ]
         self.assertEqual(set(odd), set(found))
     
+    def test_find_records_range(self):
+        """test finding records with '$gt', '$lte' and multiple operators"""
+        hist = self.db.get_history()
+        tics = [ self.db.get_record(msg_id)['submitted'] for msg_id in hist ]
+        recs = self.db.find_records({'submitted' : {'$gt' : tics[3]}})
+        found = [ r['msg_id'] for r in recs ]
+        self.assertEqual(set(found), set(m for m, t in zip(hist, tics) if t > tics[3]))
+        recs = self.db.find_records({'submitted' : {'$gt' : tics[3], '$lte' : tics[7]}})
+        found = [ r['msg_id'] for r in recs ]
+        self.assertEqual(set(found), set(m for m, t in zip(hist, tics) if tics[3] < t <= tics[7]))
+    
+    def test_find_records_multiple_keys(self):
+        """test queries on several keys, all of which must match"""
+        hist = self.db.get_history()
+        self.db.update_record(hist[0], dict(engine_uuid=u'a', client_uuid=u'x'))
+        self.db.update_record(hist[1], dict(engine_uuid=u'a', client_uuid=u'y'))
+        self.db.update_record(hist[2], dict(engine_uuid=u'b', client_uuid=u'x'))
+        recs = self.db.find_records({'engine_uuid' : u'a', 'client_uuid' : u'x'})
+        self.assertEqual([ r['msg_id'] for r in recs ], [hist[0]])
+        recs = self.db.find_records({'engine_uuid' : {'$in' : [u'a', u'b']},
+                                     'msg_id' : {'$in' : hist[1:3]}})
+        self.assertEqual(set(r['msg_id'] for r in recs), set(hist[1:3]))
+        recs = self.db.find_records({'engine_uuid' : u'a', 'completed' : None})
+        self.assertEqual(set(r['msg_id'] for r in recs), set(hist[:2]))
+    
     def test_get_history(self):
         msg_ids = self.db.get_history()
         latest = datetime(1984,1,1)
@@ -293,6 +333,39 @@ def test_cull_size_update(self):
         self.db.update_record(msg_id, dict(result_buffers = [os.urandom(11)], buffers=[]))
         self.assertEqual(len(self.db.get_history()), 79)
 
+    def test_indexes_update(self):
+        """indexed queries see updates and drops"""
+        hist = self.db.get_history()
+        now = datetime.now()
+        self.db.update_record(hist[0], dict(engine_uuid=u'a', completed=now))
+        recs = self.db.find_records({'engine_uuid' : u'a'})
+        self.assertEqual([ r['msg_id'] for r in recs ], [hist[0]])
+        recs = self.db.find_records({'completed' : None})
+        self.assertEqual(set(r['msg_id'] for r in recs), set(hist[1:]))
+        self.db.update_record(hist[0], dict(engine_uuid=u'b'))
+        self.assertEqual(self.db.find_records({'engine_uuid' : u'a'}), [])
+        # move the first record to the end of history
+        self.db.update_record(hist[0], dict(submitted=now))
+        self.assertEqual(self.db.get_history(), hist[1:] + hist[:1])
+        self.db.drop_matching_records({'engine_uuid' : u'b'})
+        self.assertEqual(self.db.find_records({'engine_uuid' : u'b'}), [])
+        self.assertEqual(self.db.get_history(), hist[1:])
+        self.assertEqual(self.db.find_records({'submitted' : {'$gte' : now}}), [])
+    
+    def test_indexed_query_scales(self):
+        """indexed queries don't check every record"""
+        self.load_records(2000, buffer_size=0)
+        msg_ids = self.db.get_history()[-5:]
+        checked = []
+        match_one = self.db._match_one
+        def counting_match_one(rec, tests):
+            checked.append(rec['msg_id'])
+            return match_one(rec, tests)
+        self.db._match_one = counting_match_one
+        recs = self.db.find_records({'msg_id' : {'$in' : msg_ids}}, keys=['submitted'])
+        self.assertEqual(set(r['msg_id'] for r in recs), set(msg_ids))
+        self.assertEqual(len(checked), 5)
+
 class TestSQLiteBackend(TaskDBTest, TestCase):
 
     @dec.skip_without('sqlite3')
@@ -303,7 +376,115 @@ def create_db(self):
         return SQLiteDB(location=location, fname=fname, log=log)
     
     def tearDown(self):
-        self.db._db.close()
+        self.db.close()
+
+    def test_close(self):
+        self.assertTrue(self.db._commit_callback._running)
+        self.db.close()
+        self.assertFalse(self.db._commit_callback._running)
+
+    def test_indexes(self):
+        cursor = self.db._db.execute("PRAGMA index_list('%s')" % self.db.table)
+        names = [ line[1] for line in cursor.fetchall() ]
+        for key in ('submitted', 'engine_uuid', 'client_uuid'):
+            self.assertIn('%s_%s' % (self.db.table, key), names)
+
+    def test_buffer_store(self):
+        self.db.buffer_threshold = 1000
+        msg_ids = self.load_records(2, buffer_size=500)
+        data = os.urandom(2000)
+        for msg_id in msg_ids:
+            self.db.update_record(msg_id, dict(result_buffers=[data, b'']))
+        rec = self.db.get_record(msg_ids[0])
+        self.assertEqual(len(rec['buffers'][0]), 500)
+        self.assertEqual(list(map(bytes, rec['result_buffers'])), [data, b''])
+        # only references are in the table
+        cursor = self.db._db.execute("SELECT length(buffers), length(result_buffers) FROM '%s' WHERE msg_id == ?"
+            % self.db.table, (msg_ids[0],))
+        buffers_size, result_size = cursor.fetchone()
+        self.assertTrue(buffers_size > 500)
+        self.assertTrue(result_size < 100)
+        # buffers are stored once, and removed when no longer used
+        store = self.db._buffer_store.path
+        count = lambda : sum(len(files) for d, dirs, files in os.walk(store))
+        self.assertEqual(count(), 2)
+        self.db.drop_matching_records({'msg_id' : msg_ids[0]})
+        self.assertEqual(count(), 2)
+        self.db.drop_matching_records({'msg_id' : msg_ids[1]})
+        self.assertEqual(count(), 0)
+
+
+class TestSQLiteBatchedBackend(TaskDBTest, TestCase):
+
+    @dec.skip_without('sqlite3')
+    def create_db(self):
+        location, fname = os.path.split(temp_db)
+        log = logging.getLogger('test')
+        log.setLevel(logging.CRITICAL)
+        return SQLiteDB(location=location, fname=fname, log=log,
+            batch_writes=True, batch_interval=10)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_journal_mode(self):
+        mode = self.db._db.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode.lower(), 'wal')
+
+    def test_queued_updates_combined(self):
+        self.db.flush()
+        msg_id = self.db.get_history()[-1]
+        self.db.update_record(msg_id, dict(stdout=u'a', engine_uuid=u'e'))
+        self.db.update_record(msg_id, dict(stdout=u'ab', stderr=u'c'))
+        self.assertEqual(list(self.db._pending), [msg_id])
+        op, rec = self.db._pending[msg_id]
+        self.assertEqual(op, 'update')
+        self.assertEqual(rec, dict(stdout=u'ab', stderr=u'c', engine_uuid=u'e'))
+        # queued updates are visible before they are written
+        rec = self.db.get_record(msg_id)
+        self.assertEqual(rec['stdout'], u'ab')
+        self.assertEqual(rec['engine_uuid'], u'e')
+        recs = self.db.find_records({'engine_uuid' : u'e'}, keys=['stdout', 'stderr'])
+        self.assertEqual(recs, [dict(msg_id=msg_id, stdout=u'ab', stderr=u'c')])
+        self.assertEqual(len(self.db._pending), 0)
+
+    def test_queued_record(self):
+        self.db.flush()
+        msg_id = self.load_records()[-1]
+        self.db.update_record(msg_id, dict(stdout=u'out'))
+        # an added record and its updates are written as a single insert
+        self.assertEqual(self.db._pending[msg_id][0], 'insert')
+        rec = self.db.get_record(msg_id)
+        self.assertEqual(rec['stdout'], u'out')
+        rec['header']['msg_id'] = 'changed'
+        self.assertEqual(self.db.get_record(msg_id)['header']['msg_id'], msg_id)
+        self.assertRaises(KeyError, self.db.add_record, msg_id, rec)
+        self.db.drop_record(msg_id)
+        self.assertRaises(KeyError, self.db.get_record, msg_id)
+        self.db.update_record(msg_id, dict(stdout=u'more'))
+        self.db.flush()
+        self.assertRaises(KeyError, self.db.get_record, msg_id)
+
+    def test_failed_write(self):
+        self.db.flush()
+        bad = self.db.get_history()[-1]
+        self.db.update_record(bad, dict(no_such_column=u'x'))
+        msg_ids = self.load_records(2)
+        self.db.flush()
+        # the bad update doesn't lose the rest of the batch
+        for msg_id in msg_ids:
+            self.assertEqual(self.db.get_record(msg_id)['msg_id'], msg_id)
+        self.assertEqual(self.db.get_record(bad)['msg_id'], bad)
+
+    def test_drop_and_add(self):
+        msg_id = self.load_records()[-1]
+        self.db.flush()
+        rec = self.db.get_record(msg_id)
+        self.db.drop_record(msg_id)
+        rec['stdout'] = u'again'
+        self.db.add_record(msg_id, rec)
+        self.db.flush()
+        self.assertEqual(self.db.get_record(msg_id)['stdout'], u'again')
 
 
 def teardown():
@@ -0,0 +1,147 @@
+"""Tests for the HeartMonitor, run in-process without engines."""
+
+# Copyright (c) IPython Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import logging
+from unittest import TestCase
+
+import zmq
+from zmq.eventloop import ioloop, zmqstream
+
+from IPython.parallel.controller.heartmonitor import HeartMonitor
+
+#-------------------------------------------------------------------------------
+# Helpers
+#-------------------------------------------------------------------------------
+
+def make_monitor(**kwargs):
+    """Create a HeartMonitor with unconnected streams, on a loop that is not started."""
+    ctx = zmq.Context.instance()
+    loop = ioloop.IOLoop()
+    def stream(kind):
+        return zmqstream.ZMQStream(ctx.socket(kind), loop)
+    log = logging.getLogger('test_heartmonitor')
+    log.setLevel(logging.WARN)
+    monitor = HeartMonitor(loop=loop, log=log,
+        pingstream=stream(zmq.PUB), pongstream=stream(zmq.ROUTER),
+        **kwargs
+    )
+    monitor.new = new = []
+    monitor.failed = failed = []
+    # handlers are kept in a Set, so they must be hashable
+    monitor.add_new_heart_handler(lambda heart: new.append(heart))
+    monitor.add_heart_failure_handler(lambda heart: failed.append(heart))
+    return monitor
+
+
+def pong(monitor, heart, beat=None):
+    """Answer a beat, the current one by default"""
+    beat = monitor.beat_count if beat is None else beat
+    monitor.handle_pong([heart, str(beat).encode('ascii')])
+
+#-------------------------------------------------------------------------------
+# Tests
+#-------------------------------------------------------------------------------
+
+
+class TestHeartMonitor(TestCase):
+
+    def setUp(self):
+        self.monitor = make_monitor(max_heartmonitor_misses=2)
+
+    def tearDown(self):
+        self.monitor.pingstream.close(linger=0)
+        self.monitor.pongstream.close(linger=0)
+        self.monitor.hb_loop.close()
+
+    def test_new_heart(self):
+        m = self.monitor
+        m.beat()
+        pong(m, b'a')
+        self.assertEqual(m.new, [b'a'])
+        self.assertIn(b'a', m.hearts)
+        # only new once
+        m.beat()
+        pong(m, b'a')
+        self.assertEqual(m.new, [b'a'])
+
+    def test_failure(self):
+        m = self.monitor
+        m.beat()
+        pong(m, b'a')
+        pong(m, b'b')
+        # a keeps beating, b stops
+        for i in range(3):
+            m.beat()
+            pong(m, b'a')
+        self.assertEqual(m.failed, [])
+        m.beat()
+        self.assertEqual(m.failed, [b'b'])
+        self.assertEqual(list(m.hearts), [b'a'])
+        for i in range(10):
+            m.beat()
+            pong(m, b'a')
+        self.assertEqual(m.failed, [b'b'])
+
+    def test_late_pong(self):
+        m = self.monitor
+        m.beat()
+        pong(m, b'a')
+        for i in range(3):
+            m.beat()
+        # answering an old beat still counts
+        pong(m, b'a', m.beat_count - 2)
+        m.beat()
+        self.assertEqual(m.failed, [])
+
+    def test_stale_pong(self):
+        m = self.monitor
+        for i in range(10):
+            m.beat()
+        pong(m, b'a', 1)
+        pong(m, b'b', b'garbage')
+        self.assertEqual(m.new, [])
+        self.assertEqual(m.hearts, {})
+
+    def test_slot_reuse(self):
+        m = self.monitor
+        m.beat()
+        pong(m, b'a')
+        for i in range(4):
+            m.beat()
+        self.assertEqual(m.failed, [b'a'])
+        pong(m, b'b')
+        self.assertEqual(m.hearts, {b'b': 0})
+        self.assertEqual(sum(m.latency_histogram(b'b')), 1)
+
+    def test_latency_histogram(self):
+        m = self.monitor
+        m.beat()
+        pong(m, b'a')
+        pong(m, b'a')
+        hist = m.latency_histogram(b'a')
+        self.assertEqual(len(hist), m.latency_bins)
+        self.assertEqual(hist[0], 2)
+        self.assertEqual(m.latency_histograms(), {b'a': hist})
+
+    def test_has_heart(self):
+        m = self.monitor
+        m.beat()
+        self.assertFalse(m.has_heart(b'a'))
+        pong(m, b'a')
+        self.assertTrue(m.has_heart(b'a'))
+
+    def test_stop(self):
+        m = self.monitor
+        # beat on a loop in its own thread
+        m.loop = ioloop.IOLoop()
+        try:
+            m.start()
+            self.assertTrue(m.thread.is_alive())
+            thread = m.thread
+            m.stop()
+            self.assertFalse(thread.is_alive())
+            self.assertIsNone(m.thread)
+        finally:
+            m.loop.close()
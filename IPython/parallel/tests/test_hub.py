@@ -0,0 +1,302 @@
+"""Tests for the Hub, run in-process without engines or clients."""
+
+# Copyright (c) IPython Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import logging
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import zmq
+from zmq.eventloop import ioloop, zmqstream
+
+from IPython.kernel.zmq.session import Session
+from IPython.parallel.controller.dictdb import DictDB
+from IPython.parallel.controller.heartmonitor import HeartMonitor
+from IPython.parallel.controller.hub import Hub, RollingHistogram
+
+#-------------------------------------------------------------------------------
+# Helpers
+#-------------------------------------------------------------------------------
+
+CLIENT = b'client'
+
+
+def make_hub(**kwargs):
+    """Create a Hub with unconnected streams and a DictDB.
+
+    Replies are only queued on the streams, whose loop is not started.
+    """
+    ctx = zmq.Context.instance()
+    loop = ioloop.IOLoop()
+    def stream(kind):
+        return zmqstream.ZMQStream(ctx.socket(kind), loop)
+    log = logging.getLogger('test_hub')
+    log.setLevel(logging.WARN)
+    heartmonitor = HeartMonitor(loop=loop, log=log,
+        pingstream=stream(zmq.PUB), pongstream=stream(zmq.ROUTER),
+    )
+    return Hub(loop=loop, session=Session(), log=log, db=DictDB(),
+        heartmonitor=heartmonitor, monitor=stream(zmq.SUB), query=stream(zmq.ROUTER),
+        notifier=stream(zmq.PUB), resubmit=stream(zmq.DEALER),
+        **kwargs
+    )
+
+
+def close_hub(hub):
+    for s in (hub.query, hub.monitor, hub.notifier, hub.resubmit,
+            hub.heartmonitor.pingstream, hub.heartmonitor.pongstream):
+        s.close(linger=0)
+    hub.loop.close()
+
+
+def iopub(hub, msg_id, msg_type, content):
+    """Send the hub an iopub message, as if from the request msg_id"""
+    session = hub.session
+    parent = dict(session.msg_header('apply_request'), msg_id=msg_id)
+    msg = session.msg(msg_type, content, parent=parent)
+    raw = session.serialize(msg, ident=b'engine.0.' + msg_type.encode('ascii'))
+    hub.dispatch_monitor_traffic([b'iopub'] + raw)
+
+
+def stream(hub, msg_id, text, name='stdout'):
+    iopub(hub, msg_id, 'stream', dict(name=name, text=text))
+
+
+def register(hub, eid, uuid):
+    """Register an engine with the hub, without a heart"""
+    hub.ids.add(eid)
+    hub.keytable[eid] = uuid.decode('ascii')
+    hub.by_ident[uuid] = eid
+    hub.queues[eid] = []
+    hub.tasks[eid] = []
+    hub.completed[eid] = []
+
+
+def submit_task(hub):
+    """Submit a task, as seen by the hub, and return its request"""
+    msg = hub.session.msg('apply_request', {})
+    hub.dispatch_monitor_traffic([b'intask'] + hub.session.serialize(msg, ident=CLIENT))
+    return msg
+
+
+def track_task(hub, request, uuid, queued, dispatched):
+    """Tell the hub the scheduler sent a task to an engine"""
+    content = dict(msg_id=request['header']['msg_id'], engine_id=uuid.decode('ascii'),
+        queued=queued, dispatched=dispatched,
+    )
+    msg = hub.session.msg('task_destination', content)
+    hub.dispatch_monitor_traffic(hub.session.serialize(msg, ident=[b'tracktask', b'scheduler']))
+
+
+def finish_task(hub, request, uuid, started):
+    """Send the hub the reply of a task, finished now"""
+    md = dict(engine=uuid.decode('ascii'), started=started, status='ok')
+    msg = hub.session.msg('apply_reply', dict(status='ok'), parent=request['header'], metadata=md)
+    hub.dispatch_monitor_traffic([b'outtask'] + hub.session.serialize(msg, ident=CLIENT))
+
+
+def query(hub, msg_type, content):
+    """Make a query of the hub, and return the content of its reply"""
+    replies = []
+    hub.session.send = lambda stream, msg_type, content=None, **kw: replies.append(content)
+    try:
+        msg = hub.session.msg(msg_type, content)
+        hub.dispatch_query(hub.session.serialize(msg, ident=CLIENT))
+    finally:
+        del hub.session.send
+    return replies[0]
+
+
+def stored(hub, msg_id, key='stdout'):
+    try:
+        return hub.db.get_record(msg_id)[key]
+    except KeyError:
+        return None
+
+#-------------------------------------------------------------------------------
+# Tests
+#-------------------------------------------------------------------------------
+
+
+class TestHubCompression(TestCase):
+
+    def setUp(self):
+        self.hub = make_hub()
+        self.hub.session.compression = 'zlib'
+
+    def tearDown(self):
+        close_hub(self.hub)
+
+    def test_stored_compressed(self):
+        """buffers are stored compressed, and decompressed for clients"""
+        hub = self.hub
+        data = b'x' * 10000
+        request = hub.session.msg('apply_request', {})
+        request, bufs = hub.session.compress_buffers(request, [b'f', data])
+        hub.dispatch_monitor_traffic([b'intask'] + hub.session.serialize(request, ident=CLIENT) + bufs)
+        msg_id = request['header']['msg_id']
+        rec = hub.db.get_record(msg_id)
+        self.assertEqual(rec['buffers'], bufs)
+        self.assertEqual(rec['metadata']['compression']['buffers'], [1])
+        md = dict(engine=u'engine0', status='ok')
+        reply = hub.session.msg('apply_reply', dict(status='ok'), parent=request['header'], metadata=md)
+        reply, rbufs = hub.session.compress_buffers(reply, [data])
+        hub.dispatch_monitor_traffic([b'outtask'] + hub.session.serialize(reply, ident=CLIENT) + rbufs)
+        rec = hub.db.get_record(msg_id)
+        self.assertEqual(rec['result_buffers'], rbufs)
+        content, buffers = hub._extract_record(rec)
+        self.assertEqual(buffers, [data])
+        self.assertNotIn('compression', content['result_metadata'])
+
+
+class TestHubStreams(TestCase):
+
+    def setUp(self):
+        self.hub = make_hub()
+
+    def tearDown(self):
+        close_hub(self.hub)
+
+    def test_buffered(self):
+        hub = self.hub
+        for text in ('a', 'b', 'c'):
+            stream(hub, 'abc', text)
+        stream(hub, 'abc', 'err', name='stderr')
+        self.assertEqual(stored(hub, 'abc'), None)
+        hub.flush_streams()
+        self.assertEqual(stored(hub, 'abc'), 'abc')
+        self.assertEqual(stored(hub, 'abc', 'stderr'), 'err')
+        self.assertEqual(hub.streams, {})
+        # more output is appended
+        stream(hub, 'abc', 'def')
+        hub.flush_streams('abc')
+        self.assertEqual(stored(hub, 'abc'), 'abcdef')
+        self.assertEqual(stored(hub, 'abc', 'stderr'), 'err')
+
+    def test_other_iopub(self):
+        hub = self.hub
+        stream(hub, 'abc', 'out')
+        iopub(hub, 'abc', 'execute_input', dict(code='a=5', execution_count=1))
+        self.assertEqual(stored(hub, 'abc', 'execute_input'), 'a=5')
+        hub.flush_streams()
+        self.assertEqual(stored(hub, 'abc'), 'out')
+        self.assertEqual(stored(hub, 'abc', 'execute_input'), 'a=5')
+
+    def test_flush_size(self):
+        hub = self.hub
+        hub.stream_buffer_size = 10
+        stream(hub, 'abc', 'x' * 6)
+        self.assertEqual(stored(hub, 'abc'), None)
+        stream(hub, 'abc', 'y' * 6)
+        self.assertEqual(stored(hub, 'abc'), 'x' * 6 + 'y' * 6)
+        self.assertNotIn('abc', hub.streams)
+
+    def test_flush_interval(self):
+        hub = self.hub
+        hub.stream_flush_interval = 0.01
+        stream(hub, 'abc', 'out')
+        hub.loop.add_timeout(hub.loop.time() + 0.2, hub.loop.stop)
+        hub.loop.start()
+        self.assertEqual(stored(hub, 'abc'), 'out')
+        self.assertEqual(hub.streams, {})
+
+    def test_flush_on_query(self):
+        hub = self.hub
+        stream(hub, 'abc', 'out')
+        msg = hub.session.msg('db_request', dict(query={'msg_id' : 'abc'}, keys=['stdout']))
+        hub.db_query(CLIENT, msg)
+        self.assertEqual(stored(hub, 'abc'), 'out')
+
+    def test_limit(self):
+        hub = self.hub
+        hub.stream_limit = 5
+        stream(hub, 'abc', 'abc')
+        hub.flush_streams()
+        stream(hub, 'abc', 'defgh')
+        stream(hub, 'abc', 'e', name='stderr')
+        hub.flush_streams()
+        truncated = 'abcde\n[output truncated]\n'
+        self.assertEqual(stored(hub, 'abc'), truncated)
+        self.assertEqual(stored(hub, 'abc', 'stderr'), 'e')
+        stream(hub, 'abc', 'more')
+        hub.flush_streams()
+        self.assertEqual(stored(hub, 'abc'), truncated)
+
+
+class TestRollingHistogram(TestCase):
+
+    def test_bins(self):
+        hist = RollingHistogram(window=10, scale=1e-3, nbins=4)
+        for value in (0, 0.0005, 0.001, 0.003, 1):
+            hist.add(value, now=0)
+        self.assertEqual(hist.counts(now=0), [2, 1, 1, 1])
+
+    def test_window(self):
+        hist = RollingHistogram(window=10, nbins=4, nslices=5)
+        hist.add(1, now=0)
+        hist.add(2, now=5)
+        self.assertEqual(hist.counts(now=9), [0, 1, 1, 0])
+        self.assertEqual(hist.counts(now=10), [0, 0, 1, 0])
+        self.assertEqual(hist.counts(now=20), [0, 0, 0, 0])
+
+
+class TestHubStats(TestCase):
+
+    def setUp(self):
+        self.hub = make_hub()
+        register(self.hub, 0, b'engine0')
+        register(self.hub, 1, b'engine1')
+
+    def tearDown(self):
+        close_hub(self.hub)
+
+    def test_task_timings(self):
+        hub = self.hub
+        request = submit_task(hub)
+        msg_id = request['header']['msg_id']
+        dispatched = datetime.now()
+        queued = dispatched - timedelta(milliseconds=10)
+        track_task(hub, request, b'engine0', queued, dispatched)
+        finish_task(hub, request, b'engine0', dispatched)
+        md = stored(hub, msg_id, 'result_metadata')
+        self.assertEqual(md['queued'], queued)
+        self.assertEqual(md['dispatched'], dispatched)
+        self.assertEqual(hub.dispatch_times, {})
+
+    def test_stats_request(self):
+        hub = self.hub
+        request = submit_task(hub)
+        dispatched = datetime.now()
+        track_task(hub, request, b'engine0', dispatched - timedelta(milliseconds=10), dispatched)
+        finish_task(hub, request, b'engine0', dispatched)
+        stats = query(hub, 'stats_request', dict(targets=None))
+        self.assertEqual(stats['status'], 'ok')
+        self.assertEqual(stats['window'], hub.stats_window)
+        self.assertEqual(stats['unassigned'][1], 1)
+        e0 = stats['0']
+        self.assertEqual(e0['queue_depth'][1], 1)
+        self.assertEqual(e0['dispatch_latency'][4], 1)
+        self.assertEqual(sum(e0['runtime']), 1)
+        self.assertEqual(e0['throughput'], 1 / hub.stats_window)
+        e1 = stats['1']
+        self.assertEqual(sum(e1['runtime']), 0)
+        self.assertEqual(e1['throughput'], 0)
+        # one target
+        stats = query(hub, 'stats_request', dict(targets=[1]))
+        self.assertEqual(sorted(stats), ['1', 'status', 'unassigned', 'window'])
+
+    def test_unregister(self):
+        hub = self.hub
+        request = submit_task(hub)
+        dispatched = datetime.now()
+        track_task(hub, request, b'engine0', dispatched - timedelta(milliseconds=10), dispatched)
+        self.assertIn(0, hub.engine_stats)
+        hub.unregister_engine(b'engine0', dict(content=dict(id=0)))
+        self.assertNotIn(0, hub.engine_stats)
+        hub._handle_stranded_msgs(0, 'engine0')
+        self.assertEqual(hub.dispatch_times, {})
+        # nor reported, nor kept again
+        stats = query(hub, 'stats_request', dict(targets=None))
+        self.assertEqual(sorted(stats), ['1', 'status', 'unassigned', 'window'])
+        self.assertEqual(list(hub.engine_stats), [1])
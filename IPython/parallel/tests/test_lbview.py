@@ -59,6 +59,22 @@ def f(x):
         r = self.view.map_sync(f, data)
         self.assertEqual(r, list(map(f, data)))
     
+    def test_map_batched(self):
+        def f(x):
+            return x**2
+        data = list(range(50))
+        ar = self.view.map_async(f, data, batchsize=16)
+        self.assertEqual(len(ar.msg_ids), 50)
+        self.assertEqual(ar.get(), list(map(f, data)))
+        # each task is recorded by the Hub individually
+        recs = self.client.db_query({'msg_id' : {'$in' : ar.msg_ids}}, keys=['msg_id', 'completed'])
+        self.assertEqual(sorted(rec['msg_id'] for rec in recs), sorted(ar.msg_ids))
+
+    def test_map_batched_chunksize(self):
+        data = list(range(50))
+        r = self.view.map_sync(lambda x: -x, data, chunksize=7, batchsize=3)
+        self.assertEqual(r, [ -x for x in data ])
+
     def test_map_generator(self):
         def f(x):
             return x**2
@@ -112,6 +128,63 @@ def slow_f(x):
         self.assertNotEqual(astheycame, reference, "should not have preserved order")
         self.assertEqual(sorted(astheycame, reverse=True), reference, "result corrupted")
 
+    def test_imap_infinite(self):
+        from itertools import count, islice
+        before = len(self.client.history)
+        squares = self.view.imap(lambda x: x**2, count(), max_pending=4)
+        self.assertEqual(list(islice(squares, 20)), [ x**2 for x in range(20) ])
+        # only a window of tasks past those consumed was submitted
+        self.assertTrue(len(self.client.history) - before <= 24)
+
+    def test_imap_chunksize(self):
+        def f(x, y):
+            return x * y
+        r = list(self.view.imap(f, iter(range(10)), range(7), chunksize=3, max_pending=2))
+        self.assertEqual(r, list(map(f, range(7), range(7))))
+
+    def test_imap_unordered(self):
+        def slow_f(x):
+            import time
+            time.sleep(0.05*x)
+            return x**2
+        data = list(range(16,0,-1))
+        reference = [ x**2 for x in data ]
+        astheycame = list(self.view.imap(slow_f, iter(data), ordered=False, max_pending=16))
+        self.assertNotEqual(astheycame, reference, "should not have preserved order")
+        self.assertEqual(sorted(astheycame, reverse=True), reference, "result corrupted")
+
+    def test_submit_graph(self):
+        def stamp(x):
+            import time
+            time.sleep(0.05)
+            return x
+        dag = {
+            'a': (stamp, ('a',)),
+            'b': (stamp, ('b',), {}, ['a']),
+            'c': (max, (1, 3)),
+            'd': (stamp, (), dict(x='d'), ['b', 'c']),
+        }
+        results = self.view.submit_graph(dag)
+        self.assertEqual(sorted(results), sorted(dag))
+        self.assertEqual(dict((node, ar.get()) for node, ar in results.items()),
+                         dict(a='a', b='b', c=3, d='d'))
+        for node, parents in [('b', 'a'), ('d', 'bc')]:
+            started = results[node].metadata.started
+            for parent in parents:
+                self.assertTrue(started > results[parent].metadata.completed)
+
+    def test_submit_graph_failed_parent(self):
+        def fail():
+            raise ValueError("failed")
+        results = self.view.submit_graph({'a': (fail,), 'b': (max, (1, 2), {}, ['a'])})
+        self.assertRaisesRemote(ValueError, results['a'].get)
+        self.assertRaisesRemote(error.ImpossibleDependency, results['b'].get)
+
+    def test_submit_graph_cycle(self):
+        dag = {'a': (max, (1, 2), {}, ['b']), 'b': (max, (1, 2), {}, ['a'])}
+        self.assertRaises(ValueError, self.view.submit_graph, dag)
+        self.assertRaises(KeyError, self.view.submit_graph, {'a': (max, (1, 2), {}, ['x'])})
+
     def test_map_ordered(self):
         def f(x):
             return x**2
@@ -210,6 +283,20 @@ def test_follow(self):
         for ar in ars:
             self.assertEqual(ar.engine_id, first_id)
 
+    def test_data(self):
+        e0 = self.client.ids[-1]
+        self.client[e0].push(dict(locality_data=list(range(10))), block=True)
+        # engines advertise their namespace with their task replies
+        for eid in self.client.ids:
+            with self.view.temp_flags(targets=eid):
+                self.view.apply_sync(lambda : None)
+        self.view.data = 'locality_data'
+        for i in range(5):
+            ar = self.view.apply_async(lambda : 1)
+            ar.get()
+            self.assertEqual(ar.engine_id, e0)
+        self.client[e0].execute('del locality_data', block=True)
+
     def test_after(self):
         view = self.view
         ar = view.apply_async(time.sleep, 0.5)
@@ -0,0 +1,630 @@
+"""Tests for the Python TaskScheduler, run in-process without engines.
+
+Run as a script to print a benchmark of dispatch rate vs. queue depth.
+"""
+
+# Copyright (c) IPython Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import print_function
+
+import logging
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import zmq
+from zmq.eventloop import ioloop, zmqstream
+
+from IPython.kernel.zmq import serialize
+from IPython.kernel.zmq.kernelbase import Kernel
+from IPython.kernel.zmq.session import Session
+from IPython.parallel.controller.scheduler import TaskScheduler, ReadyQueue, Job, MET
+from IPython.parallel.controller.dependency import Dependency
+
+#-------------------------------------------------------------------------------
+# Helpers
+#-------------------------------------------------------------------------------
+
+CLIENT = b'client'
+
+
+def make_scheduler(engines=2, **kwargs):
+    """Create a TaskScheduler with unconnected streams and some registered engines.
+
+    Nothing is ever delivered; outgoing messages are only queued on the streams,
+    whose loop is never started.
+    """
+    ctx = zmq.Context.instance()
+    loop = ioloop.IOLoop()
+    def stream(kind):
+        return zmqstream.ZMQStream(ctx.socket(kind), loop)
+    log = logging.getLogger('test_scheduler')
+    log.setLevel(logging.WARN)
+    scheduler = TaskScheduler(
+        client_stream=stream(zmq.ROUTER), engine_stream=stream(zmq.ROUTER),
+        mon_stream=stream(zmq.PUB), notifier_stream=stream(zmq.SUB),
+        query_stream=stream(zmq.DEALER),
+        session=Session(), loop=loop, log=log, **kwargs
+    )
+    for i in range(engines):
+        scheduler._register_engine(engine_ident(i))
+    return scheduler
+
+
+def close_scheduler(scheduler):
+    for name in ('client', 'engine', 'mon', 'notifier', 'query', 'control'):
+        stream = getattr(scheduler, name + '_stream')
+        if stream is not None:
+            stream.close(linger=0)
+    scheduler.loop.close()
+
+
+def engine_ident(i):
+    return ('engine-%i' % i).encode('ascii')
+
+
+def submit(scheduler, buffers=(), client=CLIENT, **metadata):
+    """Submit a task to the scheduler, as a client would. Returns the msg_id."""
+    msg = scheduler.session.msg('apply_request', {}, metadata=metadata)
+    raw = scheduler.session.serialize(msg, ident=client) + list(buffers)
+    scheduler.dispatch_submission(list(map(zmq.Message, raw)))
+    return msg['header']['msg_id']
+
+
+def reply(scheduler, engine, msg_id, parent=None, buffers=(), client=CLIENT, **metadata):
+    """Send the scheduler a reply to msg_id from engine"""
+    if parent is None:
+        parent = scheduler.pending[engine][msg_id].header
+    metadata.setdefault('status', 'ok')
+    metadata['engine'] = engine.decode('ascii')
+    msg = scheduler.session.msg('apply_reply', {}, parent=parent, metadata=metadata)
+    raw = scheduler.session.serialize(msg, ident=[engine, client]) + list(buffers)
+    scheduler.dispatch_result(list(map(zmq.Message, raw)))
+
+
+def finish(scheduler, msg_id):
+    """Reply to msg_id from the engine it was assigned to. Returns the engine."""
+    for engine, pending in scheduler.pending.items():
+        if msg_id in pending:
+            reply(scheduler, engine, msg_id)
+            return engine
+    raise KeyError("%s is not pending" % msg_id)
+
+
+def assigned(scheduler, engine=None):
+    """The set of msg_ids currently pending on engines"""
+    if engine is not None:
+        return set(scheduler.pending[engine])
+    msg_ids = set()
+    for pending in scheduler.pending.values():
+        msg_ids.update(pending)
+    return msg_ids
+
+
+def make_job(msg_id, timestamp, targets=(), follow=MET):
+    """Create a Job with a given timestamp, for ReadyQueue tests"""
+    job = Job(msg_id=msg_id, raw_msg=None, idents=[CLIENT], msg=None, header={},
+        metadata={}, targets=set(targets), after=MET, follow=follow, timeout=None,
+    )
+    job.timestamp = timestamp
+    return job
+
+
+def dispatch_rate(depth, n=None, engines=4):
+    """Measure the task dispatch rate with `depth` tasks waiting behind the HWM.
+
+    The oldest half of the waiting tasks are pinned to a busy engine,
+    so they sit at the front of the queue while the other engines take new work.
+
+    Returns the number of finish -> dispatch cycles per second,
+    measured over `n` (default: min(depth // 2, 1000)) cycles.
+    """
+    if n is None:
+        n = min(depth // 2, 1000)
+    scheduler = make_scheduler(engines, hwm=1)
+    pinned = engine_ident(0)
+    try:
+        for i in range(engines):
+            submit(scheduler)
+        for i in range(depth // 2):
+            submit(scheduler, targets=[pinned.decode('ascii')])
+        for i in range(depth - depth // 2):
+            submit(scheduler)
+        tic = time.time()
+        for i in range(n):
+            for engine, pending in scheduler.pending.items():
+                if pending and engine != pinned:
+                    reply(scheduler, engine, next(iter(pending)))
+                    break
+        toc = time.time()
+    finally:
+        close_scheduler(scheduler)
+    return n / (toc - tic)
+
+#-------------------------------------------------------------------------------
+# Tests
+#-------------------------------------------------------------------------------
+
+
+class TestTaskScheduler(TestCase):
+
+    def setUp(self):
+        self.scheduler = make_scheduler(2, hwm=1)
+
+    def tearDown(self):
+        close_scheduler(self.scheduler)
+
+    def test_hwm_queue(self):
+        s = self.scheduler
+        msg_ids = [ submit(s) for i in range(5) ]
+        self.assertEqual(assigned(s), set(msg_ids[:2]))
+        self.assertEqual(len(s.ready), 3)
+        finish(s, msg_ids[0])
+        self.assertEqual(assigned(s), set(msg_ids[1:3]))
+        self.assertEqual(len(s.ready), 2)
+
+    def test_fifo(self):
+        s = self.scheduler
+        msg_ids = [ submit(s) for i in range(10) ]
+        order = msg_ids[:2]
+        while assigned(s):
+            first = min(assigned(s), key=order.index)
+            finish(s, first)
+            order.extend(assigned(s).difference(order))
+        self.assertEqual(order, msg_ids)
+        self.assertEqual(len(s.ready), 0)
+        self.assertEqual(s.queue_map, {})
+
+    def test_targets_wait_for_target(self):
+        s = self.scheduler
+        e0, e1 = engine_ident(0), engine_ident(1)
+        busy = [ submit(s) for i in range(2) ]
+        targeted = submit(s, targets=[e1.decode('ascii')])
+        free = submit(s)
+        # finishing on engine 0 runs the untargeted job
+        finish(s, assigned(s, e0).pop())
+        self.assertEqual(assigned(s, e0), set([free]))
+        self.assertIn(targeted, s.ready)
+        finish(s, assigned(s, e1).pop())
+        self.assertEqual(assigned(s, e1), set([targeted]))
+        self.assertEqual(len(s.ready), 0)
+
+    def test_after(self):
+        s = self.scheduler
+        first = submit(s)
+        later = submit(s, after=Dependency([first]).as_dict())
+        self.assertNotIn(later, s.ready)
+        self.assertIn(later, s.queue_map)
+        self.assertNotIn(later, assigned(s))
+        finish(s, first)
+        self.assertIn(later, assigned(s))
+        self.assertEqual(s.queue_map, {})
+
+    def test_follow(self):
+        s = self.scheduler
+        first = submit(s)
+        other = submit(s)
+        engine = [ e for e in s.pending if first in s.pending[e] ][0]
+        follower = submit(s, follow=Dependency([first]).as_dict())
+        self.assertIn(follower, s.ready)
+        # the other engine is free, but can't run follower
+        finish(s, other)
+        self.assertNotIn(follower, assigned(s))
+        finish(s, first)
+        self.assertEqual(assigned(s, engine), set([follower]))
+        self.assertEqual(len(s.ready), 0)
+
+    def test_unmet_moves_engine(self):
+        s = self.scheduler
+        e0, e1 = engine_ident(0), engine_ident(1)
+        msg_ids = [ submit(s) for i in range(2) ]
+        on_e0 = assigned(s, e0).pop()
+        finish(s, assigned(s, e1).pop())
+        # engine 0 reports an unmet dependency, task should move to engine 1
+        reply(s, e0, on_e0, status='error', dependencies_met=False)
+        self.assertEqual(assigned(s, e1), set([on_e0]))
+        self.assertEqual(assigned(s, e0), set())
+
+    def test_timeout_while_ready(self):
+        s = self.scheduler
+        msg_ids = [ submit(s, timeout=60) for i in range(3) ]
+        waiting = msg_ids[-1]
+        job = s.queue_map[waiting]
+        s.job_timeout(job, job.timeout_id)
+        self.assertNotIn(waiting, s.ready)
+        self.assertIn(waiting, s.all_failed)
+        finish(s, msg_ids[0])
+        self.assertNotIn(waiting, assigned(s))
+
+    def test_batch(self):
+        s = self.scheduler
+        bufs, nbufs = serialize.pack_apply_batch(abs, [ (-i,) for i in range(5) ], {})
+        msg_ids = [ s.session.msg_id for i in range(5) ]
+        msg = s.session.msg('batch_apply_request', dict(msg_ids=msg_ids, nbufs=nbufs))
+        raw = s.session.serialize(msg, ident=CLIENT) + bufs
+        s.dispatch_submission(list(map(zmq.Message, raw)))
+        self.assertEqual(assigned(s), set(msg_ids[:2]))
+        self.assertEqual(len(s.ready), 3)
+        # jobs are individual, signed apply_requests
+        job = s.queue_map[msg_ids[3]]
+        idents, parts = s.session.feed_identities(job.raw_msg, copy=False)
+        task = s.session.deserialize(parts, copy=False)
+        self.assertEqual(idents, [CLIENT])
+        self.assertEqual(task['header']['msg_type'], 'apply_request')
+        self.assertEqual(task['header']['msg_id'], msg_ids[3])
+        self.assertEqual(task['header']['session'], msg['header']['session'])
+        f, args, kwargs = serialize.unpack_apply_message(task['buffers'])
+        self.assertEqual(f(*args), 3)
+
+    def test_batch_compressed(self):
+        """compressed buffers of a batch are left compressed, with per-task indices"""
+        s = self.scheduler
+        s.session.compression = 'zlib'
+        arg_list = [ (b'x' * 2048 * (i + 1),) for i in range(3) ]
+        bufs, nbufs = serialize.pack_apply_batch(len, arg_list, {})
+        msg_ids = [ s.session.msg_id for args in arg_list ]
+        msg = s.session.msg('batch_apply_request', dict(msg_ids=msg_ids, nbufs=nbufs))
+        msg, bufs = s.session.compress_buffers(msg, bufs)
+        self.assertTrue(msg['metadata']['compression']['buffers'])
+        raw = s.session.serialize(msg, ident=CLIENT) + bufs
+        s.dispatch_submission(list(map(zmq.Message, raw)))
+        for msg_id, args in zip(msg_ids, arg_list):
+            jobs = [ p[msg_id] for p in s.pending.values() if msg_id in p ]
+            job = jobs[0] if jobs else s.queue_map[msg_id]
+            idents, parts = s.session.feed_identities(job.raw_msg, copy=False)
+            task = s.session.deserialize(parts, copy=False)
+            self.assertNotIn('compression', task['metadata'])
+            f, args2, kwargs = serialize.unpack_apply_message(task['buffers'])
+            self.assertEqual(f(*args2), len(args[0]))
+
+    def test_graph(self):
+        s = self.scheduler
+        calls = [ (abs, (-1,), {}), (max, (1, 2), {}), (abs, (-3,), {}) ]
+        bufs, nbufs, f_indices = serialize.pack_apply_graph(calls)
+        msg_ids = [ s.session.msg_id for call in calls ]
+        # the second and third tasks depend on the first
+        parents = dict(parents=[msg_ids[0]])
+        content = dict(msg_ids=msg_ids, nbufs=nbufs, nfuncs=2, f_indices=f_indices,
+            task_metadata=[{}, parents, parents],
+        )
+        msg = s.session.msg('batch_apply_request', content)
+        raw = s.session.serialize(msg, ident=CLIENT) + bufs
+        s.dispatch_submission(list(map(zmq.Message, raw)))
+        self.assertEqual(assigned(s), set(msg_ids[:1]))
+        self.assertEqual(set(s.graph[msg_ids[0]]), set(msg_ids[1:]))
+        finish(s, msg_ids[0])
+        self.assertEqual(assigned(s), set(msg_ids[1:]))
+        for msg_id, call in zip(msg_ids, calls):
+            job = [ p[msg_id] for p in s.pending.values() if msg_id in p ]
+            if not job:
+                continue
+            idents, parts = s.session.feed_identities(job[0].raw_msg, copy=False)
+            task = s.session.deserialize(parts, copy=False)
+            f, args, kwargs = serialize.unpack_apply_message(task['buffers'])
+            self.assertEqual(f(*args), call[0](*call[1]))
+
+    def test_parents(self):
+        """the parents of a task are all required, whatever the flags of its `after`"""
+        s = self.scheduler
+        first, second = submit(s), submit(s)
+        after = Dependency([first, second], all=False).as_dict()
+        msg_id = submit(s, after=after, parents=[first, second])
+        finish(s, first)
+        self.assertNotIn(msg_id, assigned(s))
+        finish(s, second)
+        self.assertIn(msg_id, assigned(s))
+
+    def test_function_cache(self):
+        s = self.scheduler
+        first = submit(s, buffers=[b'f', b'args'], f_hash='abc')
+        engine = finish(s, first)
+        self.assertNotIn('abc', s.functions[engine])
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc')
+        engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+        reply(s, engine, msg_id, f_hash='abc', function_cached=True)
+        self.assertIn('abc', s.functions[engine])
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc')
+        job = [ p[msg_id] for p in s.pending.values() if msg_id in p ][0]
+        # the function is only omitted for the engine that has it
+        for target in s.targets:
+            f_buf = s._omit_function(job, target)[-2]
+            if target == engine:
+                self.assertEqual(f_buf, b'')
+            else:
+                self.assertEqual(f_buf.bytes, b'f')
+
+    def test_function_cache_miss(self):
+        s = self.scheduler
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc')
+        engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+        reply(s, engine, msg_id, f_hash='abc', function_cached=True)
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc', targets=[engine.decode('ascii')])
+        reply(s, engine, msg_id, status='error', f_hash='abc', function_cache_miss=True)
+        self.assertNotIn('abc', s.functions[engine])
+        self.assertNotIn(msg_id, s.all_done)
+        # sent again to the same engine, re-signed, with the function
+        job = s.pending[engine][msg_id]
+        idents, parts = s.session.feed_identities(job.raw_msg, copy=False)
+        msg = s.session.deserialize(parts, copy=False)
+        self.assertEqual(idents, [CLIENT])
+        self.assertEqual(msg['metadata']['function_resent'], 1)
+        self.assertEqual(msg['buffers'][0].bytes, b'f')
+
+    def test_function_cache_miss_without_function(self):
+        s = self.scheduler
+        # e.g. a resubmitted record of a request that omitted the function
+        msg_id = submit(s, buffers=[b'', b'args'], f_hash='abc')
+        engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+        reply(s, engine, msg_id, status='error', f_hash='abc', function_cache_miss=True)
+        self.assertIn(msg_id, s.all_failed)
+        self.assertEqual(assigned(s), set())
+
+    def test_memoize(self):
+        # no hwm, so the three tasks that run at the end are all assigned
+        s = make_scheduler(2, hwm=0)
+        try:
+            first = submit(s, buffers=[b'f', b'args'], f_hash='abc', memoize=True)
+            engine = [ e for e in s.pending if first in s.pending[e] ][0]
+            reply(s, engine, first, buffers=[b'result'])
+            self.assertEqual(s.memo_stats['stored'], 1)
+            self.assertEqual(s.memo_nbytes, len(b'result'))
+            # same function and arguments, answered without running,
+            # even if the client omitted the function
+            for f in (b'f', b''):
+                msg_id = submit(s, buffers=[f, b'args'], f_hash='abc', memoize=True)
+                self.assertNotIn(msg_id, assigned(s))
+                self.assertIn(msg_id, s.all_completed)
+                self.assertEqual(s.destinations[msg_id], engine)
+            self.assertEqual(s.memo_stats['hits'], 2)
+            # different arguments, not memoized, or a function without an f_hash, run
+            msg_ids = [
+                submit(s, buffers=[b'f', b'other'], f_hash='abc', memoize=True),
+                submit(s, buffers=[b'f', b'args'], f_hash='abc'),
+                submit(s, buffers=[b'f', b'args'], memoize=True),
+            ]
+            self.assertEqual(assigned(s), set(msg_ids))
+        finally:
+            close_scheduler(s)
+
+    def test_memoize_only_success(self):
+        s = self.scheduler
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc', memoize=True)
+        engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+        reply(s, engine, msg_id, status='error')
+        self.assertEqual(s.memo_stats['stored'], 0)
+        msg_id = submit(s, buffers=[b'f', b'args'], f_hash='abc', memoize=True)
+        self.assertIn(msg_id, assigned(s))
+
+    def test_memoize_eviction(self):
+        s = make_scheduler(2, hwm=0, memo_ttl=60, memo_bytes_limit=10)
+        try:
+            for arg in (b'a', b'b', b'c'):
+                msg_id = submit(s, buffers=[b'f', arg], f_hash='abc', memoize=True)
+                engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+                reply(s, engine, msg_id, buffers=[b'result'])
+            # only one 6 byte result fits, the least recently used are evicted
+            self.assertEqual(len(s.memo), 1)
+            self.assertEqual(s.memo_stats['evicted'], 2)
+            msg_id = submit(s, buffers=[b'f', b'a'], f_hash='abc', memoize=True)
+            self.assertIn(msg_id, assigned(s))
+            # results older than memo_ttl are not used
+            for key, entry in list(s.memo.items()):
+                s.memo[key] = (entry[0] - 120,) + entry[1:]
+            msg_id = submit(s, buffers=[b'f', b'c'], f_hash='abc', memoize=True)
+            self.assertIn(msg_id, assigned(s))
+            self.assertEqual(s.memo_stats['expired'], 1)
+            self.assertEqual(s.memo_stats['hits'], 0)
+        finally:
+            close_scheduler(s)
+
+    def test_data_locality(self):
+        s = make_scheduler(3, hwm=0)
+        e0, e1, e2 = [ engine_ident(i) for i in range(3) ]
+        try:
+            s.update_data_index(e1, added=['A', 'B'])
+            s.update_data_index(e2, added=['A'])
+            # the engine with the most of the data
+            msg_id = submit(s, data=['A', 'B'])
+            self.assertEqual(assigned(s, e1), set([msg_id]))
+            # the least loaded of the engines with the data
+            msg_id = submit(s, data=['A'])
+            self.assertEqual(assigned(s, e2), set([msg_id]))
+            # nobody has the data, least loaded
+            msg_id = submit(s, data=['C'])
+            self.assertEqual(assigned(s, e0), set([msg_id]))
+        finally:
+            close_scheduler(s)
+
+    def test_data_update(self):
+        s = self.scheduler
+        msg_id = submit(s)
+        engine = [ e for e in s.pending if msg_id in s.pending[e] ][0]
+        reply(s, engine, msg_id, data_names=['A', 'B'])
+        self.assertEqual(s.data_index, {'A': set([engine]), 'B': set([engine])})
+        msg_id = submit(s, targets=[engine.decode('ascii')])
+        reply(s, engine, msg_id, data_names=['A'])
+        self.assertNotIn('B', s.data_index)
+        s._unregister_engine(engine)
+        self.assertEqual(s.data_index, {})
+
+    def test_data_two_clients(self):
+        """engines advertise their whole namespace once per upstream socket, whichever client asked"""
+        s = make_scheduler(1)
+        engine = engine_ident(0)
+        kernel = Kernel()
+        ns = set()
+        kernel.data_names = lambda : set(ns)
+        def run(client, *names):
+            msg_id = submit(s, client=client)
+            ns.update(names)
+            # the engine sees the scheduler's engine-facing socket, then the client
+            names = kernel._data_update(b'task_out')
+            md = {} if names is None else dict(data_names=names)
+            reply(s, engine, msg_id, client=client, **md)
+        try:
+            run(b'client-a', 'a')
+            run(b'client-b', 'b')
+            self.assertEqual(s.engine_data[engine], set(['a', 'b']))
+            ns.discard('a')
+            run(b'client-a')
+            self.assertEqual(s.data_index, {'b': set([engine])})
+            # a request relayed by the MUX does not use up the change
+            ns.add('c')
+            self.assertEqual(kernel._data_update(b'mux_out'), ['b', 'c'])
+            run(b'client-b')
+            self.assertEqual(s.engine_data[engine], set(['b', 'c']))
+            self.assertEqual(len(kernel._data_advertised), 2)
+        finally:
+            close_scheduler(s)
+
+    def test_mintime(self):
+        s = make_scheduler(2, hwm=0, scheme_name='mintime')
+        e0, e1 = engine_ident(0), engine_ident(1)
+        try:
+            # no observed runtimes yet: least load
+            first = [ submit(s) for i in range(2) ]
+            self.assertEqual(len(assigned(s, e0)), 1)
+            now = datetime.now()
+            reply(s, e0, assigned(s, e0).pop(), started=now - timedelta(seconds=1))
+            reply(s, e1, assigned(s, e1).pop(), started=now - timedelta(seconds=9.5))
+            self.assertAlmostEqual(s.runtimes[e0], 1, 1)
+            self.assertAlmostEqual(s.runtimes[e1], 9.5, 1)
+            # engine 0 can finish 9 tasks before engine 1 finishes one, but not 10
+            msg_ids = [ submit(s) for i in range(10) ]
+            self.assertEqual(len(assigned(s, e0)), 9)
+            self.assertEqual(len(assigned(s, e1)), 1)
+            # runtimes are a moving average
+            reply(s, e1, assigned(s, e1).pop(), started=datetime.now() - timedelta(seconds=1))
+            self.assertAlmostEqual(s.runtimes[e1], 0.2 * 1 + 0.8 * 9.5, 1)
+        finally:
+            close_scheduler(s)
+
+    def steal_setup(self):
+        """Two engines with two tasks each, where engine 1 finishes first,
+        so the newest task on engine 0 is stolen.
+
+        Returns the stolen task's msg_id and header.
+        """
+        ctx = zmq.Context.instance()
+        s = make_scheduler(2, hwm=0, work_stealing=True)
+        s.control_stream = zmqstream.ZMQStream(ctx.socket(zmq.DEALER), s.loop)
+        e0, e1 = engine_ident(0), engine_ident(1)
+        msg_ids = [ submit(s) for i in range(4) ]
+        on_e0 = sorted(assigned(s, e0), key=msg_ids.index)
+        self.assertEqual(len(on_e0), 2)
+        header = s.pending[e0][on_e0[1]].header
+        for msg_id in assigned(s, e1):
+            finish(s, msg_id)
+        self.assertEqual(assigned(s, e1), set([on_e0[1]]))
+        self.assertEqual(assigned(s, e0), set([on_e0[0]]))
+        self.assertEqual(s.steal_stats['stolen'], 1)
+        return s, on_e0[1], header
+
+    def test_steal_aborted(self):
+        s, stolen, header = self.steal_setup()
+        e0, e1 = engine_ident(0), engine_ident(1)
+        try:
+            reply(s, e0, stolen, parent=header, status='aborted')
+            self.assertEqual(s.steal_stats['aborted'], 1)
+            self.assertNotIn(stolen, s.all_done)
+            self.assertEqual(s.stolen, {})
+            finish(s, stolen)
+            self.assertIn(stolen, s.all_completed)
+            self.assertEqual(s.destinations[stolen], e1)
+        finally:
+            close_scheduler(s)
+
+    def test_steal_duplicated(self):
+        s, stolen, header = self.steal_setup()
+        e0, e1 = engine_ident(0), engine_ident(1)
+        try:
+            # engine 0 ran the task before the abort request arrived
+            reply(s, e0, stolen, parent=header)
+            self.assertEqual(s.steal_stats['duplicated'], 1)
+            self.assertIn(stolen, s.all_completed)
+            self.assertEqual(s.destinations[stolen], e0)
+            self.assertNotIn(stolen, assigned(s))
+            # the later result from engine 1 is dropped
+            reply(s, e1, stolen, parent=header)
+            self.assertEqual(s.loads[s.targets.index(e1)], 0)
+            self.assertEqual(s.destinations[stolen], e0)
+        finally:
+            close_scheduler(s)
+
+
+class TestReadyQueue(TestCase):
+
+    def test_oldest_first(self):
+        q = ReadyQueue()
+        jobs = [ make_job(str(t), t) for t in (3, 1, 2) ]
+        for job in jobs:
+            q.add(job)
+        self.assertEqual(len(q), 3)
+        self.assertIs(q.oldest([]), jobs[1])
+        q.discard(jobs[1])
+        self.assertIs(q.oldest([]), jobs[2])
+        q.discard(jobs[2])
+        q.discard(jobs[0])
+        self.assertIsNone(q.oldest([]))
+        self.assertEqual(len(q), 0)
+
+    def test_targeted(self):
+        q = ReadyQueue()
+        a, b = engine_ident(0), engine_ident(1)
+        targeted = make_job('targeted', 1, targets=set([a]))
+        anywhere = make_job('anywhere', 2)
+        q.add(targeted)
+        q.add(anywhere)
+        self.assertIs(q.oldest([a]), targeted)
+        self.assertIs(q.oldest([b]), anywhere)
+        q.discard(targeted)
+        self.assertIs(q.oldest([a]), anywhere)
+
+    def test_restricted(self):
+        q = ReadyQueue()
+        follow = make_job('follow', 1, follow=Dependency(['other']))
+        blacklisted = make_job('blacklisted', 2)
+        blacklisted.blacklist.add(engine_ident(0))
+        q.add(follow)
+        q.add(blacklisted)
+        self.assertIsNone(q.oldest([engine_ident(0)]))
+        self.assertEqual(q.restricted_jobs(), [follow, blacklisted])
+        q.discard(follow)
+        self.assertEqual(q.restricted_jobs(), [blacklisted])
+
+    def test_token_invalidation(self):
+        q = ReadyQueue()
+        job = make_job('a', 1)
+        q.add(job)
+        # adding twice is a no-op
+        q.add(job)
+        self.assertEqual(q._entries, 1)
+        q.discard(job)
+        self.assertIsNone(job.ready_token)
+        self.assertIsNone(q.oldest([]))
+        # re-adding gets a new token, and the stale entry is never returned
+        q.add(job)
+        q.add(make_job('b', 2))
+        self.assertIs(q.oldest([]), job)
+        q.discard(job)
+        self.assertEqual(q.oldest([]).msg_id, 'b')
+
+    def test_compact(self):
+        q = ReadyQueue()
+        keep = make_job('keep', 0)
+        q.add(keep)
+        for i in range(3000):
+            job = make_job(str(i), i + 1, targets=set([engine_ident(i % 2)]))
+            q.add(job)
+            q.discard(job)
+        # stale entries are dropped, without touching live jobs
+        self.assertTrue(q._entries <= 2 * len(q) + 1024)
+        self.assertEqual(len(q), 1)
+        self.assertIs(q.oldest([engine_ident(0)]), keep)
+
+
+if __name__ == '__main__':
+    print("%8s  %s" % ("depth", "tasks/s"))
+    for depth in (100, 1000, 10000, 100000):
+        print("%8i  %i" % (depth, dispatch_rate(depth)))
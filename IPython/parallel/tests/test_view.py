@@ -15,12 +15,15 @@
 from nose.plugins.attrib import attr
 
 from IPython.testing import decorators as dec
+from IPython.kernel.zmq.serialize import serialize_object
+from IPython.kernel.zmq.session import Session
 from IPython.utils.io import capture_output
 from IPython.utils.py3compat import unicode_type
 
 from IPython import parallel  as pmod
 from IPython.parallel import error
 from IPython.parallel import AsyncResult, AsyncHubResult, AsyncMapResult
+from IPython.parallel.engine import relay
 from IPython.parallel.util import interactive
 
 from IPython.parallel.tests import add_engines
@@ -108,6 +111,72 @@ def testf(x):
         r = pull(('testf','g'))
         self.assertEqual((r[0](10),r[1](10)), (testf(10), 100))
     
+    def test_broadcast(self):
+        """test pushing through a tree of engines"""
+        self.minimum_engines(4)
+        data = dict(a=10, c=list(range(10)), d={'e':(1,2),'f':'hi'})
+        v = self.client[:]
+        for fanout in (1, 2, 3):
+            ar = v.broadcast({'data':data}, fanout=fanout, block=False)
+            self.assertTrue(isinstance(ar, AsyncResult))
+            self.assertEqual(len(ar.msg_ids), len(v))
+            ar.get(10)
+            self.assertEqual(v.pull('data', block=True), len(v) * [data])
+        # a single engine is a regular push
+        ar = self.client[-1].broadcast({'data':data}, block=False)
+        self.assertEqual(len(ar.msg_ids), 1)
+        ar.get(10)
+
+    def test_broadcast_timeout(self):
+        """engines give up on broadcasts that don't arrive"""
+        e0 = self.client[-1]
+        self.assertRaisesRemote(error.TimeoutError, e0.apply_sync, relay.broadcast_recv, 'missing', 0.2)
+
+    def test_broadcast_late(self):
+        """broadcasts that arrive after their recv timed out are dropped"""
+        e0 = self.client[-1]
+        url = e0.apply_sync(relay.relay_url)
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.connect(url)
+        try:
+            self.assertRaisesRemote(error.TimeoutError, e0.apply_sync, relay.broadcast_recv, 'late', 0.2)
+            self.client.session.send(sock, 'broadcast', content=dict(tag='late', children=[]),
+                buffers=serialize_object(dict(late=True)))
+            # the late message is read while waiting for another broadcast
+            self.assertRaisesRemote(error.TimeoutError, e0.apply_sync, relay.broadcast_recv, 'other', 0.5)
+            e0.execute('from IPython.parallel.engine import relay as _relay', block=True)
+            e0.execute('_kept = sorted(_relay.get_relay().early)', block=True)
+            self.assertEqual(e0['_kept'], [])
+        finally:
+            sock.close(linger=0)
+
+    def test_broadcast_unsigned(self):
+        """relayed messages that fail the signature check are dropped"""
+        e0 = self.client[-1]
+        url = e0.apply_sync(relay.relay_url)
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.connect(url)
+        try:
+            Session(key=b'wrong').send(sock, 'broadcast', content=dict(tag='bad', children=[]),
+                buffers=serialize_object(dict(forged=True)))
+            self.assertRaisesRemote(error.TimeoutError, e0.apply_sync, relay.broadcast_recv, 'bad', 0.5)
+            e0.execute('forged = globals().get("forged", False)', block=True)
+            self.assertEqual(e0['forged'], False)
+        finally:
+            sock.close(linger=0)
+
+    @skip_without('numpy')
+    def test_broadcast_numpy(self):
+        """broadcast arrays, which are forwarded without copying"""
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        self.minimum_engines(3)
+        A = numpy.random.random((256, 64))
+        v = self.client[:]
+        v.broadcast({'A':A}, block=True)
+        for B in v.pull('A', block=True):
+            assert_array_equal(A, B)
+
     def test_push_function_globals(self):
         """test that pushed functions have access to globals"""
         @interactive
@@ -234,6 +303,29 @@ def test_scatter_gather_numpy(self):
         b = view.gather('a', block=True)
         assert_array_equal(b, a)
     
+    def test_scatter_gather_stream(self):
+        view = self.client[:]
+        x = list(range(100))
+        view.scatter_stream('x', x, chunksize=7, max_pending=2)
+        self.assertEqual(view.gather('x', block=True), x)
+        self.assertEqual(view.gather_stream('x', chunksize=5), x)
+        # iterators are dealt in chunks
+        view.scatter_stream('y', iter(x), chunksize=10)
+        self.assertEqual(sorted(view.gather('y', block=True)), x)
+
+    @skip_without('numpy')
+    def test_scatter_gather_stream_memmap(self):
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[:]
+        with NamedTemporaryFile() as src, NamedTemporaryFile() as dst:
+            a = numpy.memmap(src.name, dtype='float64', mode='w+', shape=(1000, 4))
+            a[:] = numpy.random.random(a.shape)
+            view.scatter_stream('a', a, chunksize=64)
+            out = numpy.memmap(dst.name, dtype='float64', mode='w+', shape=a.shape)
+            self.assertTrue(view.gather_stream('a', out, chunksize=50) is out)
+            assert_array_equal(out, a)
+
     def test_scatter_gather_lazy(self):
         """scatter/gather with targets='all'"""
         view = self.client.direct_view(targets='all')
@@ -336,6 +428,14 @@ def f(x):
         r = view.map_sync(f, data)
         self.assertEqual(r, list(map(f, data)))
     
+    def test_imap(self):
+        view = self.client[:]
+        r = list(view.imap(lambda x: x**2, iter(range(16)), chunksize=3))
+        self.assertEqual(r, [ x**2 for x in range(16) ])
+        # chunks go to each engine in turn
+        engines = list(view.imap(lambda x: __import__('os').getpid(), range(2 * len(view))))
+        self.assertEqual(len(set(engines)), len(view))
+
     def test_map_empty_sequence(self):
         view = self.client[:]
         r = view.map_sync(lambda x: x, [])
@@ -815,6 +915,37 @@ def echoxy(p):
         tup = view.apply_sync(echoxy, point(1, 2))
         self.assertEqual(tup, (2,1))
     
+    def test_function_cache(self):
+        def add(a, b=0):
+            return a + b
+        
+        view = self.client[-1]
+        engine = self.client._engines[self.client.ids[-1]].encode('ascii')
+        self.assertEqual(view.apply_sync(add, 1, b=2), 3)
+        self.assertEqual(len(self.client._functions[engine]), 1)
+        # the second request omits the function
+        ar = view.apply_async(add, 2, b=3)
+        self.assertEqual(list(self.client._omitted_functions), ar.msg_ids)
+        self.assertEqual(ar.get(5), 5)
+        self.assertEqual(self.client._omitted_functions, {})
+    
+    def test_function_cache_miss(self):
+        def sub(a, b=0):
+            return a - b
+        
+        view = self.client[-1]
+        self.assertEqual(view.apply_sync(sub, 3, b=2), 1)
+        # evict everything on the engine
+        view.execute('get_ipython().kernel.function_cache.clear()', block=True)
+        # the request missing its function is sent again
+        self.assertEqual(view.apply_sync(sub, 5, b=1), 4)
+        self.assertEqual(self.client._omitted_functions, {})
+        # and the Hub has a complete record
+        ar = view.apply_async(sub, 7)
+        ar.get(5)
+        rec = self.client.db_query({'msg_id' : ar.msg_ids[0]}, keys=['completed', 'result_content'])[0]
+        self.assertEqual(rec['result_content']['status'], 'ok')
+    
     def test_sync_imports(self):
         view = self.client[-1]
         with capture_output() as io:
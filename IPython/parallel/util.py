@@ -222,6 +222,58 @@ def disambiguate_url(url, location=None):
     return "%s://%s:%s"%(proto,ip,port)
 
 
+def split_apply_batch(msg):
+    """Split a deserialized batch_apply_request into its apply_request messages.
+
+    Each task gets a copy of the batch header, with its own msg_id,
+    and the function buffer followed by its own buffers.
+
+    A batch may have several functions (see `serialize.pack_apply_graph`):
+    then the first `nfuncs` buffers are functions, and `f_indices` in the content
+    selects the function of each task.  If the content has `task_metadata`,
+    each task's metadata is updated with its own entry.
+
+    Buffers compressed by the Session are left compressed, and the indices
+    in each task's 'compression' metadata are remapped to its own buffers.
+
+    Returns a list of message dicts.
+    """
+    header = msg['header']
+    content = msg['content']
+    buffers = msg['buffers']
+    msg_ids = content['msg_ids']
+    nfuncs = content.get('nfuncs', 1)
+    f_indices = content.get('f_indices') or [0] * len(msg_ids)
+    task_metadata = content.get('task_metadata') or [{}] * len(msg_ids)
+    compression = msg['metadata'].get('compression')
+    compressed = set(compression['buffers']) if compression else set()
+    offset = nfuncs
+    msgs = []
+    for msg_id, nbufs, f_idx, task_md in zip(msg_ids, content['nbufs'], f_indices, task_metadata):
+        task_header = dict(header, msg_id=msg_id, msg_type='apply_request')
+        md = dict(msg['metadata'])
+        md.update(task_md)
+        if compression:
+            task_compressed = [0] if f_idx in compressed else []
+            task_compressed.extend(i - offset + 1 for i in range(offset, offset + nbufs)
+                                   if i in compressed)
+            if task_compressed:
+                md['compression'] = dict(compression, buffers=task_compressed)
+            else:
+                del md['compression']
+        msgs.append(dict(
+            header=task_header,
+            msg_id=msg_id,
+            msg_type='apply_request',
+            parent_header=msg['parent_header'],
+            metadata=md,
+            content={},
+            buffers=[buffers[f_idx]] + buffers[offset:offset+nbufs],
+        ))
+        offset += nbufs
+    return msgs
+
+
 #--------------------------------------------------------------------------
 # helpers for implementing old MEC API via view.apply
 #--------------------------------------------------------------------------
@@ -265,6 +317,19 @@ def _pull(keys):
     else:
         return eval(keys, globals())
 
+@interactive
+def _append_chunk(key, chunk):
+    """helper method for implementing `scatter_stream`: collect the chunks of `key`"""
+    user_chunks = globals().setdefault('_IP_CHUNKS_', {})
+    user_chunks.setdefault(key, []).append(chunk)
+
+@interactive
+def _join_chunks(key):
+    """helper method for implementing `scatter_stream`: assign the collected chunks to `key`"""
+    from IPython.parallel.client.map import Map
+    chunks = globals().get('_IP_CHUNKS_', {}).pop(key, [])
+    globals()[key] = Map().concatenate(chunks) if chunks else []
+
 @interactive
 def _execute(code):
     """helper method for implementing `client.execute` via `client.apply`"""
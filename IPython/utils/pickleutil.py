@@ -263,6 +263,8 @@ def get_object(self, g=None):
             # we just pickled it
             return pickle.loads(buffer_to_bytes_py2(data))
         else:
+            # use the memory of zmq Frames directly, instead of copying it
+            data = getattr(data, 'buffer', data)
             return frombuffer(data, dtype=self.dtype).reshape(self.shape)
 
 
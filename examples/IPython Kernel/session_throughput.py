@@ -0,0 +1,56 @@
+"""Time how many messages per second Session.deserialize can handle.
+
+Run::
+
+    python session_throughput.py [n]
+
+This signs n small messages, in groups of ten sharing a parent like the
+outputs of a request, and times deserializing them:
+
+- with a few values of Session.digest_history_size, the number of signatures
+  remembered to reject replayed messages, printing the slowest single message,
+  where the cost of forgetting old signatures would show up as a latency spike.
+- with JSON and packed headers (Session.packed_headers).
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from IPython.kernel.zmq.session import Session
+
+KEY = b'benchmark'
+
+def make_messages(n, **kwargs):
+    """Serialize n outputs, without their delimiter"""
+    session = Session(key=KEY, **kwargs)
+    messages = []
+    for i in range(n):
+        if i % 10 == 0:
+            parent = session.msg('execute_request')
+        msg = session.msg('stream', dict(name='stdout', text='%i\n' % i), parent=parent)
+        messages.append(session.serialize(msg)[1:])
+    return messages
+
+def time_deserialize(messages, **kwargs):
+    """Deserialize messages, and return messages/sec and the slowest message"""
+    session = Session(key=KEY, **kwargs)
+    slowest = 0
+    tic = time.time()
+    for msg_list in messages:
+        t = time.time()
+        session.deserialize(msg_list)
+        slowest = max(slowest, time.time() - t)
+    return len(messages) / (time.time() - tic), slowest
+
+def main(n=100000):
+    messages = make_messages(n)
+    for size in (0, 2**10, 2**16, 2**20):
+        rate, slowest = time_deserialize(messages, digest_history_size=size)
+        print("digest_history_size=%-8i %8.0f msgs/s, slowest %6.2f ms" % (size, rate, 1e3 * slowest))
+    for packed in (False, True):
+        rate, slowest = time_deserialize(make_messages(n, packed_headers=packed))
+        print("packed_headers=%-5s %8.0f msgs/s" % (packed, rate))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
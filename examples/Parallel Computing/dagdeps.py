@@ -69,6 +69,13 @@ def validate_tree(G, results):
             finished = results[parent].metadata.completed
             assert started > finished, "%s should have happened after %s"%(node, parent)
 
+def submit_graph(view, G, jobs):
+    """Submit all the jobs in one message, with view.submit_graph"""
+    dag = {}
+    for node in G:
+        dag[node] = (jobs[node], (), {}, list(G.predecessors(node)))
+    return view.submit_graph(dag)
+
 def main(nodes, edges):
     """Generate a random graph, submit jobs, then validate that the
     dependency order was enforced.
@@ -90,7 +97,7 @@ def main(nodes, edges):
     client = parallel.Client()
     view = client.load_balanced_view()
     print("submitting %i tasks with %i dependencies"%(nodes,edges))
-    results = submit_jobs(view, G, jobs)
+    results = submit_graph(view, G, jobs)
     print("waiting for results")
     view.wait()
     print("done")
@@ -0,0 +1,48 @@
+"""Time how long engines take to start and register with the controller.
+
+Start a controller first::
+
+    ipcontroller --profile=default
+
+then run::
+
+    python startup.py [n]
+
+This starts n engines with `ipcluster engines` for a few values of
+LocalEngineSetLauncher.start_concurrency, and times how long it takes
+for all of them to register, with Client.wait_for_engines.
+"""
+from __future__ import print_function
+
+import sys
+import time
+from subprocess import Popen
+
+from IPython import parallel
+
+def time_startup(client, n, concurrency):
+    """Start n engines, and return how long it took for them to register"""
+    tic = time.time()
+    p = Popen([sys.executable, '-m', 'IPython.parallel.cluster', 'engines',
+        '--n=%i' % n,
+        '--LocalEngineSetLauncher.start_concurrency=%i' % concurrency,
+    ])
+    try:
+        client.wait_for_engines(n, timeout=600)
+        return time.time() - tic
+    finally:
+        client.shutdown(hub=False, block=True)
+        p.wait()
+        while client.ids:
+            time.sleep(0.1)
+
+def main(n=32):
+    client = parallel.Client()
+    if client.ids:
+        sys.exit("Found %i engines, start with a controller and no engines" % len(client.ids))
+    for concurrency in (1, 4, 16, 64):
+        t = time_startup(client, n, concurrency)
+        print("%4i engines, %3i at a time: %6.2f s" % (n, concurrency, t))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))